@@ -1 +1,3 @@
 __author__ = 'Sean'
+
+default_app_config = __name__ + ".apps.CcbMerchantConfig"
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ccb_merchant_module的AppConfig
+    ready()时(app registry已就绪)校验CMMC_ORDER_*配置并缓存订单模型和字段名，之后order_config()直接返回缓存；
+    检查REQUEST_SN计数器使用共享cache；开启CMMC_CALLBACK_ASYNC时检查spool目录配置，
+    回调队列在进程处理第一个请求时启动，见callback_queue；
+    ccb_merchant_proxy导入时不再导入订单模块，qrcode/lxml/requests/PIL在首次使用时才导入，
+    可以在models或其他app加载过程中导入本模块。
+    @@调用：
+        INSTALLED_APPS = [..., "ccb_merchant_module"]      # 自动使用CcbMerchantConfig
+        order_model().objects.filter(...)
+        python manage.py cmmc_import_time                  # 测量导入耗时
+"""
+import threading
+from importlib import import_module
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class OrderConfig(object):
+    """
+        已校验的订单模型和字段名
+    """
+    __slots__ = ("model", "code", "amount", "pay_time", "pay_status", "del_flag", "user")
+
+    def __init__(self, model):
+        self.model = model
+        self.code = settings.CMMC_ORDER_CODE_CONF
+        self.amount = settings.CMMC_ORDER_PAY_AMOUNT
+        self.pay_time = settings.CMMC_ORDER_PAY_TIME
+        self.pay_status = settings.CMMC_ORDER_PAY_STATUS
+        self.del_flag = settings.CMMC_ORDER_DEL_FLAG
+        # 可选，订单所属用户字段名，api/pay_status按此字段只允许查询自己的订单
+        self.user = getattr(settings, "CMMC_ORDER_USER", None)
+
+
+def resolve_order_config():
+    """
+        导入订单模块并检查Order的字段是否配置正确
+    """
+    if not settings.CMMC_ORDER_MODELS_CONF:
+        raise ImportError(u"客户端关联订单模块找不到.")
+    if not settings.CMMC_ORDER_NAME:
+        raise Exception(u"请正确配置订单名-CMMC_ORDER_NAME.")
+
+    order_module = import_module(settings.CMMC_ORDER_MODELS_CONF)
+    order = getattr(order_module, settings.CMMC_ORDER_NAME, None)
+    if not order:
+        raise Exception(u"订单配置错误")
+
+    if not getattr(order, settings.CMMC_ORDER_PAY_AMOUNT, None):
+        raise Exception(u"订单付款金额字段配置错误")
+    if not getattr(order, settings.CMMC_ORDER_PAY_STATUS, None):
+        raise Exception(u"订单付款状态字段配置错误")
+    if not getattr(order, settings.CMMC_ORDER_PAY_TIME, None):
+        raise Exception(u"订单付款时间字段配置错误")
+    if settings.CMMC_ORDER_CODE_CONF:
+        if not getattr(order, settings.CMMC_ORDER_CODE_CONF, None):
+            raise Exception(u"订单号字段配置错误")
+    if getattr(settings, "CMMC_ORDER_USER", None):
+        if not getattr(order, settings.CMMC_ORDER_USER, None):
+            raise Exception(u"订单用户字段配置错误")
+    return OrderConfig(order)
+
+
+_order_config = None
+_order_config_lock = threading.Lock()
+
+
+def order_config():
+    """
+        缓存的订单配置，首次调用时解析并校验
+    """
+    global _order_config
+    if _order_config is None:
+        with _order_config_lock:
+            if _order_config is None:
+                _order_config = resolve_order_config()
+    return _order_config
+
+
+def order_model():
+    return order_config().model
+
+
+class CcbMerchantConfig(AppConfig):
+    name = __name__.rpartition(".")[0]
+    label = "ccb_merchant_module"
+    verbose_name = u"建设银行商户"
+
+    def ready(self):
+        order_config()
+        from request_sn import check_request_sn_cache
+        check_request_sn_cache()
+        if getattr(settings, "CMMC_CALLBACK_ASYNC", False):
+            if not getattr(settings, "CMMC_CALLBACK_SPOOL_DIR", None):
+                raise Exception(u"请配置持久化的回调spool目录-CMMC_CALLBACK_SPOOL_DIR")
+            # 只在处理请求的进程中启动，管理命令和fork前的master进程不启动后台线程
+            from django.core.signals import request_started
+            from callback_queue import start_callback_queue
+            request_started.connect(start_callback_queue, dispatch_uid="cmmc_callback_queue")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+BankProxy的非阻塞调用封装
+AsyncBankProxy: 在共享线程池中执行PAY/QUERY_PAY/REFUND/QUERY_REFUND，立即返回AsyncResult，
+                调用线程不再被银行响应时间占用
+    @@调用：
+        async_result = AsyncBankProxy(order_code=order_code, action="QUERY_PAY", user=user).proxy_bank()
+        # 非默认商户的订单传入merchant_id，与BankProxy一致
+        ...
+        result_str = async_result.get(timeout=30)      # 与BankProxy.proxy_bank的返回值/异常一致
+    @@回调：
+        open_bank_reply_async(request)、bank_verify_sign_async(raw_str) 同样返回AsyncResult
+    @@说明：
+        本模块运行在python2上，没有asyncio，使用multiprocessing.pool.ThreadPool承载并发的银行请求，
+        银行请求多为网络等待，线程池大小即为同时在途的银行请求数量。
+    @@setting配置(可选)：
+        CMMC_ASYNC_WORKERS = 100        # 线程池大小
+"""
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.db import close_old_connections
+import ccb_merchant_proxy as agents
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def worker_pool():
+    """
+        全局线程池，首次使用时创建
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPool(getattr(settings, "CMMC_ASYNC_WORKERS", 100))
+    return _pool
+
+
+def _run(func, *args):
+    """
+        线程池中执行，结束后释放当前线程的数据库连接
+    """
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+def submit(func, *args, **kwargs):
+    """
+        提交任务到线程池，返回AsyncResult
+        :param callback: 成功时以返回值调用的函数，在线程池的结果线程中执行
+    """
+    return worker_pool().apply_async(_run, (func,) + args, callback=kwargs.get("callback"))
+
+
+class AsyncBankProxy(object):
+    """
+        银行系统代理的非阻塞版本
+    """
+    Action = agents.BankProxy.Action
+
+    def __init__(self, order_code=None, action=None, user=None, merchant_id=None):
+        if not user:
+            raise agents.AuthError(u"需要用户权限")
+        if action not in self.Action:
+            raise agents.ActionError(u"动作命令错误")
+        if not order_code:
+            raise agents.OrderError(u"订单号错误")
+        self.order_code = order_code
+        self.action = action
+        self.user = user
+        self.merchant_id = merchant_id
+
+    def _proxy_bank(self):
+        return agents.BankProxy(order_code=self.order_code, action=self.action, user=self.user,
+                                merchant_id=self.merchant_id).proxy_bank()
+
+    def proxy_bank(self, callback=None):
+        """
+            提交银行操作，返回AsyncResult，get()得到BankProxy.proxy_bank的结果或抛出其异常
+        """
+        return submit(self._proxy_bank, callback=callback)
+
+    @classmethod
+    def query_range(cls, start, end, kind="PAY", status="3", settled="0", user=None, callback=None,
+                    merchant_id=None):
+        """
+            非阻塞的时间段流水查询，AsyncResult.get()返回记录列表
+        """
+        agents.BankProxy.check_request("QUERY_" + kind, user)
+        return submit(lambda: list(agents.BankProxy.query_range(start, end, kind, status, settled, user,
+                                                                merchant_id=merchant_id)),
+                      callback=callback)
+
+
+def open_bank_reply_async(request, callback=None):
+    """
+        非阻塞的银行回调处理
+    """
+    return submit(agents.open_bank_reply, request, callback=callback)
+
+
+def bank_verify_sign_async(raw_str, callback=None):
+    """
+        非阻塞的银行验签
+    """
+    return submit(agents.bank_verify_sign, raw_str, callback=callback)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行通信审计日志
+    AuditLog: 请求线程只把结构化事件(dict)放入有界内存队列，不格式化、不脱敏、不写磁盘，队列满时丢弃并计数；
+        后台线程批量取出事件，脱敏后序列化为json行，一次写入按大小滚动的追加文件。
+    @@事件：
+        tx          银行客户端交易(含5W1001登录): tx_code, sn, order, merchant, endpoint, elapsed, return_code, error,
+                    CMMC_AUDIT_INCLUDE_XML时另有request/response报文
+        verify      验签: elapsed, result, error
+        callback    银行回调: params(SIGN已脱敏), remote_addr, duplicated
+        request     HTTP请求(log_request): method, path, remote_addr, user
+        error       异常: message, traceback(在后台线程中格式化)
+    @@脱敏：
+        CMMC_AUDIT_MASK_FIELDS中的字段(默认PASSWORD、SIGN)：dict中的同名key、xml中的<PASSWORD>..</PASSWORD>、
+        key=value字符串中的SIGN=..，值替换为******。
+    @@文件：
+        目录下每个进程一个文件cmmc_audit.<pid>.log，超过CMMC_AUDIT_MAX_BYTES时滚动为.1、.2...，
+        保留CMMC_AUDIT_BACKUP_COUNT个。
+    @@调用：
+        audit_event("tx", tx_code="5W1002", sn=sn, order=order_code, elapsed=0.01, return_code="000000")
+    @@setting配置(均可选)：
+        CMMC_AUDIT_ENABLED = False                  # 是否记录审计日志
+        CMMC_AUDIT_DIR = None                       # 日志目录，默认为系统临时目录下的cmmc_audit
+        CMMC_AUDIT_MAX_BYTES = 64 * 1024 * 1024     # 单个文件大小上限
+        CMMC_AUDIT_BACKUP_COUNT = 10                # 保留的滚动文件数
+        CMMC_AUDIT_QUEUE_SIZE = 10000               # 内存队列长度，满时丢弃新事件
+        CMMC_AUDIT_BATCH_SIZE = 500                 # 每次写入的最大事件数
+        CMMC_AUDIT_FLUSH_INTERVAL = 1               # 队列为空时的最长等待时间(秒)
+        CMMC_AUDIT_INCLUDE_XML = False              # 是否记录脱敏后的请求/应答报文
+        CMMC_AUDIT_MASK_FIELDS = ("PASSWORD", "SIGN")
+"""
+import os
+import re
+import json
+import time
+import Queue
+import atexit
+import logging
+import tempfile
+import threading
+import traceback
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MASK = "******"
+
+
+class Redactor(object):
+    """
+        按字段名脱敏
+    """
+
+    def __init__(self, fields=("PASSWORD", "SIGN")):
+        self.fields = frozenset(field.upper() for field in fields)
+        names = "|".join(re.escape(field) for field in fields)
+        self._xml = re.compile(r"(<({0})>)(.*?)(</\2>)".format(names), re.I | re.S)
+        self._pairs = re.compile(r"((?:^|[&\s?])(?:{0})=)[^&\s]*".format(names), re.I)
+
+    def text(self, value):
+        if isinstance(value, str):
+            try:
+                value = value.decode("utf-8")
+            except UnicodeDecodeError:
+                # 银行报文为GB2312/GBK编码
+                value = value.decode("gb18030", "replace")
+        value = self._xml.sub(lambda match: match.group(1) + MASK + match.group(4), value)
+        return self._pairs.sub(lambda match: match.group(1) + MASK, value)
+
+    def redact(self, value):
+        if isinstance(value, dict):
+            return dict((key, MASK if u"{0}".format(key).upper() in self.fields else self.redact(item))
+                        for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return [self.redact(item) for item in value]
+        if isinstance(value, basestring):
+            return self.text(value)
+        return value
+
+
+class RotatingWriter(object):
+    """
+        按大小滚动的追加文件，只在后台线程中使用
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backup_count=10):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._fp = None
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._fp = open(self.path, "ab")
+
+    def rotate(self):
+        self.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = "{0}.{1}".format(self.path, index)
+            if os.path.exists(source):
+                os.rename(source, "{0}.{1}".format(self.path, index + 1))
+        if self.backup_count > 0:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+    def write(self, data):
+        if self._fp is None:
+            self._open()
+        if self._fp.tell() and self._fp.tell() + len(data) > self.max_bytes:
+            self.rotate()
+            self._open()
+        self._fp.write(data)
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class AuditLog(object):
+    """
+        审计事件队列 + 后台写入线程
+    """
+
+    def __init__(self, writer, redactor, queue_size=10000, batch_size=500, flush_interval=1, include_xml=False):
+        self.writer = writer
+        self.redactor = redactor
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.include_xml = include_xml
+        self._queue = Queue.Queue(queue_size)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {"emitted": 0, "dropped": 0, "written": 0, "batches": 0, "errors": 0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._write_loop, name="cmmc-audit-writer")
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.close, 2)
+
+    def emit(self, event, **fields):
+        """
+            记录一个事件，不阻塞；exc_info=sys.exc_info()时在后台线程中格式化traceback
+        """
+        if self._thread is None:
+            self.start()
+        fields["event"] = event
+        fields["ts"] = time.time()
+        try:
+            self._queue.put_nowait(fields)
+            self._stats["emitted"] += 1
+        except Queue.Full:
+            self._stats["dropped"] += 1
+
+    def serialize(self, fields):
+        exc_info = fields.pop("exc_info", None)
+        if exc_info:
+            fields["traceback"] = "".join(traceback.format_exception(*exc_info))
+        return json.dumps(self.redactor.redact(fields), ensure_ascii=False, default=repr).encode("utf-8") + "\n"
+
+    def _write_loop(self):
+        while not self._stopping.is_set():
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except Queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                lines = []
+                for fields in batch:
+                    try:
+                        lines.append(self.serialize(fields))
+                    except Exception as ex:
+                        self._stats["errors"] += 1
+                        logger.error(u"[audit]: serialize {0} failed: {1}".format(fields.get("event"), ex))
+                self.writer.write("".join(lines))
+                self._stats["written"] += len(lines)
+                self._stats["batches"] += 1
+            except Exception as ex:
+                self._stats["errors"] += 1
+                logger.error(u"[audit]: write failed: {0}".format(ex))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self, timeout=5):
+        """
+            等待队列中的事件写入文件，返回是否已全部写入
+        """
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def close(self, timeout=5):
+        """
+            写完队列中的事件后停止后台线程(进程退出时调用)
+        """
+        flushed = self.flush(timeout)
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval + 1)
+        self.writer.close()
+        return flushed
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["pending"] = self._queue.qsize()
+        return stats
+
+
+_audit = None
+_audit_lock = threading.Lock()
+
+
+def audit():
+    """
+        按setting配置创建的全局审计日志，未启用时返回None
+    """
+    global _audit
+    if _audit is None:
+        if not getattr(settings, "CMMC_AUDIT_ENABLED", False):
+            return None
+        with _audit_lock:
+            if _audit is None:
+                directory = getattr(settings, "CMMC_AUDIT_DIR", None) or \
+                    os.path.join(tempfile.gettempdir(), "cmmc_audit")
+                writer = RotatingWriter(os.path.join(directory, "cmmc_audit.{0}.log".format(os.getpid())),
+                                        max_bytes=getattr(settings, "CMMC_AUDIT_MAX_BYTES", 64 * 1024 * 1024),
+                                        backup_count=getattr(settings, "CMMC_AUDIT_BACKUP_COUNT", 10))
+                redactor = Redactor(getattr(settings, "CMMC_AUDIT_MASK_FIELDS", ("PASSWORD", "SIGN")))
+                _audit = AuditLog(writer, redactor,
+                                  queue_size=getattr(settings, "CMMC_AUDIT_QUEUE_SIZE", 10000),
+                                  batch_size=getattr(settings, "CMMC_AUDIT_BATCH_SIZE", 500),
+                                  flush_interval=getattr(settings, "CMMC_AUDIT_FLUSH_INTERVAL", 1),
+                                  include_xml=getattr(settings, "CMMC_AUDIT_INCLUDE_XML", False))
+    return _audit
+
+
+def audit_event(event, **fields):
+    """
+        审计日志启用时记录事件
+    """
+    log = audit()
+    if log is not None:
+        log.emit(event, **fields)
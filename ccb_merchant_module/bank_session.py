@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行客户端5W1001登录会话管理
+    BankSessionManager: 登录一次后在TTL内复用会话，会话过期或银行返回登录相关的RETURN_CODE时重新登录
+    @@调用：
+        manager = session_manager()
+        manager.ensure_login(key, login_func)       # login_func执行实际的5W1001请求
+        if manager.is_auth_error(resp_code, resp_msg):
+            manager.invalidate(key)
+    @@setting配置(均可选)：
+        CMMC_SESSION_TTL = 300              # 会话复用时间(秒)，0表示每次业务请求前都登录
+        CMMC_SESSION_SHARED = False         # True时会话状态保存在django cache中，多个worker共用一次登录
+        CMMC_SESSION_CACHE = "default"      # 共享模式使用的cache名称
+        CMMC_SESSION_AUTH_CODES = ()        # 需要重新登录的RETURN_CODE
+"""
+import time
+import logging
+import threading
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# RETURN_MSG中包含以下内容时视为会话失效
+AUTH_ERROR_KEYWORDS = (u"登录", u"登陆", u"会话", u"login", u"session")
+
+
+class BankSessionManager(object):
+    """
+        5W1001登录会话
+    """
+    Prefix = "cmmc:bank_session:"
+
+    def __init__(self, ttl=300, shared=False, cache_alias="default", auth_codes=(), lock_timeout=10):
+        self.ttl = ttl
+        self.shared = shared
+        self.cache_alias = cache_alias
+        self.auth_codes = set(auth_codes)
+        self.lock_timeout = lock_timeout
+        self._expires = {}
+        # {会话标识: Lock}，不同商户/主机的登录互不阻塞
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self._stats = {"logins": 0, "reused": 0, "invalidated": 0}
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.cache_alias]
+
+    def _cache_key(self, key):
+        return self.Prefix + key
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def is_valid(self, key):
+        if self.ttl <= 0:
+            return False
+        if self._expires.get(key, 0) > time.time():
+            return True
+        if self.shared:
+            expires = self.cache.get(self._cache_key(key))
+            if expires and expires > time.time():
+                self._expires[key] = expires
+                return True
+        return False
+
+    def _mark_valid(self, key):
+        expires = time.time() + self.ttl
+        self._expires[key] = expires
+        if self.shared:
+            self.cache.set(self._cache_key(key), expires, self.ttl)
+
+    def _wait_shared_login(self, key):
+        """
+            其他worker正在登录时等待其结果，超时返回False
+        """
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(0.05)
+            if self.is_valid(key):
+                return True
+            if self.cache.get(self._cache_key(key) + ":lock") is None:
+                break
+        return self.is_valid(key)
+
+    def ensure_login(self, key, login_func):
+        """
+            会话有效时直接返回True，否则调用login_func登录
+            :param key: 会话标识，如商户号+操作员号
+            :param login_func: 执行5W1001登录的函数，成功返回True，失败抛出异常
+        """
+        if self.is_valid(key):
+            self._count("reused")
+            return True
+        if self.ttl <= 0:
+            self._count("logins")
+            return login_func()
+        # 同一会话只有一个线程登录，登录和等待其他worker登录时只持有该会话的锁
+        with self._key_lock(key):
+            if self.is_valid(key):
+                self._count("reused")
+                return True
+            lock_key = self._cache_key(key) + ":lock"
+            locked = False
+            if self.shared:
+                locked = self.cache.add(lock_key, 1, self.lock_timeout)
+                if not locked and self._wait_shared_login(key):
+                    self._count("reused")
+                    return True
+            try:
+                result = login_func()
+                self._count("logins")
+                if result:
+                    self._mark_valid(key)
+                return result
+            finally:
+                if locked:
+                    self.cache.delete(lock_key)
+
+    def invalidate(self, key):
+        self._expires.pop(key, None)
+        self._count("invalidated")
+        if self.shared:
+            self.cache.delete(self._cache_key(key))
+
+    def is_auth_error(self, return_code, return_msg=None):
+        """
+            判断银行返回是否为登录/会话相关错误
+        """
+        if return_code == "000000":
+            return False
+        if return_code in self.auth_codes:
+            return True
+        if return_msg:
+            msg = return_msg.lower()
+            for keyword in AUTH_ERROR_KEYWORDS:
+                if keyword in msg:
+                    return True
+        return False
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def session_manager():
+    """
+        按setting配置创建的全局会话管理对象
+    """
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = BankSessionManager(ttl=getattr(settings, "CMMC_SESSION_TTL", 300),
+                                              shared=getattr(settings, "CMMC_SESSION_SHARED", False),
+                                              cache_alias=getattr(settings, "CMMC_SESSION_CACHE", "default"),
+                                              auth_codes=getattr(settings, "CMMC_SESSION_AUTH_CODES", ()))
+    return _manager
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+批量退款(5W1004)
+    BulkRefund: 对一批订单号在有界线程池中执行BankProxy REFUND，每次尝试都写入日志文件(journal)，
+                中断后使用同一journal重新执行时不会重复退款。
+    @@journal：
+        每行一个json，{"order": 订单号, "sn": REQUEST_SN, "event": "start"|"success"|"error", ...}，
+        "start"在发送退款请求前写入并fsync。
+        重新执行时：已"success"的订单跳过；只有"start"没有结果的订单(发送后中断，银行是否已退款不确定)
+        先用QUERY_REFUND向银行确认：退款流水为成功/已退款的记为成功；流水为失败或银行没有退款记录时才再退款；
+        流水待银行确认或查询失败(结果未知)时记为"error"且不退款，避免重复退款；"error"的订单在重试次数内重试。
+    @@调用：
+        summary = BulkRefund(journal_path, concurrency=4, user=user).run(order_codes)
+        python manage.py cmmc_bulk_refund --journal refund.log --file codes.txt
+    @@返回：
+        summary: 总数、成功、失败、跳过、耗时、吞吐量(个/秒)、延迟p50/p95/p99/max(秒)
+"""
+import os
+import json
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.db import close_old_connections
+from utils import REFUND_DONE_STATUSES, REFUND_FAILED_STATUSES, percentile
+
+logger = logging.getLogger(__name__)
+
+# 批量退款使用的系统用户标识
+BULK_REFUND_USER = "cmmc_bulk_refund"
+
+# 向银行确认退款状态的结果
+REFUND_CONFIRMED = "confirmed"
+REFUND_NOT_REFUNDED = "not_refunded"
+REFUND_UNKNOWN = "unknown"
+
+
+class RefundJournal(object):
+    """
+        追加写入的退款日志
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fp = None
+
+    def load(self):
+        """
+            读取已有日志，返回{订单号: {"last": 最后事件, "errors": 失败次数}}
+        """
+        states = {}
+        if not os.path.exists(self.path):
+            return states
+        with open(self.path, "rb") as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 最后一行可能在写入时中断
+                    continue
+                state = states.setdefault(entry["order"], {"last": None, "errors": 0})
+                state["last"] = entry["event"]
+                if entry["event"] == "error":
+                    state["errors"] += 1
+        return states
+
+    def write(self, order_code, event, **fields):
+        entry = {"order": order_code, "event": event, "ts": time.time()}
+        entry.update(fields)
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            if self._fp is None:
+                self._fp = open(self.path, "ab")
+            self._fp.write(line)
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+
+class BulkRefund(object):
+    """
+        批量退款执行器
+    """
+
+    def __init__(self, journal_path, concurrency=4, retries=2, user=BULK_REFUND_USER):
+        self.journal = RefundJournal(journal_path)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.user = user
+
+    @staticmethod
+    def order_codes(orders):
+        """
+            支持订单号列表、Order queryset或values_list queryset
+        """
+        from django.db.models import QuerySet
+        if isinstance(orders, QuerySet) and getattr(orders, "_fields", None) is None:
+            orders = orders.values_list(settings.CMMC_ORDER_CODE_CONF, flat=True)
+        return [code for code in orders if code]
+
+    def load_proxies(self, codes):
+        """
+            一次查询构造全部订单的REFUND代理，不存在的订单对应None
+        """
+        import ccb_merchant_proxy as agents
+        try:
+            proxies = agents.BankProxy.for_orders(codes, action="REFUND", user=self.user)
+        except agents.OrdersNotFoundError as ex:
+            logger.warning(u"[bulk refund]: {0}".format(ex))
+            proxies = ex.proxies
+        code_field = agents.order_code_field()
+        found = dict((getattr(proxy.order, code_field), proxy) for proxy in proxies)
+        return dict((code, found.get(code)) for code in codes)
+
+    def _confirm_refunded(self, proxy):
+        """
+            向银行确认状态不确定的订单是否已经退款
+            :return (REFUND_CONFIRMED 已退款 | REFUND_NOT_REFUNDED 未退款 | REFUND_UNKNOWN 待银行确认或查询失败, 异常)
+        """
+        import ccb_merchant_proxy as agents
+        code = getattr(proxy.order, settings.CMMC_ORDER_CODE_CONF)
+        try:
+            status = str(proxy.bank_query_refund())
+        except agents.RecordNotFoundError:
+            return REFUND_NOT_REFUNDED, None
+        except Exception as ex:
+            logger.debug(u"[bulk refund]: query refund {0} failed: {1}".format(code, ex))
+            return REFUND_UNKNOWN, ex
+        if status in REFUND_DONE_STATUSES:
+            return REFUND_CONFIRMED, None
+        if status in REFUND_FAILED_STATUSES:
+            return REFUND_NOT_REFUNDED, None
+        return REFUND_UNKNOWN, Exception(u"退款待银行确认(状态{0})".format(status))
+
+    def _refund(self, item):
+        import ccb_merchant_proxy as agents
+        code, uncertain, proxy = item
+        try:
+            if proxy is None:
+                ex = agents.OrderError(u"订单号错误")
+                self.journal.write(code, "error", error=u"{0}".format(ex))
+                return code, "failed", 0.0, ex
+            if uncertain:
+                confirmed, error = self._confirm_refunded(proxy)
+                if confirmed == REFUND_CONFIRMED:
+                    self.journal.write(code, "success", confirmed=True)
+                    return code, "skipped", 0.0, None
+                if confirmed == REFUND_UNKNOWN:
+                    # 银行可能已经退款，不能再次发送5W1004
+                    self.journal.write(code, "error", error=u"{0}".format(error), unconfirmed=True)
+                    return code, "failed", 0.0, error
+            start = time.time()
+            sn = proxy.request_sn()
+            self.journal.write(code, "start", sn=sn)
+            try:
+                proxy.bank_refund(sn)
+            except Exception as ex:
+                latency = time.time() - start
+                self.journal.write(code, "error", sn=sn, error=u"{0}".format(ex), latency=latency)
+                return code, "failed", latency, ex
+            latency = time.time() - start
+            self.journal.write(code, "success", sn=sn, latency=latency)
+            return code, "success", latency, None
+        finally:
+            close_old_connections()
+
+    def plan(self, codes):
+        """
+            根据journal确定需要执行的订单，返回([(订单号, 是否需要先确认)], 跳过数)
+        """
+        states = self.journal.load()
+        work, skipped = [], 0
+        for code in codes:
+            state = states.get(code)
+            if state is None:
+                work.append((code, False))
+            elif state["last"] == "success" or state["errors"] > self.retries:
+                skipped += 1
+            else:
+                # "start"表示上次发送后中断；"error"可能是银行已处理但应答失败，均先确认
+                work.append((code, True))
+        return work, skipped
+
+    def run(self, orders, progress=None):
+        """
+            执行批量退款，返回summary
+            :param progress: 可选，每完成一个订单调用progress(code, result, latency, error)
+        """
+        codes = list(dict.fromkeys(self.order_codes(orders)))
+        work, skipped = self.plan(codes)
+        proxies = self.load_proxies([code for code, _ in work])
+        work = [(code, uncertain, proxies[code]) for code, uncertain in work]
+        latencies = []
+        counts = {"success": 0, "failed": 0, "skipped": skipped}
+        started = time.time()
+        pool = ThreadPool(self.concurrency)
+        try:
+            for code, result, latency, error in pool.imap_unordered(self._refund, work):
+                counts[result] += 1
+                if result != "skipped":
+                    latencies.append(latency)
+                if progress:
+                    progress(code, result, latency, error)
+        finally:
+            pool.close()
+            pool.join()
+            self.journal.close()
+        elapsed = time.time() - started
+        latencies.sort()
+        done = counts["success"] + counts["failed"]
+        return {"total": len(codes), "success": counts["success"], "failed": counts["failed"],
+                "skipped": counts["skipped"], "elapsed": elapsed,
+                "throughput": done / elapsed if elapsed > 0 else 0.0,
+                "latency_p50": percentile(latencies, 50), "latency_p95": percentile(latencies, 95),
+                "latency_p99": percentile(latencies, 99), "latency_max": latencies[-1] if latencies else 0.0}
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+通用缓存后端，二维码缓存、查询结果缓存和支付通知共用
+    LocalTTLBackend: 进程内缓存，TTL过期 + LRU淘汰 + 条目数上限，可选按size(value)计算的内存上限
+    DjangoCacheBackend: 使用django cache，多个worker共享，key加上子类的Prefix
+    自定义后端需实现get(key)/set(key, value, ttl)/delete(key)
+    is_local_cache(alias): django cache是否只在本进程内有效，需要多个worker共享的功能在启动时检查
+"""
+import time
+import threading
+from collections import OrderedDict
+
+# 只在本进程内有效的django cache后端
+LOCAL_CACHE_BACKENDS = frozenset(["django.core.cache.backends.locmem.LocMemCache",
+                                  "django.core.cache.backends.dummy.DummyCache"])
+
+
+def cache_backend_path(alias):
+    from django.conf import settings
+    return settings.CACHES.get(alias, {}).get("BACKEND")
+
+
+def is_local_cache(alias):
+    return cache_backend_path(alias) in LOCAL_CACHE_BACKENDS
+
+
+class LocalTTLBackend(object):
+    """
+        进程内LRU缓存
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None):
+        """
+            :param max_bytes: 按size(value)计算的占用上限，None不限制
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def size(self, value):
+        """
+            value占用的字节数，子类按值的结构实现
+        """
+        return 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                self._bytes -= self.size(value)
+                return None
+            # 重新插入到末尾，标记为最近使用
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, ttl):
+        size = self.size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= self.size(old[1])
+            self._data[key] = (time.time() + ttl, value)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or
+                                  (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= self.size(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self._bytes -= self.size(item[1])
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self._bytes}
+
+
+class DjangoCacheBackend(object):
+    """
+        django cache后端
+    """
+    Prefix = "cmmc:"
+
+    def __init__(self, alias="default"):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(self.Prefix + key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(self.Prefix + key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(self.Prefix + key)
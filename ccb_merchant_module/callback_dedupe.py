@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行回调通知的去重
+    建行会重复发送api/open/bank_reply通知，已经验签通过并处理过的(ORDERID, PAYMENT, SIGN)记录在这里，
+    重复的通知直接返回，不再连接验签端口，也不再开启数据库事务。
+    只记录验签通过的通知，伪造的请求SIGN不同，不会命中。
+    @@存储：
+        进程内有界缓存(TTL + LRU) + django cache(多个worker共享)
+    @@setting配置(均可选)：
+        CMMC_CALLBACK_DEDUPE_TTL = 86400            # 记录保留时间(秒)，0表示关闭去重
+        CMMC_CALLBACK_DEDUPE_MAX = 10000            # 进程内最大记录数
+        CMMC_CALLBACK_DEDUPE_CACHE = "default"      # 共享使用的cache名称，None表示只使用进程内缓存
+"""
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from django.conf import settings
+
+
+class CallbackDedupeStore(object):
+    """
+        已验签回调的去重记录
+    """
+    Prefix = "cmmc:callback:"
+
+    def __init__(self, ttl=86400, max_entries=10000, cache_alias="default"):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache_alias = cache_alias
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def make_key(order_id, payment, sign):
+        raw = u"{0}|{1}|{2}".format(order_id, payment, sign).encode("UTF-8")
+        return hashlib.md5(raw).hexdigest()
+
+    def _local_get(self, key):
+        with self._lock:
+            expires = self._local.pop(key, None)
+            if expires is None or expires < time.time():
+                return False
+            self._local[key] = expires
+            return True
+
+    def _local_set(self, key, expires):
+        with self._lock:
+            self._local.pop(key, None)
+            self._local[key] = expires
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def seen(self, order_id, payment, sign):
+        """
+            通知是否已经验签处理过
+        """
+        if self.ttl <= 0 or not sign:
+            return False
+        key = self.make_key(order_id, payment, sign)
+        found = self._local_get(key)
+        if not found and self.cache_alias:
+            expires = self.cache.get(self.Prefix + key)
+            if expires:
+                self._local_set(key, expires)
+                found = True
+        self._stats["hits" if found else "misses"] += 1
+        return found
+
+    def add(self, order_id, payment, sign):
+        """
+            记录验签通过并处理完成的通知
+        """
+        if self.ttl <= 0 or not sign:
+            return
+        key = self.make_key(order_id, payment, sign)
+        expires = time.time() + self.ttl
+        self._local_set(key, expires)
+        if self.cache_alias:
+            self.cache.set(self.Prefix + key, expires, self.ttl)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["entries"] = len(self._local)
+        return stats
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def callback_dedupe_store():
+    """
+        按setting配置创建的全局去重记录
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = CallbackDedupeStore(ttl=getattr(settings, "CMMC_CALLBACK_DEDUPE_TTL", 86400),
+                                             max_entries=getattr(settings, "CMMC_CALLBACK_DEDUPE_MAX", 10000),
+                                             cache_alias=getattr(settings, "CMMC_CALLBACK_DEDUPE_CACHE", "default"))
+    return _store
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行回调的异步处理队列
+    CMMC_CALLBACK_ASYNC开启后，api/open/bank_reply只把回调参数写入本地spool目录并放入队列，立即应答银行；
+    后台验签线程池负责验签，提交线程把验签通过的订单合并为批量的条件UPDATE：
+        UPDATE order SET pay_status=已支付, pay_time=now
+        WHERE order_code IN (...) AND pay_status=未支付 AND del_flag=0
+    @@持久化：
+        每条回调写成一个json文件(先写临时文件再rename，并fsync)，文件名带进程号表示由该进程处理，
+        处理完成(已更新或验签失败)后删除；处理请求的进程在第一个请求时(request_started信号)启动后台线程，
+        由recover()重新载入本进程和已退出进程遗留的文件，不需要等待新的回调；管理命令和gunicorn --preload的
+        master进程不处理请求，不会启动线程或认领文件；多次处理同一回调是安全的(UPDATE带有未支付条件)。
+        fork出的子进程不继承后台线程，首次使用时按进程号重新启动。
+        验签服务或数据库异常时按CMMC_CALLBACK_MAX_ATTEMPTS重试，仍失败的文件移到failed子目录(死信)等待人工处理。
+        回调写入spool后已经应答银行，spool目录必须在重启后保留，不能使用系统临时目录。
+    @@setting配置：
+        CMMC_CALLBACK_ASYNC = False                 # 是否异步处理银行回调
+        CMMC_CALLBACK_SPOOL_DIR = None              # spool目录，CMMC_CALLBACK_ASYNC开启时必须配置(持久化的本地目录)
+        CMMC_CALLBACK_WORKERS = 4                   # 验签线程数
+        CMMC_CALLBACK_BATCH_SIZE = 50               # 每批UPDATE的最大订单数
+        CMMC_CALLBACK_FLUSH_INTERVAL = 0.5          # 批量提交的最长等待时间(秒)
+        CMMC_CALLBACK_MAX_ATTEMPTS = 5              # 验签或提交异常时的最大尝试次数
+"""
+import os
+import json
+import time
+import uuid
+import errno
+import Queue
+import logging
+import datetime
+import threading
+from django.conf import settings
+from django.db import transaction, close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+
+class CallbackSpool(object):
+    """
+        本地spool目录，一条回调一个文件：<id>.json.<pid>
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.failed_directory = os.path.join(directory, "failed")
+        for path in (self.directory, self.failed_directory):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as ex:
+                    if ex.errno != errno.EEXIST:
+                        raise
+
+    def write(self, params):
+        """
+            持久化一条回调，返回文件路径
+        """
+        name = "{0}-{1}.json".format(int(time.time() * 1000), uuid.uuid4().hex)
+        tmp_path = os.path.join(self.directory, name + ".tmp")
+        path = os.path.join(self.directory, "{0}.{1}".format(name, os.getpid()))
+        with open(tmp_path, "wb") as fp:
+            fp.write(json.dumps(params))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_path, path)
+        return path
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def move_failed(self, path):
+        try:
+            os.rename(path, os.path.join(self.failed_directory, os.path.basename(path)))
+        except OSError:
+            pass
+
+    def recover(self):
+        """
+            认领本进程以外已退出进程遗留的文件，返回[(path, params)]
+        """
+        pid = os.getpid()
+        items = []
+        for name in sorted(os.listdir(self.directory)):
+            base, _, owner = name.rpartition(".")
+            if not base.endswith(".json") or not owner.isdigit():
+                continue
+            owner = int(owner)
+            if owner != pid and pid_alive(owner):
+                continue
+            path = os.path.join(self.directory, name)
+            claimed = os.path.join(self.directory, "{0}.{1}".format(base, pid))
+            try:
+                if claimed != path:
+                    os.rename(path, claimed)
+                with open(claimed, "rb") as fp:
+                    items.append((claimed, json.loads(fp.read())))
+            except (OSError, IOError, ValueError):
+                logger.error(u"[callback spool]: recover {0} failed".format(name))
+        return items
+
+
+class CallbackQueue(object):
+    """
+        回调处理队列：验签线程池 + 批量提交线程
+    """
+
+    def __init__(self, spool, workers=4, batch_size=50, flush_interval=0.5, max_attempts=5):
+        self.spool = spool
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._queue = Queue.Queue()
+        self._verified = Queue.Queue()
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {"enqueued": 0, "verified": 0, "rejected": 0, "retried": 0, "failed": 0,
+                       "updated": 0, "batches": 0}
+
+    def start(self):
+        """
+            启动后台线程并重新载入spool中遗留的回调，每个进程只执行一次
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # fork出的子进程：父进程的线程和队列中的回调不属于本进程
+                self._queue = Queue.Queue()
+                self._verified = Queue.Queue()
+                self._threads = []
+            self._pid = os.getpid()
+            for index in range(self.workers):
+                self._spawn(self._verify_loop, "cmmc-callback-verify-{0}".format(index))
+            self._spawn(self._commit_loop, "cmmc-callback-commit")
+        self.recover()
+
+    def recover(self):
+        """
+            重新载入本进程和已退出进程遗留的spool文件，返回载入的回调数
+        """
+        items = self.spool.recover()
+        for item in items:
+            self._queue.put(item + (0,))
+        if items:
+            logger.info(u"[callback queue]: recovered %s callbacks", len(items))
+        return len(items)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def _spawn(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def enqueue(self, params):
+        """
+            持久化并入队，写入spool后即可应答银行
+        """
+        self.start()
+        path = self.spool.write(params)
+        self._count("enqueued")
+        self._queue.put((path, params, 0))
+
+    def _verify_loop(self):
+        import ccb_merchant_proxy as agents
+        while True:
+            path, params, attempts = self._queue.get()
+            try:
+                verified = agents.verify_callback(params)
+            except Exception as ex:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    self._count("failed")
+                    logger.error(u"[callback queue]: verify {0} failed: {1}".format(params.get("ORDERID"), ex))
+                    self.spool.move_failed(path)
+                else:
+                    self._count("retried")
+                    time.sleep(min(2 ** attempts * 0.1, 5))
+                    self._queue.put((path, params, attempts))
+                continue
+            if verified:
+                self._count("verified")
+                self._verified.put((path, params, 0))
+            else:
+                self._count("rejected")
+                self.spool.remove(path)
+
+    def _commit_loop(self):
+        while True:
+            batch = [self._verified.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._verified.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+            try:
+                self.commit(batch)
+            except Exception as ex:
+                # 数据库异常时保留spool文件重新提交，超过最大尝试次数的移到failed子目录
+                logger.error(u"[callback queue]: commit failed: {0}".format(ex))
+                retry = 0
+                for path, params, attempts in batch:
+                    attempts += 1
+                    if attempts >= self.max_attempts:
+                        self._count("failed")
+                        self.spool.move_failed(path)
+                    else:
+                        retry = max(retry, attempts)
+                        self._verified.put((path, params, attempts))
+                if retry:
+                    self._count("retried")
+                    time.sleep(min(2 ** retry, 30))
+            finally:
+                close_old_connections()
+
+    def commit(self, batch):
+        """
+            批量条件UPDATE，完成后删除spool文件并记录去重
+        """
+        import ccb_merchant_proxy as agents
+        codes = list(set(params["ORDERID"] for _, params, _ in batch))
+        with transaction.atomic():
+            updated = agents.mark_orders_paid(codes)
+        self._count("updated", updated)
+        self._count("batches")
+        dedupe_store = agents.callback_dedupe_store()
+        for path, params, _ in batch:
+            dedupe_store.add(params["ORDERID"], params["PAYMENT"], params["SIGN"])
+            self.spool.remove(path)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({"pending": self._queue.qsize(), "verified_pending": self._verified.qsize()})
+        return stats
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def callback_queue():
+    """
+        按setting配置创建的全局回调队列
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                directory = getattr(settings, "CMMC_CALLBACK_SPOOL_DIR", None)
+                if not directory:
+                    raise Exception(u"请配置持久化的回调spool目录-CMMC_CALLBACK_SPOOL_DIR")
+                _queue = CallbackQueue(CallbackSpool(directory),
+                                       workers=getattr(settings, "CMMC_CALLBACK_WORKERS", 4),
+                                       batch_size=getattr(settings, "CMMC_CALLBACK_BATCH_SIZE", 50),
+                                       flush_interval=getattr(settings, "CMMC_CALLBACK_FLUSH_INTERVAL", 0.5),
+                                       max_attempts=getattr(settings, "CMMC_CALLBACK_MAX_ATTEMPTS", 5))
+    return _queue
+
+
+def start_callback_queue(**kwargs):
+    """
+        request_started信号处理，处理请求的进程在第一个请求时启动回调队列
+    """
+    callback_queue().start()
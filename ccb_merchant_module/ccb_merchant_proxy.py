@@ -7,6 +7,7 @@ BnakProxy: 建设银行业务的代理类
     @@调用：
         action_obj = BankProxy(order_code=order_code, action="PAY", user=user)
         result_str = action_obj.proxy_bank()
+        多商户时传入merchant_id(见merchants)，默认使用BANK_*配置的商户
     @@关键参数与返回值：
         1、action = 'PAY'
             功能： 调用建设银行的聚合二维码，返回二维码图像数据
@@ -25,52 +26,97 @@ BnakProxy: 建设银行业务的代理类
 
         4、action = 'QUERY_REFUND' （支持查询）
             功能： 调用建设银行的客户端服务，返回订单的退款结果
-            result_str： 成功， 返回银行的订单状态信息，ORDER_STATUS_SUCCESS[0] or ORDER_STATUS_REFUND[0]
+            result_str： 成功， 返回银行的退款流水状态，含义见utils.REFUND_DONE_STATUSES/REFUND_FAILED_STATUSES
+                         没有退款记录， 抛出RecordNotFoundError
                          失败， 抛出异常信息
 
+    @@批量构造：
+        proxies = BankProxy.for_orders(order_codes, action="QUERY_PAY", user=user)
+        一次查询加载全部订单(只加载主键、订单号、金额、支付状态字段)，按order_codes的顺序返回代理列表；
+        有订单不存在时抛出OrdersNotFoundError，ex.missing为全部不存在的订单号，ex.proxies为已找到订单的代理
+
+    @@批量查询：
+        for record in BankProxy.query_range(start, end, kind="PAY", user=user):
+            ...
+        按时间段分页查询支付(kind="PAY", 5W1002)或退款(kind="REFUND", 5W1003)流水，逐条返回银行记录BankRecord
+
 open_bank_reply：银行回调函数的实现方法
 
 """
 from django.db import transaction
 from django.conf import settings
-from importlib import import_module
+from django.utils.functional import SimpleLazyObject
 from utils import *
+from apps import order_model, order_config
+
+# 订单模型在首次使用时解析，配置在AppConfig.ready中校验
+Order = SimpleLazyObject(order_model)
 
-if not settings.CMMC_ORDER_MODELS_CONF:
-    raise ImportError(u"客户端关联订单模块找不到.")
-if not settings.CMMC_ORDER_NAME:
-    raise Exception(u"请正确配置订单名-CMMC_ORDER_NAME.")
-
-order_module = import_module(settings.CMMC_ORDER_MODELS_CONF)
-Order = getattr(order_module, settings.CMMC_ORDER_NAME, None)
-if not Order:
-    raise Exception(u"订单配置错误")
-
-# 检查Order的字段是否配置正确
-if not getattr(Order, settings.CMMC_ORDER_PAY_AMOUNT, None):
-    raise Exception(u"订单付款金额字段配置错误")
-if not getattr(Order, settings.CMMC_ORDER_PAY_STATUS, None):
-    raise Exception(u"订单付款状态字段配置错误")
-if not getattr(Order, settings.CMMC_ORDER_PAY_TIME, None):
-    raise Exception(u"订单付款时间字段配置错误")
-if settings.CMMC_ORDER_CODE_CONF:
-    if not getattr(Order, settings.CMMC_ORDER_CODE_CONF, None):
-        raise Exception(u"订单号字段配置错误")
-
-import requests
+import sys
 import hashlib
 import logging
 import json
 import urllib
 import StringIO
-import qrcode
-import traceback
 import xml.etree.ElementTree as ET
-from lxml import etree
-import socket
 import datetime
+import time
+from tcp_pool import TcpProxy
+from merchants import merchant_registry, MerchantError
+from query_cache import memoize_query, invalidate_query
+from audit import audit, audit_event
+from bank_session import session_manager
+from qrcode_cache import qrcode_cache
+from payment_notifier import payment_notifier
+from xml_template import LOGIN_TEMPLATE, QUERY_PAY_TEMPLATE, QUERY_REFUND_TEMPLATE, REFUND_TEMPLATE
+from xml_parser import BankReply, parse_header, parse_reply, iter_records
+from callback_dedupe import callback_dedupe_store
+from callback_queue import callback_queue
+from request_sn import RequestSnError, request_sn_allocator
+from metrics import metrics, classify_error, TX_QRCODE, TX_VERIFY
+from resilience import CircuitOpenError, DeadlineExceeded, deadline, bank_deadline, with_deadline
 logger = logging.getLogger(__name__)
 
+# 银行回调参数
+CALLBACK_FIELDS = ("POSID", "BRANCHID", "ORDERID", "PAYMENT", "CURCODE", "REMARK1", "REMARK2", "ACC_TYPE",
+                   "SUCCESS", "SIGN")
+
+
+# 批量加载订单时每次查询的订单号数量
+ORDER_BATCH_SIZE = 500
+
+
+def order_code_field():
+    return order_config().code or "order_code"
+
+
+def order_queryset():
+    """
+        BankProxy使用的订单查询：未删除的订单，只加载主键、订单号、金额和支付状态字段
+    """
+    conf = order_config()
+    fields = set(field for field in (order_code_field(), conf.amount, conf.pay_status) if field)
+    return Order.objects.filter(**{conf.del_flag or "del_flag": FLAG_NO}).only(*fields)
+
+
+def qrcode_generate(qrcode_url_str):
+    """
+        生成聚合二维码PNG数据(模块级函数，可以在进程池中执行)
+    """
+    import qrcode
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(qrcode_url_str)
+    qr.make(fit=True)
+    img = qr.make_image()
+    string_io = StringIO.StringIO()
+    img.save(string_io, "PNG")
+    return string_io.getvalue()
+
 
 class AuthError(Exception):
     """
@@ -93,6 +139,18 @@ class OrderError(Exception):
     pass
 
 
+class OrdersNotFoundError(OrderError):
+    """
+        批量构造时部分订单不存在
+    """
+
+    def __init__(self, missing, proxies):
+        super(OrdersNotFoundError, self).__init__(
+            u"订单号错误: {0}".format(u", ".join(u"{0}".format(code) for code in missing)))
+        self.missing = missing
+        self.proxies = proxies
+
+
 class QRCodeError(Exception):
     """
         生产二维码错误
@@ -107,30 +165,11 @@ class OrderPayError(Exception):
     pass
 
 
-class TcpProxy(object):
+class RecordNotFoundError(Exception):
     """
-        socket connection to bank tools
+        银行没有该订单的流水记录
     """
-    def __init__(self, sock=None):
-        if sock is None:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        else:
-            self.sock = sock
-
-    def connect(self, host, port):
-        self.sock.connect((host, port))
-
-    def send_data(self, data):
-        self.sock.sendall(data)
-
-    def receive_data(self):
-        chunks = ""
-        chunk = self.sock.recv(2048)
-        while chunk:
-            chunks += chunk
-            chunk = self.sock.recv(2048)
-        self.sock.close()
-        return chunks
+    pass
 
 
 class BankProxy(object):
@@ -141,50 +180,117 @@ class BankProxy(object):
     Action = ["REFUND", "QUERY_PAY", "QUERY_REFUND", "PAY"]
     Prompt = "Bank proxy module"
 
-    def __init__(self, order_code=None, action=None, user=None):
-        if not user:
-            raise AuthError(u"需要用户权限")
+    def __init__(self, order_code=None, action=None, user=None, merchant_id=None):
+        self.check_request(action, user)
         self.user = user
-        if action not in self.Action:
-            raise ActionError(u"动作命令错误")
         self.action = action
         if not order_code:
             raise OrderError(u"订单号错误")
         try:
-            if settings.CMMC_ORDER_CODE_CONF:
-                self.order = Order.objects.get(**{settings.CMMC_ORDER_CODE_CONF: order_code,
-                                                  settings.CMMC_ORDER_DEL_FLAG: FLAG_NO})
-            else:
-                self.order = Order.objects.get(del_flag=FLAG_NO, order_code=order_code)
+            self.order = order_queryset().get(**{order_code_field(): order_code})
         except:
             raise OrderError(u"订单号错误")
-        self.merchant_id = settings.BANK_MERCHANT_ID
-        self.pos_id = settings.BANK_POS_ID
-        self.user_id = settings.BANK_USER_ID
-        self.branch_id = settings.BANK_BRANCH_ID
-        self.user_password = settings.BANK_USER_PASSWORD
-        self.public_key = settings.BANK_PUBLIC_KEY
+        self.init_merchant(merchant_id)
+
+    @classmethod
+    def check_request(cls, action, user):
+        if not user:
+            raise AuthError(u"需要用户权限")
+        if action not in cls.Action:
+            raise ActionError(u"动作命令错误")
+
+    @classmethod
+    def for_order(cls, order, action, user, merchant_id=None):
+        """
+            使用已加载的订单构造代理，不再查询数据库
+        """
+        proxy = cls.__new__(cls)
+        proxy.user = user
+        proxy.action = action
+        proxy.order = order
+        proxy.init_merchant(merchant_id)
+        return proxy
+
+    @classmethod
+    def for_orders(cls, order_codes, action=None, user=None, merchant_id=None):
+        """
+            批量构造代理，所有订单在一次查询中加载
+            :param order_codes: 订单号列表
+            :return list, 按order_codes顺序(去重)的BankProxy；有订单不存在时抛出OrdersNotFoundError
+        """
+        cls.check_request(action, user)
+        codes = []
+        seen = set()
+        for code in order_codes:
+            if not code:
+                raise OrderError(u"订单号错误")
+            if code not in seen:
+                seen.add(code)
+                codes.append(code)
+        code_field = order_code_field()
+        orders = {}
+        # 分批查询，避免IN参数超过数据库限制(如sqlite的999个)
+        for index in range(0, len(codes), ORDER_BATCH_SIZE):
+            for order in order_queryset().filter(**{code_field + "__in": codes[index:index + ORDER_BATCH_SIZE]}):
+                orders[getattr(order, code_field)] = order
+        proxies = [cls.for_order(orders[code], action, user, merchant_id) for code in codes if code in orders]
+        missing = [code for code in codes if code not in orders]
+        if missing:
+            raise OrdersNotFoundError(missing, proxies)
+        return proxies
+
+    def init_merchant(self, merchant_id=None):
+        """
+            读取商户配置信息
+        """
+        merchant = merchant_registry().get(merchant_id)
+        self.merchant = merchant
+        self.merchant_id = merchant.merchant_id
+        self.pos_id = merchant.pos_id
+        self.user_id = merchant.user_id
+        self.branch_id = merchant.branch_id
+        self.user_password = merchant.user_password
+        self.public_key = merchant.public_key
         self.cash_code = '01'
-        self.proxy_url = settings.BANK_PROXY_URL
+        self.proxy_url = merchant.proxy_url
+        # 本次交易选定的银行客户端连接池
+        self._tools = None
+
+    def tools(self):
+        """
+            本次交易使用的银行客户端连接池，首次调用时按最少在途请求选择，登录和业务请求使用同一主机
+        """
+        if self._tools is None:
+            self._tools = self.merchant.tools_router.choose()
+        return self._tools
+
+    @property
+    def session_key(self):
+        pool = self.tools()
+        return u"{0}:{1}@{2}:{3}".format(self.merchant_id, self.user_id, pool.host, pool.port)
 
     @staticmethod
-    def proxy_connection(url, method="POST", content_type=None, data=None):
+    def proxy_connection(url, method="POST", content_type=None, data=None, tx_code=TX_QRCODE):
         """
             静态函数，请求建行url地址并返回结果
             :param url : 建行url地址
             :param method: 请求动作
             :param content_type: "text/xml", 传送xml
             :param data: 传送内容，
+            :param tx_code: 统计使用的交易码
         """
+        import requests
+        from http_session import http_request
         headers = {"Content_type": content_type} if content_type else None
+        start = time.time()
         try:
             if method != "POST":
-                re = requests.get(url, params=data)
+                re = http_request("GET", url, params=data)
             else:
                 if headers:
-                    re = requests.post(url, data=data, headers=headers)
+                    re = http_request("POST", url, data=data, headers=headers)
                 else:
-                    re = requests.post(url, data=data)
+                    re = http_request("POST", url, data=data)
             if re.status_code == requests.codes.ok:
                 # fixme 可能返回的结果编码不一致
                 return re.text
@@ -192,10 +298,12 @@ class BankProxy(object):
                 raise re.raise_for_status()
         except:
             raise
+        finally:
+            metrics().observe(tx_code, "http", time.time() - start)
 
-    def pay_qrcode(self):
+    def pay_mac(self):
         """
-            生成集合二维码，否则抛出异常
+            PAY请求的MAC
         """
         def md5_generate(byte_str):
             """
@@ -208,55 +316,87 @@ class BankProxy(object):
             md5_obj.update(byte_str)
             return md5_obj.hexdigest()
 
-        def qrcode_generate(qrcode_url_str):
-            """
-                生成聚合二维码数据
-            """
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(qrcode_url_str)
-            qr.make(fit=True)
-            img = qr.make_image()
-            string_io = StringIO.StringIO()
-            img.save(string_io, "PNG")
-            return string_io.getvalue()
-
         raw_str_list = ["MERCHANTID=" + self.merchant_id, "POSID=" + self.pos_id, "BRANCHID=" + self.branch_id,
                         "ORDERID=" + getattr(self.order, settings.CMMC_ORDER_CODE_CONF),
                         "PAYMENT=" + getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT),
                         "CURCODE=" + self.cash_code, "TXCODE=" + "530550", "REMARK1=" + "", "REMARK2=" + "",
                         "RETURNTYPE=" + str(3), "TIMEOUT=" + "", "PUB=" + self.public_key[-30:]]
         raw_str = "&".join(raw_str_list).encode("UTF-8")
-        mac_hash = md5_generate(raw_str)
+        return md5_generate(raw_str)
+
+    def qrcode_cache_key(self, mac_hash=None):
+        """
+            二维码缓存key，未启用缓存时返回None
+        """
+        cache = qrcode_cache()
+        if cache is None:
+            return None
+        return cache.make_key(getattr(self.order, settings.CMMC_ORDER_CODE_CONF),
+                              getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT), mac_hash or self.pay_mac())
+
+    @with_deadline
+    def pay_qrcode_url(self, mac_hash=None):
+        """
+            请求建行网关，返回聚合二维码内容(QRURL)，否则抛出异常
+        """
         query_params = {"CCB_IBSVersion": "V6",
                         "MERCHANTID": self.merchant_id, "POSID": self.pos_id, "BRANCHID": self.branch_id,
                         "ORDERID": getattr(self.order, settings.CMMC_ORDER_CODE_CONF),
                         "PAYMENT": getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT), "CURCODE": self.cash_code,
                         "REMARK1": "", "REMARK2": "", "TXCODE": "530550", "RETURNTYPE": 3, "TIMEOUT": "",
-                        "MAC": mac_hash}
-        qrcode_url = "https://ibsbjstar.ccb.com.cn/CCBIS/ccbMain"
-        response_1 = self.proxy_connection(qrcode_url, method="POST", data=query_params)
-        response_json_1 = json.loads(response_1)
+                        "MAC": mac_hash or self.pay_mac()}
+        qrcode_url = getattr(settings, "CMMC_QRCODE_GATEWAY_URL", "https://ibsbjstar.ccb.com.cn/CCBIS/ccbMain")
+        stats = metrics()
+        start = time.time()
+        try:
+            response_1 = self.proxy_connection(qrcode_url, method="POST", data=query_params)
+            response_json_1 = json.loads(response_1)
+            response_json_2 = None
+            if response_json_1["SUCCESS"] == "true" and not response_json_1.get("ERRCODE", ""):
+                response_2 = self.proxy_connection(response_json_1['PAYURL'], method="GET")
+                response_json_2 = json.loads(response_2)
+        except Exception as ex:
+            stats.count(TX_QRCODE, classify_error(ex))
+            raise
+        stats.observe(TX_QRCODE, "total", time.time() - start)
+        last_json = response_json_2 or response_json_1
+        stats.count(TX_QRCODE, last_json.get("ERRCODE") or ("000000" if last_json["SUCCESS"] == "true" else "failed"))
         if response_json_1["SUCCESS"] == "true":
             if response_json_1.get("ERRCODE", ""):
                 raise QRCodeError(u"{0}: {1}".format(response_json_1['ERRCODE']), response_json_1.get("ERRMSG"))
-            response_2 = self.proxy_connection(response_json_1['PAYURL'], method="GET")
-            response_json_2 = json.loads(response_2)
             if response_json_2["SUCCESS"] == "true":
                 if response_json_2.get("ERRCODE", ""):
                     raise QRCodeError(u"{0}: {1}".format(response_json_2['ERRCODE']), response_json_2.get("ERRMSG"))
-                qrcode_str = urllib.unquote(response_json_2['QRURL'])
-                # 生成付款吗
-                return qrcode_generate(qrcode_str)
+                return urllib.unquote(response_json_2['QRURL'])
             else:
                 raise QRCodeError(u"二维码生成错误")
         else:
             raise QRCodeError(u"二维码生成错误")
 
+    @with_deadline
+    def pay_qrcode(self):
+        """
+            生成集合二维码，否则抛出异常
+        """
+        mac_hash = self.pay_mac()
+        cache = qrcode_cache()
+        cache_key = self.qrcode_cache_key(mac_hash)
+        if cache_key:
+            cached = cache.get(cache_key)
+            if cached:
+                if cached.get("png"):
+                    return cached["png"]
+                if cached.get("qrurl"):
+                    qrcode_png = qrcode_generate(cached["qrurl"])
+                    cache.set(cache_key, qrurl=cached["qrurl"], png=qrcode_png)
+                    return qrcode_png
+        qrcode_str = self.pay_qrcode_url(mac_hash)
+        # 生成付款吗
+        qrcode_png = qrcode_generate(qrcode_str)
+        if cache_key:
+            cache.set(cache_key, qrurl=qrcode_str, png=qrcode_png)
+        return qrcode_png
+
     @staticmethod
     def xml_generate(encoding='utf-8', xml_declaration=None, standalone=None, data={}):
         """
@@ -268,6 +408,7 @@ class BankProxy(object):
                 @ data: two level data info to create xml
         :return @ xml_string: the string reprents xml using encoding encoded.
         """
+        from lxml import etree
         data_keys = data.keys()
         if len(data_keys) != 1:
             raise Exception(u"数据信息错误")
@@ -293,163 +434,269 @@ class BankProxy(object):
             lxml etree decode xml string using the xml declaration encoding format
             ：return [T|F]
         """
-        root = etree.fromstring(xml_string).getroottree()
-        return_code = root.find("RETURN_CODE").text
-        return_msg = root.find("RETURN_MSG").text
-        return return_code, return_msg
+        reply = parse_header(xml_string)
+        return reply.return_code, reply.return_msg
 
-    def bank_proxy_connection(self, sn=1):
+    def tx_template(self, template):
         """
-            银行连接操作
+            固化了商户号、操作员和密码的TX请求模板
+        """
+        return template.bind(CUST_ID=self.merchant_id, USER_ID=self.user_id, PASSWORD=self.user_password)
+
+    def bank_tools_request(self, data, tx_code="tcp"):
+        """
+            通过本次交易选定主机的连接池向银行客户端发送xml请求，返回应答xml
+        """
+        return self.tools().request(data, label=tx_code)
+
+    @staticmethod
+    def request_sn():
+        """
+            分配新的请求流水号
+        """
+        return request_sn_allocator().allocate()
+
+    @staticmethod
+    def check_request_sn(reply, sn):
+        """
+            应答的REQUEST_SN必须与请求一致
         """
+        if reply.request_sn is not None and reply.request_sn != str(sn):
+            raise RequestSnError(u"应答流水号{0}与请求流水号{1}不一致".format(reply.request_sn, sn))
 
-        def create_xml(request_sn=sn):
-            """生成有顺序的xml格式"""
-            tx_root = etree.Element("TX")
-            etree.SubElement(tx_root, "REQUEST_SN").text = str(request_sn)
-            etree.SubElement(tx_root, "CUST_ID").text = self.merchant_id
-            etree.SubElement(tx_root, "USER_ID").text = self.user_id
-            etree.SubElement(tx_root, "PASSWORD").text = self.user_password
-            etree.SubElement(tx_root, "TX_CODE").text = "5W1001"
-            etree.SubElement(tx_root, "LANGUAGE").text = "CN"
-            tx_info = etree.SubElement(tx_root, "TX_INFO")
-            etree.SubElement(tx_info, "REM1").text = ""
-            etree.SubElement(tx_info, "REM2").text = ""
-            return etree.tostring(tx_root, xml_declaration=True, encoding="GB2312", standalone=True)
+    def bank_proxy_connection(self, sn=None):
+        """
+            银行连接操作
+        """
 
         try:
-            # fixme the dict key is arbitrary to output
-            # connection_xml = self.xml_generate(encoding="GB2312", xml_declaration=True, standalone=True, data=data)
-            connection_xml = create_xml(sn)
-            sock_connect = TcpProxy()
-            sock_connect.connect(settings.BANK_TOOLS_HOST, settings.BANK_TOOLS_PORT)
-            sock_connect.send_data(connection_xml)
-            connection_resp = sock_connect.receive_data()
+            sn = sn or self.request_sn()
+            connection_xml = self.tx_template(LOGIN_TEMPLATE).render(REQUEST_SN=sn)
             # connection_resp = self.proxy_connection(self.proxy_url, method="POST", content_type="text/xml",
             #                                         data=connection_xml)
-            resp_code, resp_msg = self.xml_parse_return_code(connection_resp)
+            start = time.time()
+            try:
+                connection_resp, reply = self.bank_tx_exchange(connection_xml, sn, LOGIN_TEMPLATE.tx_code)
+            except Exception as ex:
+                metrics().count(LOGIN_TEMPLATE.tx_code, classify_error(ex))
+                raise
+            metrics().observe(LOGIN_TEMPLATE.tx_code, "total", time.time() - start)
+            metrics().count(LOGIN_TEMPLATE.tx_code, reply.return_code)
+            resp_code, resp_msg = reply.return_code, reply.return_msg
             if resp_code != "000000":
                 raise Exception(u"{0}".format(resp_msg))
             else:
                 return True
         except Exception as ex:
-            error_info = traceback.format_exc()
-            logger.error(u"[{0}: fatal error-{1}-[trace infos -{2}]]".format(self.Prompt, ex.message, error_info))
-            raise ex
+            if audit() is not None:
+                # traceback在审计日志的后台线程中格式化
+                logger.error(u"[%s: fatal error-%s]", self.Prompt, ex)
+                audit_event("error", where="bank_proxy_connection", message=u"{0}".format(ex),
+                            exc_info=sys.exc_info())
+            else:
+                logger.error(u"[%s: fatal error-%s]", self.Prompt, ex, exc_info=True)
+            raise
+
+    def bank_login(self, sn=None):
+        """
+            银行登录会话，会话有效时直接复用，否则执行5W1001登录(使用单独的流水号)
+        """
+        return session_manager().ensure_login(self.session_key, lambda: self.bank_proxy_connection(sn))
 
+    def bank_tx_exchange(self, xml_string, sn, tx_code):
+        """
+            发送一次请求并解析应答头，应答流水号与请求不一致时抛出RequestSnError
+            :return (应答xml, BankReply)
+        """
+        start = time.time()
+        resp = None
+        try:
+            resp = self.bank_tools_request(xml_string, tx_code)
+            with metrics().timer(tx_code, "parse"):
+                reply = parse_header(resp)
+            self.check_request_sn(reply, sn)
+        except Exception as ex:
+            self.audit_tx(tx_code, sn, start, xml_string, resp, error=ex)
+            raise
+        self.audit_tx(tx_code, sn, start, xml_string, resp, reply.return_code)
+        return resp, reply
+
+    def audit_tx(self, tx_code, sn, start, request, response, return_code=None, error=None):
+        """
+            记录交易审计事件(只入队，脱敏和写文件在后台线程)
+        """
+        log = audit()
+        if log is None:
+            return
+        fields = {"tx_code": tx_code, "sn": sn, "merchant": self.merchant_id, "elapsed": time.time() - start,
+                  "return_code": return_code, "error": classify_error(error) if error is not None else None,
+                  "order": getattr(self.order, settings.CMMC_ORDER_CODE_CONF) if self.order is not None else None,
+                  "endpoint": u"{0}:{1}".format(self._tools.host, self._tools.port) if self._tools else None}
+        if log.include_xml:
+            fields.update(request=request, response=response)
+        log.emit("tx", **fields)
+
+    def bank_tx_request(self, xml_string, sn, tx_code="tcp"):
+        """
+            发送业务请求并解析返回码，银行返回登录相关错误时重新登录并重发一次，
+            按tx_code记录耗时和RETURN_CODE(或异常分类)
+            :return (应答xml, RETURN_CODE, RETURN_MSG)
+        """
+        stats = metrics()
+        start = time.time()
+        try:
+            resp, reply = self.bank_tx_exchange(xml_string, sn, tx_code)
+            manager = session_manager()
+            if manager.is_auth_error(reply.return_code, reply.return_msg):
+                logger.info(u"[{0}: bank session expired-{1}-{2}]".format(self.Prompt, reply.return_code,
+                                                                           reply.return_msg))
+                stats.count(tx_code, reply.return_code)
+                manager.invalidate(self.session_key)
+                self.bank_login()
+                resp, reply = self.bank_tx_exchange(xml_string, sn, tx_code)
+        except Exception as ex:
+            stats.count(tx_code, classify_error(ex))
+            raise
+        stats.observe(tx_code, "total", time.time() - start)
+        stats.count(tx_code, reply.return_code)
+        return resp, reply.return_code, reply.return_msg
+
+    @staticmethod
+    def parse_record(resp, tx_code):
+        """
+            解析应答中的第一条记录
+        """
+        with metrics().timer(tx_code, "parse"):
+            return parse_reply(resp).record
+
+    @memoize_query("QUERY_PAY")
+    @with_deadline
     def bank_query_pay(self):
-        sn = self.order.id
-        data = {"TX": {"REQUEST_SN": sn, "CUST_ID": self.merchant_id, "USER_ID": self.user_id,
-                       "PASSWORD": self.user_password, "TX_CODE": "5W1002", "LANGUAGE": "CN",
-                       "TX_INFO": {"START": "", "STARTHOUR": "", "STARTMIN": "",
-                                   "END": "", "ENDHOUR": "", "ENDMIN": "",
-                                   "KIND": "0", "ORDER": getattr(self.order, settings.CMMC_ORDER_CODE_CONF),
-                                   "ACCOUNT": "", "DEXCEL": "1", "MONEY": "",
-                                   "NORDERBY": "2", "PAGE": "", "POS_CODE": self.pos_id,
-                                   "STATUS": "3"}
-                       }
-                }
-        if self.bank_proxy_connection(sn):
-            xml_query_pay = self.xml_generate(encoding="GB2312", xml_declaration=True, standalone=True, data=data)
+        sn = self.request_sn()
+        if self.bank_login():
+            xml_query_pay = self.tx_template(QUERY_PAY_TEMPLATE).render(
+                REQUEST_SN=sn, KIND="0", ORDER=getattr(self.order, settings.CMMC_ORDER_CODE_CONF), DEXCEL="1",
+                NORDERBY="2", POS_CODE=self.pos_id, STATUS="3")
             # resp_query = self.proxy_connection(self.proxy_url, "POST", "text/xml", xml_query_pay)
-            socket_connect = TcpProxy()
-            socket_connect.connect(settings.BANK_TOOLS_HOST, settings.BANK_TOOLS_PORT)
-            socket_connect.send_data(xml_query_pay)
-            resp_query = socket_connect.receive_data()
-            resp_code, resp_msg = self.xml_parse_return_code(resp_query)
+            resp_query, resp_code, resp_msg = self.bank_tx_request(xml_query_pay, sn, QUERY_PAY_TEMPLATE.tx_code)
             if resp_code != "000000":
                 raise OrderPayError(u"{0}".format(resp_msg))
             else:
-                root = etree.fromstring(resp_query).getroottree()
-                query_order = root.xpath("//ORDER")[0].text
-                query_amount = root.xpath("//PAYMENT_MONEY")[0].text
-                query_status = root.xpath("//ORDER_STATUS")[0].text
-                if query_order != getattr(self.order, settings.CMMC_ORDER_CODE_CONF) or \
-                        float(query_amount) != getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT):
+                record = self.parse_record(resp_query, QUERY_PAY_TEMPLATE.tx_code)
+                if record is None or record.order != getattr(self.order, settings.CMMC_ORDER_CODE_CONF) or \
+                        record.payment_money != getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT):
                     raise Exception(u"账单号/支付金额不匹配")
                 else:
-                    return query_status
+                    return record.status
         else:
             raise Exception(u"bank connection error")
 
+    @memoize_query("QUERY_REFUND")
+    @with_deadline
     def bank_query_refund(self):
-        sn = self.order.id
-        data = {"TX": {"REQUEST_SN": sn, "CUST_ID": self.merchant_id, "USER_ID": self.user_id,
-                       "PASSWORD": self.user_password, "TX_CODE": "5W1003", "LANGUAGE": "CN",
-                       "TX_INFO": {"START": "", "STARTHOUR": "", "STARTMIN": "",
-                                   "END": "", "ENDHOUR": "", "ENDMIN": "",
-                                   "KIND": "0", "ORDER": getattr(self.order, settings.CMMC_ORDER_CODE_CONF),
-                                   "ACCOUNT": "", "DEXCEL": "1", "MONEY": "",
-                                   "NORDERBY": "2", "PAGE": "", "POS_CODE": self.pos_id,
-                                   "STATUS": "3"}
-                       }
-                }
-        if self.bank_proxy_connection(sn):
-            xml_query_refund = self.xml_generate(encoding="GB2312", xml_declaration=True, standalone=True, data=data)
+        sn = self.request_sn()
+        if self.bank_login():
+            xml_query_refund = self.tx_template(QUERY_REFUND_TEMPLATE).render(
+                REQUEST_SN=sn, KIND="0", ORDER=getattr(self.order, settings.CMMC_ORDER_CODE_CONF), DEXCEL="1",
+                NORDERBY="2", POS_CODE=self.pos_id, STATUS="3")
             # resp_query = self.proxy_connection(self.proxy_url, "POST", "text/xml", xml_query_refund)
-            socket_connect = TcpProxy()
-            socket_connect.connect(settings.BANK_TOOLS_HOST, settings.BANK_TOOLS_PORT)
-            socket_connect.send_data(xml_query_refund)
-            resp_query = socket_connect.receive_data()
-            resp_code, resp_msg = self.xml_parse_return_code(resp_query)
-            if resp_code != "000000":
+            resp_query, resp_code, resp_msg = self.bank_tx_request(xml_query_refund, sn,
+                                                                   QUERY_REFUND_TEMPLATE.tx_code)
+            if resp_code == RETURN_NO_RECORD[0]:
+                raise RecordNotFoundError(u"{0}".format(resp_msg))
+            elif resp_code != "000000":
                 raise Exception(u"{0}".format(resp_msg))
             else:
-                root = etree.fromstring(resp_query).getroottree()
-                query_order = root.xpath("//ORDER")[0].text
-                query_status = root.xpath("//ORDER_STATUS")[0].text
-                query_refund_amount = root.xpath("//REFUNDEMENT_AMOUNT")[0].text
-                if query_order != getattr(self.order, settings.CMMC_ORDER_CODE_CONF) or \
-                        float(query_refund_amount) != getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT):
+                record = self.parse_record(resp_query, QUERY_REFUND_TEMPLATE.tx_code)
+                if record is None:
+                    raise RecordNotFoundError(RETURN_NO_RECORD[1])
+                if record.order != getattr(self.order, settings.CMMC_ORDER_CODE_CONF) or \
+                        record.refund_amount != getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT):
                     raise Exception(u"账单号/退款支付金额不匹配")
                 else:
-                    return query_status
+                    return record.status
         else:
             raise Exception(u"bank connection error")
 
-    def bank_refund(self):
-        def create_xml_refund(request_sn, money, order_code):
-            """生成有顺序的xml格式"""
-            tx_root = etree.Element("TX")
-            etree.SubElement(tx_root, "REQUEST_SN").text = str(request_sn)
-            etree.SubElement(tx_root, "CUST_ID").text = self.merchant_id
-            etree.SubElement(tx_root, "USER_ID").text = self.user_id
-            etree.SubElement(tx_root, "PASSWORD").text = self.user_password
-            etree.SubElement(tx_root, "TX_CODE").text = "5W1004"
-            etree.SubElement(tx_root, "LANGUAGE").text = "CN"
-            tx_info = etree.SubElement(tx_root, "TX_INFO")
-            etree.SubElement(tx_info, "MONEY").text = str(money)
-            etree.SubElement(tx_info, "ORDER").text = order_code
-            etree.SubElement(tx_info, "SIGN_INFO").text = ""
-            etree.SubElement(tx_info, "SIGNCERT").text = ""
-            return etree.tostring(tx_root, xml_declaration=True, encoding="GB2312", standalone=True)
-
-        sn = self.order.id
-
-        if self.bank_proxy_connection(sn):
+    @with_deadline
+    def bank_refund(self, sn=None):
+        sn = sn or self.request_sn()
+
+        if self.bank_login():
             # xml_refund = self.xml_generate(encoding="GB2312", xml_declaration=True, standalone=True, data=data)
             # resp_query = self.proxy_connection(self.proxy_url, "POST", "text/xml", xml_refund)
-            xml_refund = create_xml_refund(sn, getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT),
-                                           getattr(self.order, settings.CMMC_ORDER_CODE_CONF))
-            socket_connect = TcpProxy()
-            socket_connect.connect(settings.BANK_TOOLS_HOST, settings.BANK_TOOLS_PORT)
-            socket_connect.send_data(xml_refund)
-            resp_query = socket_connect.receive_data()
-            resp_code, resp_msg = self.xml_parse_return_code(resp_query)
+            xml_refund = self.tx_template(REFUND_TEMPLATE).render(
+                REQUEST_SN=sn, MONEY=str(getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT)),
+                ORDER=getattr(self.order, settings.CMMC_ORDER_CODE_CONF))
+            resp_query, resp_code, resp_msg = self.bank_tx_request(xml_refund, sn, REFUND_TEMPLATE.tx_code)
             if resp_code != "000000":
                 raise Exception(u"{0}".format(resp_msg))
             else:
-                root = etree.fromstring(resp_query).getroottree()
-                query_order = root.xpath("//ORDER_NUM")[0].text
-                query_refund_amount = root.xpath("//AMOUNT")[0].text
-                if query_order != getattr(self.order, settings.CMMC_ORDER_CODE_CONF) or \
-                        float(query_refund_amount) != getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT):
+                record = self.parse_record(resp_query, REFUND_TEMPLATE.tx_code)
+                if record is None or record.order != getattr(self.order, settings.CMMC_ORDER_CODE_CONF) or \
+                        record.amount != getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT):
                     raise Exception(u"账单号/退款支付金额不匹配")
                 else:
+                    invalidate_query(record.order)
                     return True
         else:
             raise Exception(u"bank connection error")
 
+    @classmethod
+    def query_range(cls, start, end, kind="PAY", status="3", settled="0", user=None, merchant_id=None):
+        """
+            按时间段分页查询支付/退款流水(5W1002/5W1003)，不需要指定订单
+            :param start: datetime, 查询开始时间
+            :param end: datetime, 查询结束时间，跨天时按天拆分查询
+            :param kind: "PAY" 支付流水, "REFUND" 退款流水
+            :param status: 流水状态 0 失败 1 成功 2 不确定 3 全部
+            :param settled: 结算状态 0 未结算 1 已结算
+            :return generator, 逐条返回银行流水记录BankRecord(record.order, record.payment_money, record.status...)
+        """
+        if kind not in ("PAY", "REFUND"):
+            raise ActionError(u"动作命令错误")
+        if start > end:
+            raise Exception(u"查询时间段错误")
+        cls.check_request("QUERY_" + kind, user)
+        proxy = cls.for_order(None, "QUERY_" + kind, user, merchant_id)
+        return proxy.bank_query_range(start, end, kind, status, settled)
+
+    def bank_query_range(self, start, end, kind, status, settled):
+        day_start = start
+        while day_start <= end:
+            day_end = min(end, datetime.datetime.combine(day_start.date(), datetime.time(23, 59)))
+            for record in self.bank_query_window(day_start, day_end, kind, status, settled):
+                yield record
+            day_start = datetime.datetime.combine(day_start.date() + datetime.timedelta(days=1), datetime.time(0, 0))
+
+    def bank_query_window(self, start, end, kind, status, settled):
+        """
+            查询同一天内的时间段，按PAGE逐页请求直到最后一页
+        """
+        template = QUERY_PAY_TEMPLATE if kind == "PAY" else QUERY_REFUND_TEMPLATE
+        page = 1
+        page_count = 1
+        while page <= page_count:
+            sn = self.request_sn()
+            xml_query = self.tx_template(template).render(
+                REQUEST_SN=sn, START=start.strftime("%Y%m%d"), STARTHOUR=start.strftime("%H"),
+                STARTMIN=start.strftime("%M"), END=end.strftime("%Y%m%d"), ENDHOUR=end.strftime("%H"),
+                ENDMIN=end.strftime("%M"), KIND=settled, DEXCEL="1", NORDERBY="2", PAGE=str(page),
+                POS_CODE=self.pos_id, STATUS=status)
+            # 每页的登录和查询共用一个截止时间，并重新选择银行客户端主机
+            self._tools = None
+            with deadline(bank_deadline()):
+                if not self.bank_login():
+                    raise Exception(u"bank connection error")
+                resp_query, resp_code, resp_msg = self.bank_tx_request(xml_query, sn, template.tx_code)
+            if resp_code != "000000":
+                raise OrderPayError(u"{0}".format(resp_msg))
+            reply = BankReply()
+            for record in iter_records(resp_query, reply):
+                yield record
+            page_count = reply.page_count or page
+            page += 1
+
     def proxy_bank(self):
         if self.action == self.Action[0]:
             return self.bank_refund()
@@ -461,57 +708,174 @@ class BankProxy(object):
             return self.pay_qrcode()
 
 
-@transaction.atomic
-def open_bank_reply(request):
+def callback_params(request):
     """
-        建设银行回调接口，银行通知订单是否已经支付
+        读取银行回调参数，GET参数优先
+    """
+    params = {}
+    for name in CALLBACK_FIELDS:
+        params[name] = request.POST.get(name, "") if not request.GET.get(name, "") else request.GET.get(name, "")
+    return params
+
+
+def verify_callback(params):
+    """
+        拼接验签字符串并验签
     """
-    logger.debug(u"debug in bank verify: request GET is {}".format(request.GET))
-    logger.debug(u"debug in bank verify: request POST is {}".format(request.POST))
-    pos_id = request.POST.get("POSID", "") if not request.GET.get("POSID", "") else request.GET.get("POSID", "")
-    branch_id = request.POST.get("BRANCHID", "") if not request.GET.get("BRANCHID", "") else request.GET.get("BRANCHID", "")
-    order_id = request.POST.get("ORDERID", "") if not request.GET.get("ORDERID", "") else request.GET.get("ORDERID", "")
-    payment = request.POST.get("PAYMENT", "") if not request.GET.get("PAYMENT", "") else request.GET.get("PAYMENT", "")
-    curcode = request.POST.get("CURCODE", "") if not request.GET.get("CURCODE", "") else request.GET.get("CURCODE", "")
-    remark_1 = request.POST.get("REMARK1", "") if not request.GET.get("REMARK1", "") else request.GET.get("REMARK1", "")
-    remark_2 = request.POST.get("REMARK2", "") if not request.GET.get("REMARK2", "") else request.GET.get("REMARK2", "")
-    acc_type = request.POST.get("ACC_TYPE", "") if not request.GET.get("ACC_TYPE", "") else request.GET.get("ACC_TYPE", "")
-    success = request.POST.get("SUCCESS", "") if not request.GET.get("SUCCESS", "") else request.GET.get("SUCCESS", "")
-    sign = request.POST.get("SIGN", "") if not request.GET.get("SIGN", "") else request.GET.get("SIGN", "")
-
-    raw_str_verfy = "POSID=" + pos_id + "&BRANCHID=" + branch_id + "&ORDERID=" + order_id + "&PAYMENT=" + payment + \
-    "&CURCODE=" + curcode + "&REMARK1=" + remark_1 + "&REMARK2=" + remark_2 + "&ACC_TYPE=" + acc_type + "&SUCCESS=" \
-                    + success + "&SIGN=" + sign
+    raw_str_verfy = "POSID=" + params["POSID"] + "&BRANCHID=" + params["BRANCHID"] + "&ORDERID=" + \
+        params["ORDERID"] + "&PAYMENT=" + params["PAYMENT"] + "&CURCODE=" + params["CURCODE"] + "&REMARK1=" + \
+        params["REMARK1"] + "&REMARK2=" + params["REMARK2"] + "&ACC_TYPE=" + params["ACC_TYPE"] + "&SUCCESS=" + \
+        params["SUCCESS"] + "&SIGN=" + params["SIGN"]
     # mind the EOF is \n
     raw_str_verfy += "\n"
+    verified = bank_verify_sign(raw_str_verfy, merchant_registry().by_pos_id(params["POSID"]))
+    if verified:
+        # 订单状态已变化，删除缓存的查询结果
+        invalidate_query(params["ORDERID"])
+    return verified
+
+
+def open_bank_reply(request):
+    """
+        建设银行回调接口，银行通知订单是否已经支付
+    """
+    params = callback_params(request)
+    order_id, payment, sign = params["ORDERID"], params["PAYMENT"], params["SIGN"]
+    # 重复的通知已经验签处理过，直接返回
+    dedupe_store = callback_dedupe_store()
+    duplicated = dedupe_store.seen(order_id, payment, sign)
+    audit_event("callback", params=params, remote_addr=request.META.get("REMOTE_ADDR"), duplicated=duplicated)
+    if duplicated:
+        logger.debug(u"[in api bank open reply]: duplicated notification of order %s.", order_id)
+        return
     # todo something to verify the request bank reply
     # here yes
-    boolean = bank_verify_sign(raw_str_verfy)
+    boolean = verify_callback(params)
     if boolean:
-        order_obj = Order.objects.filter(**{settings.CMMC_ORDER_DEL_FLAG: FLAG_NO,
-                                            settings.CMMC_ORDER_CODE_CONF: order_id,
-                                            settings.CMMC_ORDER_PAY_STATUS: ORDER_CHOICE_0[0]}).first()
-        if not order_obj:
-            return
-        setattr(order_obj, settings.CMMC_ORDER_PAY_STATUS, ORDER_CHOICE_2[0])
-        setattr(order_obj, settings.CMMC_ORDER_PAY_TIME, datetime.datetime.now())
-        order_obj.save()
-        logger.debug(u"[in api bank open reply]: order pay has been ensured .")
+        if mark_order_paid(order_id):
+            logger.debug(u"[in api bank open reply]: order pay has been ensured .")
+        dedupe_store.add(order_id, payment, sign)
     else:
         return
 
 
-def bank_verify_sign(raw_str):
+def enqueue_bank_reply(request):
+    """
+        异步处理银行回调：参数写入本地spool并放入处理队列后立即返回，
+        验签和订单状态更新由后台线程批量完成，见callback_queue
+        :return True 已入队, False 重复的通知
+    """
+    params = callback_params(request)
+    duplicated = callback_dedupe_store().seen(params["ORDERID"], params["PAYMENT"], params["SIGN"])
+    audit_event("callback", params=params, remote_addr=request.META.get("REMOTE_ADDR"), duplicated=duplicated)
+    if duplicated:
+        return False
+    callback_queue().enqueue(params)
+    return True
+
+
+@transaction.atomic
+def mark_order_paid(order_code):
+    """
+        将未支付的订单标记为已支付，订单不存在或已处理时返回False
+    """
+    order_obj = Order.objects.filter(**{settings.CMMC_ORDER_DEL_FLAG: FLAG_NO,
+                                        settings.CMMC_ORDER_CODE_CONF: order_code,
+                                        settings.CMMC_ORDER_PAY_STATUS: ORDER_CHOICE_0[0]}).first()
+    if not order_obj:
+        return False
+    setattr(order_obj, settings.CMMC_ORDER_PAY_STATUS, ORDER_CHOICE_2[0])
+    setattr(order_obj, settings.CMMC_ORDER_PAY_TIME, datetime.datetime.now())
+    order_obj.save()
+    # 提交后再唤醒等待支付结果的请求，否则等待者可能读到未提交的状态
+    transaction.on_commit(lambda: payment_notifier().notify([order_code]))
+    return True
+
+
+def mark_orders_paid(order_codes):
+    """
+        批量将未支付的订单标记为已支付(单条条件UPDATE，不触发Order.save)，返回更新的订单数
+    """
+    if not order_codes:
+        return 0
+    updated = Order.objects.filter(**{settings.CMMC_ORDER_DEL_FLAG: FLAG_NO,
+                                      settings.CMMC_ORDER_CODE_CONF + "__in": order_codes,
+                                      settings.CMMC_ORDER_PAY_STATUS: ORDER_CHOICE_0[0]}).update(
+        **{settings.CMMC_ORDER_PAY_STATUS: ORDER_CHOICE_2[0], settings.CMMC_ORDER_PAY_TIME: datetime.datetime.now()})
+    if updated:
+        order_codes = list(order_codes)
+        transaction.on_commit(lambda: payment_notifier().notify(order_codes))
+    return updated
+
+
+def order_pay_status(order_code, owner=None):
+    """
+        读取订单支付状态，订单不存在时抛出OrderError
+        :param owner: 不为None时只读取该用户的订单(CMMC_ORDER_USER)，其他用户的订单同样视为不存在
+    """
+    queryset = order_queryset().filter(**{order_code_field(): order_code})
+    if owner is not None:
+        queryset = queryset.filter(**{order_config().user: owner})
+    status = queryset.values_list(settings.CMMC_ORDER_PAY_STATUS, flat=True).first()
+    if status is None:
+        raise OrderError(u"订单号错误")
+    return status
+
+
+def wait_pay_status(order_code, timeout, user, owner=None):
+    """
+        等待订单支付结果(长轮询)：订单未支付时等待mark_order_paid/mark_orders_paid(银行回调、后台轮询)的通知，
+        最多等待timeout秒；超时后回调可能已丢失，查询一次银行(QUERY_PAY)，银行已支付时标记订单已支付。
+        :param owner: 见order_pay_status
+        :return (支付状态, 来源)，来源为"order" 无需等待, "notify" 收到通知, "bank" 超时后查询银行,
+                "timeout" 超时且查询银行失败, "busy" 等待者已满
+    """
+    notifier = payment_notifier()
+    with notifier.waiter(order_code) as waiter:
+        # 先登记再读取状态，读取之后的通知不会丢失
+        status = order_pay_status(order_code, owner)
+        if str(status) != str(ORDER_CHOICE_0[0]):
+            return status, "order"
+        if waiter is None:
+            return status, "busy"
+        if waiter.wait(timeout):
+            return order_pay_status(order_code, owner), "notify"
+
+    def query_bank():
+        bank_status = BankProxy(order_code=order_code, action="QUERY_PAY", user=user).proxy_bank()
+        if str(bank_status) == str(ORDER_STATUS_SUCCESS[0]):
+            mark_orders_paid([order_code])
+        return bank_status
+
+    try:
+        # 本进程内同一订单同时超时的请求只查询一次银行
+        notifier.fallback(order_code, query_bank)
+    except Exception as ex:
+        logger.debug(u"[wait pay status]: query {0} failed: {1}".format(order_code, ex))
+        return status, "timeout"
+    return order_pay_status(order_code, owner), "bank"
+
+
+@with_deadline
+def bank_verify_sign(raw_str, merchant=None):
     """
         建设银行验签
+        :param merchant: 回调所属商户，None为默认商户
     """
-    logger.debug(u"bank_verify_sign string is {}".format(raw_str))
-    socket_connect = TcpProxy()
-    socket_connect.connect(settings.BANK_TOOLS_HOST, settings.BANK_VERIFY_PORT)
-    socket_connect.send_data(raw_str)
-    resp = socket_connect.receive_data()
-    logger.debug(u"bank verify result is {}".format(resp))
-    result = resp[0]
+    stats = metrics()
+    start = time.time()
+    try:
+        resp = (merchant or merchant_registry().default).verify_router.request(raw_str, label=TX_VERIFY)
+        result = resp[0]
+    except Exception as ex:
+        stats.count(TX_VERIFY, classify_error(ex))
+        audit_event("verify", elapsed=time.time() - start, error=classify_error(ex))
+        raise
+    elapsed = time.time() - start
+    stats.observe(TX_VERIFY, "total", elapsed)
+    stats.count(TX_VERIFY, result.upper())
+    audit_event("verify", elapsed=elapsed, result=result)
+    logger.debug(u"bank verify result is %s", resp)
     if result.lower() == "n":
         return False
     elif result.lower() == "y":
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行客户端应答的分帧接收缓冲
+    FrameCodec: 每个连接一个预分配的bytearray，socket通过recv_into(memoryview)直接写入空闲部分，
+        不再逐块拼接字符串(原来的chunks += chunk在大应答时为平方复杂度)；
+        报文完整性按以下方式判断，无需等待对端关闭连接：
+            terminator 应答以结束标签(如"</TX>")结束，只在新收到的数据中查找，整体为线性复杂度；
+            header_size 应答前有header_size位十进制长度头(不含长度头本身)，读到长度头后按长度一次分配好缓冲；
+            两者都未设置时读到对端关闭连接为止(验签端口)。
+        帧之后的空白字符被丢弃；缓冲按需倍增，超过max_size时抛出FrameError，
+        单次应答使缓冲超过keep_size时，处理完成后恢复为初始大小，避免连接池中的空闲连接长期占用内存。
+    @@调用(socket读写在TcpProxy.receive_data中)：
+        codec = FrameCodec(terminator="</TX>")
+        while True:
+            frame = codec.next_frame()
+            if frame is not None:
+                return frame
+            n = sock.recv_into(codec.free_space())
+            if not n:
+                return codec.eof_frame()
+            codec.commit(n)
+"""
+
+WHITESPACE = frozenset(bytearray(b" \t\r\n"))
+
+
+class FrameError(Exception):
+    """
+        应答报文格式错误或超过大小限制
+    """
+    pass
+
+
+class FrameCodec(object):
+    """
+        分帧接收缓冲，buf[start:end]为已接收未取走的数据
+    """
+
+    def __init__(self, terminator=None, header_size=0, initial_size=8192, max_size=64 * 1024 * 1024,
+                 keep_size=1024 * 1024, min_free=4096):
+        self.terminator = terminator
+        self.header_size = header_size
+        self.initial_size = initial_size
+        self.max_size = max_size
+        self.keep_size = keep_size
+        self.min_free = min_free
+        self.buf = bytearray(initial_size)
+        self.start = 0
+        self.end = 0
+        # 已查找过结束标签的位置
+        self.scanned = 0
+        # 长度头模式下当前帧的总长度(含长度头)
+        self.expected = None
+
+    def pending(self):
+        return self.end - self.start
+
+    def _reserve(self, size):
+        """
+            保证buf[end:]至少有size字节空闲，先把数据移到开头，仍不够时扩容
+        """
+        if len(self.buf) - self.end >= size:
+            return
+        length = self.end - self.start
+        if self.start:
+            self.buf[:length] = self.buf[self.start:self.end]
+        if len(self.buf) - length < size:
+            capacity = len(self.buf)
+            while capacity - length < size:
+                capacity *= 2
+            if capacity > self.max_size:
+                raise FrameError(u"应答超过最大长度{0}字节".format(self.max_size))
+            # extend可在原内存上扩展，避免再复制一份已接收的数据
+            self.buf.extend(bytearray(capacity - len(self.buf)))
+        self.scanned -= self.start
+        self.start, self.end = 0, length
+
+    def free_space(self):
+        """
+            可写入的空闲部分，供recv_into使用
+        """
+        if self.expected is not None:
+            self._reserve(max(self.expected - self.pending(), 1))
+        else:
+            self._reserve(self.min_free)
+        return memoryview(self.buf)[self.end:]
+
+    def commit(self, size):
+        self.end += size
+
+    def _take(self, stop, data_start=None):
+        """
+            取出buf[start:stop]，之后跳过空白字符
+        """
+        frame = memoryview(self.buf)[self.start if data_start is None else data_start:stop].tobytes()
+        self.start = stop
+        while self.start < self.end and self.buf[self.start] in WHITESPACE:
+            self.start += 1
+        self.scanned = self.start
+        self.expected = None
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+            if len(self.buf) > self.keep_size:
+                self.buf = bytearray(self.initial_size)
+        return frame
+
+    def next_frame(self):
+        """
+            已收到完整的一帧时返回该帧，否则返回None
+        """
+        if self.header_size:
+            if self.expected is None:
+                if self.pending() < self.header_size:
+                    return None
+                header = memoryview(self.buf)[self.start:self.start + self.header_size].tobytes()
+                try:
+                    length = int(header)
+                except ValueError:
+                    raise FrameError(u"应答长度头错误: {0!r}".format(header))
+                if length < 0 or length + self.header_size > self.max_size:
+                    raise FrameError(u"应答长度错误: {0}".format(length))
+                self.expected = self.header_size + length
+            if self.pending() < self.expected:
+                return None
+            stop = self.start + self.expected
+            return self._take(stop, self.start + self.header_size)
+        if self.terminator:
+            # 结束标签可能跨越两次recv，从上次查找位置往前len(terminator) - 1字节开始
+            position = self.buf.find(self.terminator, max(self.start, self.scanned - len(self.terminator) + 1),
+                                     self.end)
+            if position < 0:
+                self.scanned = self.end
+                return None
+            return self._take(position + len(self.terminator))
+        return None
+
+    def eof_frame(self):
+        """
+            对端关闭连接时取出剩余的全部数据
+        """
+        return self._take(self.end)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+建行网关(聚合二维码)HTTP请求的共享会话
+    BankProxy.proxy_connection使用进程内共享的requests.Session，连接保持(keep-alive)，
+    避免每次PAY都重新进行TCP连接和TLS握手。
+    @@功能：
+        连接池大小、连接/读取超时可配置；GET请求在连接错误时自动重试；
+        记录建立连接(含TLS握手)和整个请求的耗时，http_stats()读取统计；
+        连接/读取超时不超过当前deadline的剩余时间，每个host一个熔断器(连接错误、超时和5xx计为失败)，见resilience。
+    @@说明：
+        会话不保存cookie，与原来每次调用requests.post/get的行为一致，避免不同订单之间共享cookie。
+    @@setting配置(均可选)：
+        CMMC_HTTP_POOL_SIZE = 10            # 每个host的连接池大小
+        CMMC_HTTP_CONNECT_TIMEOUT = 5       # 连接超时(秒)
+        CMMC_HTTP_READ_TIMEOUT = 15         # 读取超时(秒)
+        CMMC_HTTP_GET_RETRIES = 2           # GET请求重试次数
+"""
+import time
+import urlparse
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import cookielib
+from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from django.conf import settings
+from resilience import remaining_time, circuit_breaker
+
+
+class HttpTimingStats(object):
+    """
+        连接和请求耗时统计
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {"connects": 0, "connect_time": 0.0, "connect_time_max": 0.0,
+                      "requests": 0, "request_time": 0.0, "request_time_max": 0.0, "errors": 0}
+
+    def _add(self, name, seconds):
+        with self._lock:
+            self._data[name + "s"] += 1
+            self._data[name + "_time"] += seconds
+            if seconds > self._data[name + "_time_max"]:
+                self._data[name + "_time_max"] = seconds
+
+    def add_connect(self, seconds):
+        self._add("connect", seconds)
+
+    def add_request(self, seconds):
+        self._add("request", seconds)
+
+    def add_error(self):
+        with self._lock:
+            self._data["errors"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self._data)
+        data["connect_time_avg"] = data["connect_time"] / data["connects"] if data["connects"] else 0.0
+        data["request_time_avg"] = data["request_time"] / data["requests"] if data["requests"] else 0.0
+        return data
+
+
+timing_stats = HttpTimingStats()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.time()
+        HTTPConnection.connect(self)
+        timing_stats.add_connect(time.time() - start)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        # https连接的connect包含TCP连接和TLS握手
+        start = time.time()
+        HTTPSConnection.connect(self)
+        timing_stats.add_connect(time.time() - start)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+        使用计时连接类的HTTPAdapter
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool,
+                                                   "https": TimedHTTPSConnectionPool}
+
+
+def get_retry(total):
+    """
+        只对GET(幂等)请求重试
+    """
+    try:
+        return Retry(total=total, backoff_factor=0.2, allowed_methods=frozenset(["GET"]),
+                     status_forcelist=(502, 503, 504))
+    except TypeError:
+        return Retry(total=total, backoff_factor=0.2, method_whitelist=frozenset(["GET"]),
+                     status_forcelist=(502, 503, 504))
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def http_session():
+    """
+        进程内共享的requests.Session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = getattr(settings, "CMMC_HTTP_POOL_SIZE", 10)
+                adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                           max_retries=get_retry(getattr(settings, "CMMC_HTTP_GET_RETRIES", 2)))
+                session = requests.Session()
+                session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def http_timeout():
+    """
+        (连接超时, 读取超时)，不超过当前deadline的剩余时间
+    """
+    return (remaining_time(getattr(settings, "CMMC_HTTP_CONNECT_TIMEOUT", 5)),
+            remaining_time(getattr(settings, "CMMC_HTTP_READ_TIMEOUT", 15)))
+
+
+class GatewayError(IOError):
+    """
+        建行网关返回5xx，计为熔断失败
+    """
+    pass
+
+
+def _request(method, url, **kwargs):
+    start = time.time()
+    try:
+        resp = http_session().request(method, url, **kwargs)
+    except Exception:
+        timing_stats.add_error()
+        raise
+    timing_stats.add_request(time.time() - start)
+    if resp.status_code >= 500:
+        raise GatewayError(u"{0} {1}: HTTP {2}".format(method, url, resp.status_code))
+    return resp
+
+
+def http_request(method, url, **kwargs):
+    """
+        通过共享会话发送请求并记录耗时，经过目标host的熔断器
+    """
+    kwargs.setdefault("timeout", http_timeout())
+    breaker = circuit_breaker(urlparse.urlparse(url).netloc, failure_types=(requests.ConnectionError,
+                                                                          requests.Timeout,
+                                                                          requests.exceptions.RetryError,
+                                                                          GatewayError))
+    if breaker is None:
+        return _request(method, url, **kwargs)
+    with breaker.guard():
+        return _request(method, url, **kwargs)
+
+
+def http_stats():
+    return timing_stats.snapshot()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+BankProxy和银行回调接口的并发压测
+    python manage.py cmmc_bench --action QUERY_PAY --action CALLBACK --requests 2000 --concurrency 16
+    默认启动进程内的BankSimulator并将BANK_TOOLS_*、CMMC_QRCODE_GATEWAY_URL指向模拟器，
+    --no-simulate时直接压测setting中配置的建行客户端(请勿对生产环境执行REFUND)。
+    订单取自数据库中未删除的订单(--orders个)，CALLBACK每次使用不同的SIGN，走完整的验签和更新流程。
+    默认关闭QUERY_PAY/QUERY_REFUND结果缓存以测量银行请求本身，--query-cache时启用。
+"""
+import time
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from ...simulator import BankSimulator
+from ...utils import FLAG_NO, percentile
+from ... import ccb_merchant_proxy as agents
+from ... import views
+
+BENCH_USER = "cmmc_bench"
+ACTIONS = ("QUERY_PAY", "QUERY_REFUND", "REFUND", "PAY", "CALLBACK")
+
+
+class Command(BaseCommand):
+    help = u"并发压测BankProxy各action和银行回调接口，输出ops/s和p50/p99延迟"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--action", action="append", choices=ACTIONS, help=u"压测的action，可重复指定")
+        parser.add_argument("--requests", type=int, default=1000, help=u"每个action的请求数")
+        parser.add_argument("--concurrency", type=int, default=16, help=u"并发数")
+        parser.add_argument("--orders", type=int, default=100, help=u"使用的订单数")
+        parser.add_argument("--no-simulate", action="store_false", dest="simulate", help=u"不启动模拟器")
+        parser.add_argument("--latency", type=float, default=0.005, help=u"模拟器延迟(秒)")
+        parser.add_argument("--jitter", type=float, default=0.002, help=u"模拟器延迟抖动(秒)")
+        parser.add_argument("--error-rate", type=float, default=0.0, help=u"模拟器错误返回比例")
+        parser.add_argument("--drop-rate", type=float, default=0.0, help=u"模拟器断开连接比例")
+        parser.add_argument("--query-cache", action="store_true", default=False, help=u"启用查询结果缓存")
+
+    def handle(self, *args, **options):
+        orders = list(agents.Order.objects.filter(**{settings.CMMC_ORDER_DEL_FLAG: FLAG_NO}).values_list(
+            settings.CMMC_ORDER_CODE_CONF, settings.CMMC_ORDER_PAY_AMOUNT)[:options["orders"]])
+        if not orders:
+            raise CommandError(u"数据库中没有可用的订单")
+        actions = options["action"] or ["QUERY_PAY", "CALLBACK"]
+        overrides = {} if options["query_cache"] else {"CMMC_QUERY_CACHE_BACKEND": None}
+        if not options["simulate"]:
+            with override_settings(**overrides):
+                for action in actions:
+                    self.report(action, self.run(action, orders, options))
+            return
+        simulator = BankSimulator(latency=options["latency"], jitter=options["jitter"],
+                                  error_rate=options["error_rate"], drop_rate=options["drop_rate"]).start()
+        for code, amount in orders:
+            simulator.add_order(code, amount)
+        try:
+            overrides.update(simulator.settings_overrides())
+            with override_settings(**overrides):
+                for action in actions:
+                    self.report(action, self.run(action, orders, options))
+        finally:
+            simulator.stop()
+        self.stdout.write(u"simulator: {0}".format(simulator.stats()))
+
+    @staticmethod
+    def call_action(action, code, amount, index):
+        """
+            执行一次请求，失败时抛出异常
+        """
+        if action != "CALLBACK":
+            return agents.BankProxy(order_code=code, action=action, user=BENCH_USER).proxy_bank()
+        params = {"POSID": settings.BANK_POS_ID, "BRANCHID": settings.BANK_BRANCH_ID, "ORDERID": code,
+                  "PAYMENT": "{0}".format(amount), "CURCODE": "01", "REMARK1": "", "REMARK2": "",
+                  "ACC_TYPE": "12", "SUCCESS": "Y", "TYPE": "1", "REFERER": "", "CLIENTIP": "",
+                  "SIGN": "bench{0:08d}".format(index)}
+        response = views.api_open_bank_reply(RequestFactory().post("/api/open/bank_reply", params))
+        if response.content:
+            raise Exception(response.content)
+
+    def run(self, action, orders, options):
+        def task(index):
+            code, amount = orders[index % len(orders)]
+            start = time.time()
+            try:
+                self.call_action(action, code, amount, index)
+                error = None
+            except Exception as ex:
+                error = ex
+            finally:
+                close_old_connections()
+            return time.time() - start, error
+
+        latencies, errors, first_error = [], 0, None
+        pool = ThreadPool(options["concurrency"])
+        started = time.time()
+        try:
+            for latency, error in pool.imap_unordered(task, range(options["requests"])):
+                latencies.append(latency)
+                if error is not None:
+                    errors += 1
+                    first_error = first_error or error
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - started
+        latencies.sort()
+        return {"requests": len(latencies), "errors": errors, "first_error": first_error, "elapsed": elapsed,
+                "ops": len(latencies) / elapsed if elapsed > 0 else 0.0,
+                "p50": percentile(latencies, 50) * 1000, "p99": percentile(latencies, 99) * 1000}
+
+    def report(self, action, result):
+        self.stdout.write(u"{0:<12} requests={requests} errors={errors} elapsed={elapsed:.2f}s ops/s={ops:.1f} "
+                          u"p50={p50:.2f}ms p99={p99:.2f}ms".format(action, **result))
+        if result["first_error"] is not None:
+            self.stderr.write(u"{0:<12} first error: {1}".format(action, result["first_error"]))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+TX请求报文生成的微基准测试：xml_generate(ElementTree + lxml二次序列化) 与 预编译模板
+    python manage.py cmmc_bench_xml --number 20000
+"""
+import timeit
+from django.core.management.base import BaseCommand
+from ...ccb_merchant_proxy import BankProxy
+from ...xml_template import QUERY_PAY_TEMPLATE
+
+
+class Command(BaseCommand):
+    help = u"比较xml_generate与预编译模板生成5W1002查询报文的耗时"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--number", type=int, default=20000, help=u"每种方式的执行次数")
+
+    def handle(self, *args, **options):
+        number = options["number"]
+        data = {"TX": {"REQUEST_SN": 1, "CUST_ID": "105000000000001", "USER_ID": "105000000000001-001",
+                       "PASSWORD": "password", "TX_CODE": "5W1002", "LANGUAGE": "CN",
+                       "TX_INFO": {"START": "", "STARTHOUR": "", "STARTMIN": "",
+                                   "END": "", "ENDHOUR": "", "ENDMIN": "",
+                                   "KIND": "0", "ORDER": "105000000000001201802220001",
+                                   "ACCOUNT": "", "DEXCEL": "1", "MONEY": "",
+                                   "NORDERBY": "2", "PAGE": "", "POS_CODE": "000000001",
+                                   "STATUS": "3"}
+                       }
+                }
+        template = QUERY_PAY_TEMPLATE.bind(CUST_ID="105000000000001", USER_ID="105000000000001-001",
+                                           PASSWORD="password")
+
+        def old_path():
+            BankProxy.xml_generate(encoding="GB2312", xml_declaration=True, standalone=True, data=data)
+
+        def new_path():
+            template.render(REQUEST_SN=1, KIND="0", ORDER="105000000000001201802220001", DEXCEL="1",
+                            NORDERBY="2", POS_CODE="000000001", STATUS="3")
+
+        old_time = min(timeit.repeat(old_path, number=number, repeat=3))
+        new_time = min(timeit.repeat(new_path, number=number, repeat=3))
+        self.stdout.write(u"xml_generate : {0:.2f} us/op".format(old_time / number * 1e6))
+        self.stdout.write(u"xml_template : {0:.2f} us/op".format(new_time / number * 1e6))
+        self.stdout.write(u"speedup      : {0:.1f}x".format(old_time / new_time if new_time else 0))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+批量退款
+    python manage.py cmmc_bulk_refund --journal refund.log --file codes.txt [--concurrency 4]
+    python manage.py cmmc_bulk_refund --journal refund.log ORDER_CODE [ORDER_CODE ...]
+    使用同一journal重新执行即可从中断处继续，已退款的订单不会重复退款
+"""
+import io
+from django.core.management.base import BaseCommand, CommandError
+from ...bulk_refund import BulkRefund
+
+
+class Command(BaseCommand):
+    help = u"批量执行建行退款(5W1004)，记录退款日志并支持中断后继续"
+
+    def add_arguments(self, parser):
+        parser.add_argument("order_codes", nargs="*", help=u"订单号")
+        parser.add_argument("--file", default=None, help=u"订单号文件，每行一个")
+        parser.add_argument("--journal", required=True, help=u"退款日志文件")
+        parser.add_argument("--concurrency", type=int, default=4, help=u"并发退款数")
+        parser.add_argument("--retries", type=int, default=2, help=u"失败订单的最大重试次数")
+
+    def handle(self, *args, **options):
+        codes = list(options["order_codes"])
+        if options["file"]:
+            with io.open(options["file"], encoding="utf-8") as fp:
+                codes.extend(line.strip() for line in fp if line.strip())
+        if not codes:
+            raise CommandError(u"请指定订单号")
+
+        def progress(code, result, latency, error):
+            if error is not None:
+                self.stderr.write(u"{0} {1}: {2}".format(code, result, error))
+
+        summary = BulkRefund(options["journal"], concurrency=options["concurrency"],
+                             retries=options["retries"]).run(codes, progress=progress)
+        self.stdout.write(u"total={total} success={success} failed={failed} skipped={skipped} "
+                          u"elapsed={elapsed:.2f}s throughput={throughput:.2f}/s".format(**summary))
+        self.stdout.write(u"latency p50={latency_p50:.3f}s p95={latency_p95:.3f}s p99={latency_p99:.3f}s "
+                          u"max={latency_max:.3f}s".format(**summary))
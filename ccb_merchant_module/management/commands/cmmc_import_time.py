@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+测量ccb_merchant_proxy和views的导入耗时
+    python manage.py cmmc_import_time [--repeat 5]
+    每次在新的子进程中执行django.setup()后导入，输出导入耗时的中位数和由该导入加载的重量级依赖
+    (django.setup()本身可能已经加载PIL等模块，不计入)
+"""
+import os
+import sys
+import json
+import subprocess
+from django.core.management.base import BaseCommand, CommandError
+
+HEAVY_MODULES = ("qrcode", "PIL.Image", "lxml.etree", "requests")
+
+SCRIPT = """
+import sys, time, json
+import django
+django.setup()
+before = set(sys.modules)
+start = time.time()
+import {package}.ccb_merchant_proxy
+import {package}.views
+elapsed = time.time() - start
+loaded = [name for name in {heavy!r} if name in sys.modules and name not in before]
+print(json.dumps({{"elapsed": elapsed, "loaded": loaded}}))
+"""
+
+
+class Command(BaseCommand):
+    help = u"测量ccb_merchant_proxy和views的导入耗时"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5, help=u"测量次数")
+
+    def handle(self, *args, **options):
+        package = __name__.split(".management.")[0]
+        script = SCRIPT.format(package=package, heavy=HEAVY_MODULES)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path or os.getcwd() for path in sys.path))
+        results = []
+        for _ in range(options["repeat"]):
+            output = subprocess.check_output([sys.executable, "-c", script], env=env)
+            try:
+                results.append(json.loads(output.strip().splitlines()[-1]))
+            except (ValueError, IndexError):
+                raise CommandError(u"测量失败: {0}".format(output))
+        elapsed = sorted(result["elapsed"] for result in results)
+        self.stdout.write(u"import {0}.ccb_merchant_proxy + views: median {1:.1f}ms min {2:.1f}ms".format(
+            package, elapsed[len(elapsed) // 2] * 1000, elapsed[0] * 1000))
+        self.stdout.write(u"heavy modules loaded by import: {0}".format(u", ".join(results[-1]["loaded"]) or u"none"))
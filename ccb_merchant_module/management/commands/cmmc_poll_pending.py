@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+未支付订单对账轮询
+    python manage.py cmmc_poll_pending [--once] [--concurrency 4]
+"""
+from django.core.management.base import BaseCommand
+from ...pending_poller import pending_poller
+
+
+class Command(BaseCommand):
+    help = u"轮询未支付订单的银行支付状态，补偿丢失的银行回调"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", default=False, help=u"查询一轮后退出")
+        parser.add_argument("--concurrency", type=int, default=None, help=u"同时在途的银行查询数")
+        parser.add_argument("--min-interval", type=float, default=None, help=u"新订单的查询间隔(秒)")
+        parser.add_argument("--max-interval", type=float, default=None, help=u"最大查询间隔(秒)")
+        parser.add_argument("--scan-interval", type=float, default=None, help=u"重新扫描未支付订单的间隔(秒)")
+
+    def handle(self, *args, **options):
+        poller = pending_poller(concurrency=options["concurrency"], min_interval=options["min_interval"],
+                                max_interval=options["max_interval"], scan_interval=options["scan_interval"])
+        if options["once"]:
+            stats = poller.run_once()
+            self.stdout.write(u" ".join(u"{0}={1}".format(key, value) for key, value in sorted(stats.items())))
+        else:
+            poller.run_forever()
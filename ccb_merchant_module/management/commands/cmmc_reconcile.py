@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行流水与订单表对账
+    python manage.py cmmc_reconcile --start 2017-01-01 --end "2017-01-31 23:59" --output recon.jsonl
+        [--kind PAY|REFUND] [--chunk-size 1000] [--fix] [--merchant MERCHANT_ID]
+    差异逐行写入output，--fix时自动将银行已支付、金额一致的未支付订单标记为已支付
+"""
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from ...reconciliation import Reconciler
+
+TIME_FORMATS = ("%Y-%m-%d %H:%M", "%Y-%m-%d")
+
+
+def parse_time(value, end=False):
+    for fmt in TIME_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if end and fmt == "%Y-%m-%d":
+            parsed = parsed.replace(hour=23, minute=59)
+        return parsed
+    raise CommandError(u"时间格式错误: {0}".format(value))
+
+
+class Command(BaseCommand):
+    help = u"按时间段核对建行支付/退款流水与订单表，输出差异"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", required=True, help=u"开始时间，YYYY-MM-DD[ HH:MM]")
+        parser.add_argument("--end", required=True, help=u"结束时间，YYYY-MM-DD[ HH:MM]，只有日期时为当天23:59")
+        parser.add_argument("--kind", default="PAY", choices=("PAY", "REFUND"), help=u"支付或退款流水")
+        parser.add_argument("--output", required=True, help=u"差异输出文件")
+        parser.add_argument("--chunk-size", type=int, default=1000, help=u"每批加载的订单数")
+        parser.add_argument("--fix", action="store_true", default=False, help=u"自动修复安全的差异")
+        parser.add_argument("--merchant", default=None, help=u"商户号，默认BANK_MERCHANT_ID")
+
+    def handle(self, *args, **options):
+        start, end = parse_time(options["start"]), parse_time(options["end"], end=True)
+        if start > end:
+            raise CommandError(u"查询时间段错误")
+        summary = Reconciler(start, end, kind=options["kind"], output=options["output"],
+                             chunk_size=options["chunk_size"], fix=options["fix"],
+                             merchant_id=options["merchant"]).run()
+        self.stdout.write(u"bank_records={bank_records} matched={matched} pending={pending} "
+                          u"missing_order={missing_order} missing_bank={missing_bank} amount={amount} "
+                          u"status={status} fixed={fixed} elapsed={elapsed:.2f}s".format(**summary))
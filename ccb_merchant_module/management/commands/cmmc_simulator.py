@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+启动建行客户端模拟器
+    python manage.py cmmc_simulator --tools-port 12345 --verify-port 12346 --http-port 8088 [--latency 0.01]
+    未登记的订单从数据库读取金额并视为已支付；将BANK_TOOLS_HOST/BANK_TOOLS_PORT/BANK_VERIFY_PORT和
+    CMMC_QRCODE_GATEWAY_URL指向模拟器即可联调
+"""
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from ...simulator import BankSimulator
+from ... import ccb_merchant_proxy as agents
+
+
+def order_amount(code):
+    try:
+        return agents.Order.objects.filter(**{settings.CMMC_ORDER_CODE_CONF: code}).values_list(
+            settings.CMMC_ORDER_PAY_AMOUNT, flat=True).first()
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = u"启动建行客户端模拟器(业务端口、验签端口和聚合二维码网关)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1", help=u"监听地址")
+        parser.add_argument("--tools-port", type=int, default=12345, help=u"业务端口")
+        parser.add_argument("--verify-port", type=int, default=12346, help=u"验签端口")
+        parser.add_argument("--http-port", type=int, default=8088, help=u"聚合二维码网关端口")
+        parser.add_argument("--latency", type=float, default=0.0, help=u"延迟(秒)")
+        parser.add_argument("--jitter", type=float, default=0.0, help=u"延迟抖动(秒)")
+        parser.add_argument("--error-rate", type=float, default=0.0, help=u"错误返回比例")
+        parser.add_argument("--drop-rate", type=float, default=0.0, help=u"断开连接比例")
+        parser.add_argument("--page-size", type=int, default=20, help=u"按时间段查询的每页条数")
+        parser.add_argument("--no-keep-alive", action="store_false", dest="keep_alive",
+                            help=u"每个请求后关闭业务端口连接")
+
+    def handle(self, *args, **options):
+        simulator = BankSimulator(host=options["host"], tools_port=options["tools_port"],
+                                  verify_port=options["verify_port"], http_port=options["http_port"],
+                                  latency=options["latency"], jitter=options["jitter"],
+                                  error_rate=options["error_rate"], drop_rate=options["drop_rate"],
+                                  keep_alive=options["keep_alive"], page_size=options["page_size"],
+                                  order_lookup=order_amount).start()
+        for name, value in sorted(simulator.settings_overrides().items()):
+            self.stdout.write(u"{0} = {1!r}".format(name, value))
+        try:
+            while True:
+                time.sleep(60)
+                self.stdout.write(u"{0}".format(simulator.stats()))
+        except KeyboardInterrupt:
+            simulator.stop()
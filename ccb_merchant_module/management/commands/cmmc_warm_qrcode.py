@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+批量预生成支付二维码
+    python manage.py cmmc_warm_qrcode --file codes.txt [--concurrency 8] [--processes 4] [--force]
+    python manage.py cmmc_warm_qrcode ORDER_CODE [ORDER_CODE ...]
+    二维码缓存必须是web worker共享的后端(CMMC_QRCODE_CACHE_BACKEND = "django"或自定义后端)，
+    local后端只写入本命令进程的内存，命令结束后即丢失
+"""
+import io
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ...qrcode_warmup import QRCodeWarmer
+from ...ccb_merchant_proxy import QRCodeError
+
+
+class Command(BaseCommand):
+    help = u"批量请求建行网关并生成支付二维码，写入二维码缓存"
+
+    def add_arguments(self, parser):
+        parser.add_argument("order_codes", nargs="*", help=u"订单号")
+        parser.add_argument("--file", default=None, help=u"订单号文件，每行一个")
+        parser.add_argument("--concurrency", type=int, default=8, help=u"并发的网关请求数")
+        parser.add_argument("--processes", type=int, default=None, help=u"生成PNG的进程数，默认CPU核数，0为当前进程")
+        parser.add_argument("--force", action="store_true", default=False, help=u"已缓存的订单也重新生成")
+        parser.add_argument("--merchant", default=None, help=u"商户号，默认BANK_MERCHANT_ID")
+
+    def handle(self, *args, **options):
+        codes = list(options["order_codes"])
+        if options["file"]:
+            with io.open(options["file"], encoding="utf-8") as fp:
+                codes.extend(line.strip() for line in fp if line.strip())
+        if not codes:
+            raise CommandError(u"请指定订单号")
+        backend = getattr(settings, "CMMC_QRCODE_CACHE_BACKEND", "local")
+        if not backend or backend == "local":
+            raise CommandError(u"CMMC_QRCODE_CACHE_BACKEND需要配置为共享的缓存后端(django或自定义后端)，"
+                               u"local后端的预生成结果web worker无法使用")
+
+        def progress(code, result, error):
+            if error is not None:
+                self.stderr.write(u"{0} {1}: {2}".format(code, result, error))
+
+        warmer = QRCodeWarmer(concurrency=options["concurrency"], processes=options["processes"],
+                              force=options["force"], merchant_id=options["merchant"])
+        try:
+            summary = warmer.run(codes, progress=progress)
+        except QRCodeError as ex:
+            raise CommandError(u"{0}".format(ex))
+        self.stdout.write(u"total={total} success={success} failed={failed} skipped={skipped} "
+                          u"elapsed={elapsed:.2f}s throughput={throughput:.2f}/s".format(**summary))
+        self.stdout.write(u"gateway latency p50={latency_p50:.3f}s p95={latency_p95:.3f}s p99={latency_p99:.3f}s "
+                          u"max={latency_max:.3f}s".format(**summary))
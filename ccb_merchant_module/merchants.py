@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+多商户配置和银行客户端多主机路由
+    Merchant: 单个商户的配置(商户号、柜台号、分行号、操作员、密码、公钥)和该商户使用的银行客户端主机列表
+    MerchantRegistry: merchant_id -> Merchant，默认商户即原有的BANK_*配置，CMMC_MERCHANTS中配置其他商户
+    ToolsRouter: 一组银行客户端主机(每个主机一个连接池和熔断器，见tcp_pool)之间的负载均衡：
+        选择在途请求(使用中 + 等待中的连接)最少的主机，相同时轮流选择；
+        熔断(open)的主机被跳过，全部熔断时仍返回其中一个，由其熔断器抛出CircuitOpenError并计入rejected；
+        最近连续失败的主机(很快返回错误，在途请求少)排在正常主机之后，避免故障主机吸走请求。
+    @@说明：
+        5W1001登录会话属于某个银行客户端实例，BankProxy在登录前选定主机，同一次交易的登录和业务请求都发往该主机，
+        会话按"商户号:操作员@host:port"分别缓存。
+        验签请求按回调的POSID找到商户，在该商户的验签端口之间同样按最少在途请求选择。
+    @@调用：
+        BankProxy(order_code=order_code, action="QUERY_PAY", user=user, merchant_id="105000000000001")
+        merchant = merchant_registry().get(merchant_id)         # merchant_id为None时返回默认商户
+        resp = merchant.tools_router.request(xml_string, label="5W1002")
+    @@setting配置(均可选)：
+        CMMC_TOOLS_HOSTS = []           # 默认商户的银行客户端主机[(host, port)]，未配置时为BANK_TOOLS_HOST/BANK_TOOLS_PORT
+        CMMC_VERIFY_HOSTS = []          # 默认商户的验签主机[(host, port)]，未配置时为BANK_TOOLS_HOST/BANK_VERIFY_PORT
+        CMMC_MERCHANTS = {}             # 其他商户，{merchant_id: {"POS_ID": ..., "BRANCH_ID": ..., "USER_ID": ...,
+                                        #   "USER_PASSWORD": ..., "PUBLIC_KEY": ..., "PROXY_URL": ...,
+                                        #   "TOOLS_HOSTS": [...], "VERIFY_HOSTS": [...]}}，未配置的项使用默认商户的值
+"""
+import itertools
+import threading
+from django.conf import settings
+from django.core.signals import setting_changed
+from tcp_pool import get_pool, TOOLS_TERMINATOR
+
+
+class MerchantError(Exception):
+    """
+        商户未配置
+    """
+    pass
+
+
+class ToolsRouter(object):
+    """
+        按最少在途请求在多个银行客户端主机之间选择连接池
+    """
+
+    def __init__(self, hosts, terminator=None):
+        if not hosts:
+            raise MerchantError(u"未配置银行客户端主机")
+        self.hosts = [(host, int(port)) for host, port in hosts]
+        self.pools = [get_pool(host, port, terminator=terminator) for host, port in self.hosts]
+        self._counter = itertools.count()
+
+    def choose(self):
+        """
+            选择在途请求最少且未熔断的连接池，全部熔断时返回轮到的连接池(请求时抛出CircuitOpenError)
+        """
+        count = len(self.pools)
+        offset = next(self._counter) % count
+        best, best_load = None, None
+        for index in range(count):
+            pool = self.pools[(offset + index) % count]
+            if pool.breaker is not None and not pool.breaker.available():
+                continue
+            load = (pool.breaker is not None and pool.breaker.failures > 0, pool.outstanding())
+            if best is None or load < best_load:
+                best, best_load = pool, load
+        return best or self.pools[offset]
+
+    def request(self, data, label="tcp", idempotent=None):
+        return self.choose().request(data, label=label, idempotent=idempotent)
+
+
+class Merchant(object):
+    """
+        单个商户的配置
+    """
+
+    def __init__(self, merchant_id, pos_id, branch_id, user_id, user_password, public_key, proxy_url,
+                 tools_hosts, verify_hosts):
+        self.merchant_id = merchant_id
+        self.pos_id = pos_id
+        self.branch_id = branch_id
+        self.user_id = user_id
+        self.user_password = user_password
+        self.public_key = public_key
+        self.proxy_url = proxy_url
+        self.tools_router = ToolsRouter(tools_hosts, terminator=TOOLS_TERMINATOR)
+        self.verify_router = ToolsRouter(verify_hosts)
+
+    def __repr__(self):
+        return "<Merchant {0}>".format(self.merchant_id)
+
+
+class MerchantRegistry(object):
+    """
+        merchant_id -> Merchant
+    """
+
+    def __init__(self, default, merchants=()):
+        self.default = default
+        self._merchants = dict((merchant.merchant_id, merchant) for merchant in merchants)
+        self._merchants[default.merchant_id] = default
+        self._by_pos_id = dict((merchant.pos_id, merchant) for merchant in self._merchants.values())
+
+    def get(self, merchant_id=None):
+        if merchant_id is None:
+            return self.default
+        try:
+            return self._merchants[merchant_id]
+        except KeyError:
+            raise MerchantError(u"商户未配置: {0}".format(merchant_id))
+
+    def by_pos_id(self, pos_id):
+        """
+            按柜台号查找商户(银行回调只带POSID)，找不到时返回默认商户
+        """
+        return self._by_pos_id.get(pos_id, self.default)
+
+    def merchants(self):
+        return list(self._merchants.values())
+
+
+def default_merchant():
+    tools_hosts = getattr(settings, "CMMC_TOOLS_HOSTS", None) or [(settings.BANK_TOOLS_HOST, settings.BANK_TOOLS_PORT)]
+    verify_hosts = getattr(settings, "CMMC_VERIFY_HOSTS", None) or \
+        [(settings.BANK_TOOLS_HOST, settings.BANK_VERIFY_PORT)]
+    return Merchant(settings.BANK_MERCHANT_ID, settings.BANK_POS_ID, settings.BANK_BRANCH_ID, settings.BANK_USER_ID,
+                    settings.BANK_USER_PASSWORD, settings.BANK_PUBLIC_KEY, settings.BANK_PROXY_URL,
+                    tools_hosts, verify_hosts)
+
+
+def build_registry():
+    """
+        按setting配置创建商户表
+    """
+    default = default_merchant()
+    merchants = []
+    for merchant_id, conf in getattr(settings, "CMMC_MERCHANTS", {}).items():
+        merchants.append(Merchant(merchant_id, conf.get("POS_ID", default.pos_id),
+                                  conf.get("BRANCH_ID", default.branch_id), conf.get("USER_ID", default.user_id),
+                                  conf.get("USER_PASSWORD", default.user_password),
+                                  conf.get("PUBLIC_KEY", default.public_key), conf.get("PROXY_URL", default.proxy_url),
+                                  conf.get("TOOLS_HOSTS") or default.tools_router.hosts,
+                                  conf.get("VERIFY_HOSTS") or default.verify_router.hosts))
+    return MerchantRegistry(default, merchants)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def merchant_registry():
+    """
+        全局商户表，首次使用时创建，相关setting变化(如override_settings)时重建
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = build_registry()
+    return _registry
+
+
+def _reset_registry(setting, **kwargs):
+    global _registry
+    if setting.startswith("BANK_") or setting in ("CMMC_MERCHANTS", "CMMC_TOOLS_HOSTS", "CMMC_VERIFY_HOSTS"):
+        with _registry_lock:
+            _registry = None
+
+
+setting_changed.connect(_reset_registry)
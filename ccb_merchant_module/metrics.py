@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行交易的耗时和错误统计
+    按交易码(5W1001-5W1004、530550聚合二维码、verify验签)和阶段记录耗时直方图，按结果记录计数：
+        阶段：connect 建立连接, send 发送, recv 接收, parse 解析应答, http 建行网关HTTP请求, total 整个交易
+        结果：银行RETURN_CODE(成功为000000)、验签Y/N，或异常分类(timeout, deadline, circuit_open, connection,
+              pool_timeout, sn_mismatch, 其他异常类名)
+    @@导出：
+        api/metrics 返回Prometheus文本格式(同时包含连接池、HTTP会话、熔断器和查询结果缓存的统计)；
+        CMMC_METRICS_SINKS配置的函数在每次记录时被调用：sink(kind, tx_code, name, value)，
+            kind为"observe"(name为阶段, value为秒)或"count"(name为结果, value为1)，用于转发到statsd等，须快速返回。
+    @@调用：
+        with metrics().timer("5W1002", "parse"):
+            ...
+        metrics().count("5W1002", "000000")
+    @@setting配置(均可选)：
+        CMMC_METRICS_ENABLED = True             # 是否记录
+        CMMC_METRICS_BUCKETS = None             # 直方图分桶上界(秒)，默认DEFAULT_BUCKETS
+        CMMC_METRICS_SINKS = ()                 # sink函数路径列表，如("myapp.metrics.statsd_sink",)
+        CMMC_METRICS_ALLOWED_IPS = None         # 允许访问api/metrics的IP列表，None时只允许本机(METRICS_LOCAL_IPS)；
+                                                # 登录的staff用户不受IP限制
+"""
+import time
+import socket
+import bisect
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# 交易码
+TX_LOGIN = "5W1001"
+TX_QUERY_PAY = "5W1002"
+TX_QUERY_REFUND = "5W1003"
+TX_REFUND = "5W1004"
+TX_QRCODE = "530550"
+TX_VERIFY = "verify"
+
+# CMMC_METRICS_ALLOWED_IPS未配置时允许访问api/metrics的地址(统计中包含银行客户端地址，默认不公开)
+METRICS_LOCAL_IPS = ("127.0.0.1", "::1")
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def classify_error(ex):
+    """
+        异常分类，作为计数的结果标签
+    """
+    from tcp_pool import PoolTimeoutError
+    from request_sn import RequestSnError
+    from resilience import CircuitOpenError, DeadlineExceeded
+    if isinstance(ex, PoolTimeoutError):
+        return "pool_timeout"
+    if isinstance(ex, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(ex, DeadlineExceeded):
+        return "deadline"
+    if isinstance(ex, RequestSnError):
+        return "sn_mismatch"
+    if isinstance(ex, socket.timeout) or "Timeout" in type(ex).__name__:
+        return "timeout"
+    if isinstance(ex, (socket.error, IOError)):
+        return "connection"
+    return type(ex).__name__
+
+
+class Histogram(object):
+    """
+        固定分桶的直方图，counts不累计，导出时再累计
+    """
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry(object):
+    """
+        进程内的统计数据
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, sinks=(), enabled=True):
+        self.buckets = tuple(sorted(buckets))
+        self.sinks = list(sinks)
+        self.enabled = enabled
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, tx_code, phase, seconds):
+        if not self.enabled:
+            return
+        key = (tx_code, phase)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+        for sink in self.sinks:
+            sink("observe", tx_code, phase, seconds)
+
+    def count(self, tx_code, result):
+        if not self.enabled:
+            return
+        key = (tx_code, result)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+        for sink in self.sinks:
+            sink("count", tx_code, result, 1)
+
+    @contextmanager
+    def timer(self, tx_code, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(tx_code, phase, time.time() - start)
+
+    def snapshot(self):
+        """
+            {"histograms": {(tx_code, phase): {"count", "sum", "buckets": [(上界, 累计数)]}},
+             "counters": {(tx_code, result): 次数}}
+        """
+        with self._lock:
+            histograms = dict((key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items())
+            counters = dict(self._counters)
+        result = {}
+        for key, (counts, total, count) in histograms.items():
+            cumulative, buckets = 0, []
+            for bound, value in zip(self.buckets + (float("inf"),), counts):
+                cumulative += value
+                buckets.append((bound, cumulative))
+            result[key] = {"count": count, "sum": total, "buckets": buckets}
+        return {"histograms": result, "counters": counters}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def label_value(value):
+    return u"{0}".format(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def render_prometheus(registry, collectors=True):
+    """
+        Prometheus文本格式(text/plain; version=0.0.4)
+    """
+    snapshot = registry.snapshot()
+    lines = ["# HELP cmmc_tx_phase_seconds Bank transaction phase latency in seconds.",
+             "# TYPE cmmc_tx_phase_seconds histogram"]
+    for (tx_code, phase), data in sorted(snapshot["histograms"].items()):
+        labels = u"tx_code=\"{0}\",phase=\"{1}\"".format(label_value(tx_code), label_value(phase))
+        for bound, value in data["buckets"]:
+            lines.append(u"cmmc_tx_phase_seconds_bucket{{{0},le=\"{1}\"}} {2}".format(labels, format_bound(bound),
+                                                                                     value))
+        lines.append(u"cmmc_tx_phase_seconds_sum{{{0}}} {1!r}".format(labels, data["sum"]))
+        lines.append(u"cmmc_tx_phase_seconds_count{{{0}}} {1}".format(labels, data["count"]))
+    lines.extend(["# HELP cmmc_tx_total Bank transactions by result (RETURN_CODE or error class).",
+                  "# TYPE cmmc_tx_total counter"])
+    for (tx_code, result), value in sorted(snapshot["counters"].items()):
+        lines.append(u"cmmc_tx_total{{tx_code=\"{0}\",result=\"{1}\"}} {2}".format(label_value(tx_code),
+                                                                                  label_value(result), value))
+    if collectors:
+        from tcp_pool import pool_stats
+        from http_session import http_stats
+        from resilience import breaker_states, STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN
+        from query_cache import query_cache, QUERY_ACTIONS
+        lines.extend(["# HELP cmmc_pool Bank tools connection pool statistics.", "# TYPE cmmc_pool gauge"])
+        for endpoint, stats in sorted(pool_stats().items()):
+            for name, value in sorted(stats.items()):
+                lines.append(u"cmmc_pool{{endpoint=\"{0}\",stat=\"{1}\"}} {2}".format(label_value(endpoint),
+                                                                                     name, value))
+        lines.extend(["# HELP cmmc_http CCB gateway HTTP session statistics.", "# TYPE cmmc_http gauge"])
+        for name, value in sorted(http_stats().items()):
+            lines.append(u"cmmc_http{{stat=\"{0}\"}} {1!r}".format(name, value))
+        cache = query_cache()
+        if cache is not None:
+            cache_stats = cache.stats()
+            lines.extend(["# HELP cmmc_query_cache QUERY_PAY/QUERY_REFUND result cache statistics.",
+                          "# TYPE cmmc_query_cache gauge"])
+            for action in QUERY_ACTIONS:
+                for name, value in sorted(cache_stats[action].items()):
+                    lines.append(u"cmmc_query_cache{{action=\"{0}\",stat=\"{1}\"}} {2!r}".format(action, name, value))
+            lines.append(u"cmmc_query_cache{{stat=\"invalidated\"}} {0}".format(cache_stats["invalidated"]))
+        states = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+        breakers = sorted(breaker_states().items())
+        lines.extend(["# HELP cmmc_circuit_state Circuit breaker state (0 closed, 1 half open, 2 open).",
+                      "# TYPE cmmc_circuit_state gauge"])
+        for endpoint, stats in breakers:
+            lines.append(u"cmmc_circuit_state{{endpoint=\"{0}\"}} {1}".format(label_value(endpoint),
+                                                                              states[stats["state"]]))
+        lines.extend(["# HELP cmmc_circuit Circuit breaker counters.", "# TYPE cmmc_circuit counter"])
+        for endpoint, stats in breakers:
+            for name in ("opened", "rejected", "failures"):
+                lines.append(u"cmmc_circuit{{endpoint=\"{0}\",stat=\"{1}\"}} {2}".format(label_value(endpoint),
+                                                                                          name, stats[name]))
+    return u"\n".join(lines) + u"\n"
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def metrics():
+    """
+        按setting配置创建的全局统计对象
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                sinks = [import_string(path) if isinstance(path, basestring) else path
+                         for path in getattr(settings, "CMMC_METRICS_SINKS", ())]
+                _registry = MetricsRegistry(buckets=getattr(settings, "CMMC_METRICS_BUCKETS", None) or
+                                            DEFAULT_BUCKETS, sinks=sinks,
+                                            enabled=getattr(settings, "CMMC_METRICS_ENABLED", True))
+    return _registry
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+订单支付通知
+    收银台页面等待订单支付结果时，请求按订单号登记等待(Waiter)，mark_order_paid/mark_orders_paid在事务提交后调用
+    notify唤醒等待该订单的请求；等待者被唤醒后重新读取订单状态，不需要反复轮询，也不需要请求银行。
+    等待者应先登记再读取订单状态，读取之后提交的通知不会丢失。
+    同一订单同时超时的等待者通过fallback()只执行一次银行查询(本进程内)，其他等待者共享结果。
+    @@后端：
+        local: 只唤醒本进程内的等待者
+        django: notify同时在django cache中写入已支付标记，其他worker的等待者每CMMC_PAY_WAIT_CHECK_INTERVAL秒检查一次，
+                多个worker部署时使用
+    @@调用：
+        with payment_notifier().waiter(order_code) as waiter:
+            if waiter is None:      # 等待者已满
+                ...
+            status = 读取订单状态
+            notified = waiter.wait(timeout)
+    @@setting配置(均可选)：
+        CMMC_PAY_WAIT_BACKEND = "local"             # "local"或"django"
+        CMMC_PAY_WAIT_TIMEOUT = 25                  # api/pay_status默认和最长等待时间(秒)
+        CMMC_PAY_WAIT_MAX_WAITERS = 1000            # 本进程同时等待的请求数上限，超过时立即返回当前状态
+        CMMC_PAY_WAIT_CHECK_INTERVAL = 1            # django后端检查其他worker通知的间隔(秒)
+        CMMC_PAY_WAIT_ALIAS = "default"             # django后端使用的cache名称
+"""
+import time
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from cache_backends import DjangoCacheBackend
+
+
+class DjangoPaidBackend(DjangoCacheBackend):
+    """
+        django cache中的已支付标记
+    """
+    Prefix = "cmmc:paid:"
+
+    def mark(self, order_codes, ttl):
+        self.cache.set_many(dict((self.Prefix + code, 1) for code in order_codes), ttl)
+
+
+class Flight(object):
+    """
+        正在执行的fallback调用
+    """
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Waiter(object):
+    """
+        一个请求对一个订单的等待
+    """
+
+    def __init__(self, notifier, order_code):
+        self.notifier = notifier
+        self.order_code = order_code
+        self._event = notifier._register(order_code)
+
+    def wait(self, timeout):
+        """
+            等待通知，返回True 收到通知, False 超时
+        """
+        notifier = self.notifier
+        deadline = time.time() + timeout
+        notified = False
+        while not notified:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            interval = min(remaining, notifier.check_interval) if notifier.backend is not None else remaining
+            notified = self._event.wait(interval) or \
+                (notifier.backend is not None and bool(notifier.backend.get(self.order_code)))
+        notifier._count("notified" if notified else "timeouts")
+        return notified
+
+    def close(self):
+        if self._event is not None:
+            self.notifier._unregister(self.order_code, self._event)
+            self._event = None
+
+
+class PaymentNotifier(object):
+    """
+        按订单号唤醒等待支付结果的请求
+    """
+
+    def __init__(self, backend=None, max_waiters=1000, check_interval=1, ttl=120):
+        self.backend = backend
+        self.max_waiters = max_waiters
+        self.check_interval = check_interval
+        self.ttl = ttl
+        # {订单号: [Event, 等待者数]}
+        self._events = {}
+        self._waiters = 0
+        # {订单号: Flight}
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {"waits": 0, "notified": 0, "timeouts": 0, "rejected": 0, "notifications": 0,
+                       "fallbacks": 0, "fallbacks_shared": 0}
+
+    def _register(self, order_code):
+        with self._lock:
+            entry = self._events.get(order_code)
+            if entry is None:
+                entry = self._events[order_code] = [threading.Event(), 0]
+            entry[1] += 1
+            self._waiters += 1
+            return entry[0]
+
+    def _unregister(self, order_code, event):
+        with self._lock:
+            self._waiters -= 1
+            entry = self._events.get(order_code)
+            if entry is not None and entry[0] is event:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._events[order_code]
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    @contextmanager
+    def waiter(self, order_code):
+        """
+            登记等待，等待者已满时返回None
+        """
+        with self._lock:
+            full = self._waiters >= self.max_waiters
+            self._stats["rejected" if full else "waits"] += 1
+        if full:
+            yield None
+            return
+        waiter = Waiter(self, order_code)
+        try:
+            yield waiter
+        finally:
+            waiter.close()
+
+    def notify(self, order_codes):
+        """
+            订单状态已变化，唤醒等待这些订单的请求
+        """
+        order_codes = list(order_codes)
+        if self.backend is not None and order_codes:
+            self.backend.mark(order_codes, self.ttl)
+        with self._lock:
+            self._stats["notifications"] += len(order_codes)
+            # 已唤醒的Event从表中移除，之后登记的等待者使用新的Event
+            events = [self._events.pop(code)[0] for code in order_codes if code in self._events]
+        for event in events:
+            event.set()
+
+    def fallback(self, order_code, func):
+        """
+            同一订单同时只执行一次func()，其他调用者等待并共享其返回值或异常；
+            func为银行查询，耗时受CMMC_BANK_DEADLINE限制，等待者不会无限等待
+        """
+        with self._lock:
+            flight = self._flights.get(order_code)
+            leader = flight is None
+            if leader:
+                flight = self._flights[order_code] = Flight()
+            self._stats["fallbacks" if leader else "fallbacks_shared"] += 1
+        if leader:
+            try:
+                flight.result = func()
+            except Exception as ex:
+                flight.error = ex
+            finally:
+                with self._lock:
+                    del self._flights[order_code]
+                flight.event.set()
+        else:
+            flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["waiters"] = self._waiters
+        return stats
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def pay_wait_timeout():
+    return getattr(settings, "CMMC_PAY_WAIT_TIMEOUT", 25)
+
+
+def payment_notifier():
+    """
+        按setting配置创建的全局支付通知
+    """
+    global _notifier
+    if _notifier is None:
+        with _notifier_lock:
+            if _notifier is None:
+                backend = None
+                if getattr(settings, "CMMC_PAY_WAIT_BACKEND", "local") == "django":
+                    backend = DjangoPaidBackend(getattr(settings, "CMMC_PAY_WAIT_ALIAS", "default"))
+                _notifier = PaymentNotifier(backend,
+                                            max_waiters=getattr(settings, "CMMC_PAY_WAIT_MAX_WAITERS", 1000),
+                                            check_interval=getattr(settings, "CMMC_PAY_WAIT_CHECK_INTERVAL", 1),
+                                            ttl=pay_wait_timeout() * 2 + 60)
+    return _notifier
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+未支付订单的后台对账轮询
+    银行回调丢失时订单一直停留在ORDER_CHOICE_0，本模块定期扫描未支付订单并通过QUERY_PAY查询银行状态：
+        新订单查询频繁，之后按指数退避拉长间隔(CMMC_POLL_MIN_INTERVAL * CMMC_POLL_BACKOFF ** n，
+        不超过CMMC_POLL_MAX_INTERVAL)；
+        银行返回终态(成功/已退款)或本地订单已不是未支付状态时停止轮询，银行返回支付成功时将订单标记为已支付；
+        同时在途的银行请求数不超过CMMC_POLL_CONCURRENCY，避免压垮银行客户端。
+    调度使用按下次查询时间排序的堆，数万个未支付订单时每次调度的开销仍为O(log n)。
+    @@调用：
+        python manage.py cmmc_poll_pending             # 常驻运行
+        python manage.py cmmc_poll_pending --once      # 查询一轮后退出
+    @@setting配置(均可选)：
+        CMMC_POLL_CONCURRENCY = 4           # 同时在途的QUERY_PAY数量
+        CMMC_POLL_MIN_INTERVAL = 30         # 新订单的查询间隔(秒)
+        CMMC_POLL_MAX_INTERVAL = 3600       # 最大查询间隔(秒)
+        CMMC_POLL_BACKOFF = 2               # 退避倍数
+        CMMC_POLL_MAX_AGE = 172800          # 超过该时间(秒)的订单不再轮询
+        CMMC_POLL_SCAN_INTERVAL = 60        # 重新扫描未支付订单的间隔(秒)
+        CMMC_ORDER_CREATE_TIME = None       # 自定义订单创建时间字段名，未配置时以首次扫描到的时间计算订单年龄，
+                                            # 超过CMMC_POLL_MAX_AGE的订单记入已过期集合，之后的扫描不再加入调度
+"""
+import math
+import time
+import heapq
+import logging
+import datetime
+import threading
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from utils import FLAG_NO, ORDER_CHOICE_0, ORDER_STATUS_SUCCESS, ORDER_STATUS_REFUND_PART, ORDER_STATUS_REFUND
+
+logger = logging.getLogger(__name__)
+
+# 轮询使用的系统用户标识
+POLLER_USER = "cmmc_pending_poller"
+
+# 银行流水的终态
+TERMINAL_STATUSES = frozenset(str(status[0]) for status in (ORDER_STATUS_SUCCESS, ORDER_STATUS_REFUND_PART,
+                                                           ORDER_STATUS_REFUND))
+
+
+def order_age(created):
+    """
+        订单年龄(秒)，兼容USE_TZ的aware datetime
+    """
+    now = timezone.now() if timezone.is_aware(created) else datetime.datetime.now()
+    return max(0, (now - created).total_seconds())
+
+
+class PendingOrderPoller(object):
+    """
+        未支付订单轮询调度
+    """
+
+    def __init__(self, concurrency=4, min_interval=30, max_interval=3600, backoff=2, max_age=172800,
+                 scan_interval=60):
+        self.concurrency = concurrency
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_age = max_age
+        self.scan_interval = scan_interval
+        self._heap = []
+        # order_code -> [退避级数, 订单起始时间]
+        self._orders = {}
+        # 超过max_age不再轮询的订单号，未配置创建时间字段时扫描结果仍包含这些订单
+        self._expired = set()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(concurrency)
+        self._pool = ThreadPool(concurrency)
+        self._next_scan = 0
+        self._stats = {"queries": 0, "paid": 0, "terminal": 0, "errors": 0, "expired": 0}
+
+    def interval(self, level):
+        return min(self.max_interval, self.min_interval * self.backoff ** level)
+
+    def initial_level(self, age):
+        """
+            按订单年龄确定起始退避级数，重启后老订单不会被当作新订单频繁查询
+        """
+        if age <= self.min_interval or self.backoff <= 1:
+            return 0
+        return int(math.log(float(age) / self.min_interval, self.backoff))
+
+    def scan(self, now=None):
+        """
+            扫描未支付订单，新订单加入调度，已不是未支付状态的订单移出
+        """
+        import ccb_merchant_proxy as agents
+        now = now or time.time()
+        create_field = getattr(settings, "CMMC_ORDER_CREATE_TIME", None)
+        fields = [settings.CMMC_ORDER_CODE_CONF] + ([create_field] if create_field else [])
+        queryset = agents.Order.objects.filter(**{settings.CMMC_ORDER_DEL_FLAG: FLAG_NO,
+                                                  settings.CMMC_ORDER_PAY_STATUS: ORDER_CHOICE_0[0]})
+        if create_field and self.max_age:
+            queryset = queryset.filter(**{create_field + "__gte": timezone.now() -
+                                          datetime.timedelta(seconds=self.max_age)})
+        pending = set()
+        with self._lock:
+            for row in queryset.values_list(*fields).iterator():
+                code = row[0]
+                pending.add(code)
+                if code in self._orders or code in self._expired:
+                    continue
+                started = now
+                if create_field and row[1]:
+                    started = now - order_age(row[1])
+                level = self.initial_level(now - started)
+                self._orders[code] = [level, started]
+                heapq.heappush(self._heap, (now, code))
+            for code in list(self._orders):
+                if code not in pending and code not in self._in_flight:
+                    del self._orders[code]
+            # 已支付或已删除的过期订单不会再出现在扫描结果中
+            self._expired &= pending
+        self._next_scan = now + self.scan_interval
+        return len(pending)
+
+    def _query(self, code):
+        """
+            线程池中执行：查询银行，银行返回支付成功时标记订单已支付，返回(银行状态, 标记数, 异常)；
+            数据库操作都在这里完成，回调(_done)只处理调度状态
+        """
+        import ccb_merchant_proxy as agents
+        status, paid, error = None, 0, None
+        try:
+            status = agents.BankProxy(order_code=code, action="QUERY_PAY", user=POLLER_USER).proxy_bank()
+            if str(status) == str(ORDER_STATUS_SUCCESS[0]):
+                paid = agents.mark_orders_paid([code])
+        except Exception as ex:
+            # 标记失败时订单仍为未支付，按退避间隔重新查询
+            status, error = None, ex
+        finally:
+            close_old_connections()
+        return status, paid, error
+
+    def _done(self, code, status, paid, error):
+        """
+            在线程池的结果线程中执行，异常不能抛出，否则结果线程退出，之后的回调都不会执行
+        """
+        try:
+            with self._lock:
+                self._stats["queries"] += 1
+                self._in_flight.discard(code)
+                state = self._orders.get(code)
+                if error is not None:
+                    self._stats["errors"] += 1
+                elif status is not None and str(status) in TERMINAL_STATUSES:
+                    self._stats["paid"] += paid
+                    self._stats["terminal"] += 1
+                    self._orders.pop(code, None)
+                    return
+                if state is None:
+                    return
+                now = time.time()
+                if self.max_age and now - state[1] > self.max_age:
+                    self._stats["expired"] += 1
+                    self._orders.pop(code, None)
+                    self._expired.add(code)
+                    return
+                heapq.heappush(self._heap, (now + self.interval(state[0]), code))
+                state[0] += 1
+            if error is not None:
+                logger.debug(u"[pending poller]: query {0} failed: {1}".format(code, error))
+        except Exception as ex:
+            logger.error(u"[pending poller]: schedule {0} failed: {1}".format(code, ex))
+            with self._lock:
+                self._stats["errors"] += 1
+        finally:
+            self._slots.release()
+
+    def dispatch(self, now=None):
+        """
+            提交所有到期的订单查询，受并发数限制，返回提交的数量
+        """
+        now = now or time.time()
+        count = 0
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                _, code = heapq.heappop(self._heap)
+                if code not in self._orders or code in self._in_flight:
+                    continue
+                self._in_flight.add(code)
+            self._slots.acquire()
+            self._pool.apply_async(self._query, (code,), callback=lambda result, code=code: self._done(code, *result))
+            count += 1
+        return count
+
+    def next_due(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def run_once(self):
+        """
+            扫描并查询一轮，等待所有查询完成
+        """
+        self.scan()
+        self.dispatch()
+        for _ in range(self.concurrency):
+            self._slots.acquire()
+        for _ in range(self.concurrency):
+            self._slots.release()
+        return self.stats()
+
+    def run_forever(self):
+        while True:
+            now = time.time()
+            if now >= self._next_scan:
+                try:
+                    self.scan(now)
+                except Exception as ex:
+                    logger.error(u"[pending poller]: scan failed: {0}".format(ex))
+                finally:
+                    close_old_connections()
+            self.dispatch()
+            next_due = self.next_due() or self._next_scan
+            time.sleep(max(0.05, min(next_due, self._next_scan) - time.time()))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({"tracked": len(self._orders), "in_flight": len(self._in_flight)})
+        return stats
+
+
+def pending_poller(**kwargs):
+    """
+        按setting配置创建轮询对象，kwargs覆盖配置
+    """
+    options = {"concurrency": getattr(settings, "CMMC_POLL_CONCURRENCY", 4),
+               "min_interval": getattr(settings, "CMMC_POLL_MIN_INTERVAL", 30),
+               "max_interval": getattr(settings, "CMMC_POLL_MAX_INTERVAL", 3600),
+               "backoff": getattr(settings, "CMMC_POLL_BACKOFF", 2),
+               "max_age": getattr(settings, "CMMC_POLL_MAX_AGE", 172800),
+               "scan_interval": getattr(settings, "CMMC_POLL_SCAN_INTERVAL", 60)}
+    options.update(dict((key, value) for key, value in kwargs.items() if value is not None))
+    return PendingOrderPoller(**options)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+支付二维码(PAY)结果缓存
+    同一未支付订单重复请求二维码(刷新页面、多设备打开)时，直接返回缓存的QRURL/PNG数据，
+    不再请求建行网关和重新生成图片。
+    缓存key由订单号、支付金额和MAC计算，订单金额变化时自动失效。
+    @@后端：
+        LocalQRCodeBackend: 进程内缓存，TTL过期 + LRU淘汰 + 内存上限(见cache_backends.LocalTTLBackend)
+        DjangoQRCodeBackend: 使用django cache，多个worker共享
+        也可以配置为自定义后端类的路径，需实现get(key)/set(key, value, ttl)/delete(key)
+    @@setting配置(均可选)：
+        CMMC_QRCODE_CACHE_BACKEND = "local"         # "local", "django", 或后端类路径，None表示不缓存
+        CMMC_QRCODE_CACHE_TTL = 600                 # 缓存时间(秒)，不应超过建行二维码的有效期
+        CMMC_QRCODE_CACHE_MAX_ENTRIES = 1000        # local后端最大条目数
+        CMMC_QRCODE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # local后端最大占用字节数
+        CMMC_QRCODE_CACHE_ALIAS = "default"         # django后端使用的cache名称
+"""
+import hashlib
+import threading
+from django.conf import settings
+from django.utils.module_loading import import_string
+from cache_backends import LocalTTLBackend, DjangoCacheBackend
+
+
+class LocalQRCodeBackend(LocalTTLBackend):
+    """
+        进程内LRU缓存，按二维码数据大小计算内存占用
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=32 * 1024 * 1024):
+        super(LocalQRCodeBackend, self).__init__(max_entries=max_entries, max_bytes=max_bytes)
+
+    def size(self, value):
+        return len(value.get("png") or "") + len(value.get("qrurl") or "")
+
+
+class DjangoQRCodeBackend(DjangoCacheBackend):
+    """
+        django cache后端
+    """
+    Prefix = "cmmc:qrcode:"
+
+
+class QRCodeCache(object):
+    """
+        二维码缓存，value为{"qrurl": 二维码内容, "png": 图片数据}
+    """
+
+    def __init__(self, backend, ttl=600):
+        self.backend = backend
+        self.ttl = ttl
+        self._stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(order_code, payment, mac):
+        raw = u"{0}|{1}|{2}".format(order_code, payment, mac).encode("UTF-8")
+        return hashlib.md5(raw).hexdigest()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        self._stats["hits" if value else "misses"] += 1
+        return value
+
+    def set(self, key, qrurl=None, png=None):
+        self.backend.set(key, {"qrurl": qrurl, "png": png}, self.ttl)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def stats(self):
+        stats = dict(self._stats)
+        if hasattr(self.backend, "stats"):
+            stats.update(self.backend.stats())
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def qrcode_cache():
+    """
+        按setting配置创建的全局二维码缓存，未启用时返回None
+    """
+    global _cache
+    if _cache is None:
+        backend_conf = getattr(settings, "CMMC_QRCODE_CACHE_BACKEND", "local")
+        if not backend_conf:
+            return None
+        with _cache_lock:
+            if _cache is None:
+                if backend_conf == "local":
+                    backend = LocalQRCodeBackend(
+                        max_entries=getattr(settings, "CMMC_QRCODE_CACHE_MAX_ENTRIES", 1000),
+                        max_bytes=getattr(settings, "CMMC_QRCODE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+                elif backend_conf == "django":
+                    backend = DjangoQRCodeBackend(getattr(settings, "CMMC_QRCODE_CACHE_ALIAS", "default"))
+                else:
+                    backend = import_string(backend_conf)()
+                _cache = QRCodeCache(backend, ttl=getattr(settings, "CMMC_QRCODE_CACHE_TTL", 600))
+    return _cache
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+批量预生成支付二维码
+    开售时大量订单同时创建，每个客户第一次PAY都要串行执行MAC、两次建行网关请求和PNG生成。
+    QRCodeWarmer: 订单一次查询加载(BankProxy.for_orders)，网关请求在有界线程池中执行，
+        得到QRURL后立即写入二维码缓存，同时交给进程池生成PNG(CPU密集，不受GIL限制)，生成后写入缓存；
+        客户第一次请求pay_qrcode时直接命中缓存，不再等待银行。
+    缓存key包含订单金额和MAC，预生成后金额变化的订单会自动重新请求银行。
+    需要启用二维码缓存(CMMC_QRCODE_CACHE_BACKEND)。local后端只在执行预生成的进程内有效，
+    cmmc_warm_qrcode命令在单独的进程中运行，要求使用共享的后端(django或自定义后端)。
+    @@调用：
+        summary = QRCodeWarmer(concurrency=8, processes=4).run(order_codes)
+        python manage.py cmmc_warm_qrcode --file codes.txt
+    @@返回：
+        summary: 总数、成功、失败、跳过(已缓存)、耗时、吞吐量(个/秒)、网关延迟p50/p95/p99/max(秒)
+"""
+import time
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from django.db import close_old_connections
+from qrcode_cache import qrcode_cache
+from utils import percentile
+
+logger = logging.getLogger(__name__)
+
+# 预生成二维码使用的系统用户标识
+WARMUP_USER = "cmmc_warm_qrcode"
+
+
+class QRCodeWarmer(object):
+    """
+        批量预生成支付二维码
+    """
+
+    def __init__(self, concurrency=8, processes=None, force=False, user=WARMUP_USER, merchant_id=None):
+        """
+            :param concurrency: 并发的网关请求数
+            :param processes: 生成PNG的进程数，None为CPU核数，0表示在当前进程中生成
+            :param force: 已缓存的订单也重新生成
+        """
+        self.concurrency = concurrency
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.force = force
+        self.user = user
+        self.merchant_id = merchant_id
+
+    def load_proxies(self, codes):
+        """
+            一次查询构造全部订单的PAY代理，返回(代理列表, 不存在的订单号列表)
+        """
+        import ccb_merchant_proxy as agents
+        try:
+            return agents.BankProxy.for_orders(codes, action="PAY", user=self.user, merchant_id=self.merchant_id), []
+        except agents.OrdersNotFoundError as ex:
+            logger.warning(u"[qrcode warmup]: {0}".format(ex))
+            return ex.proxies, ex.missing
+
+    def plan(self, proxies, cache):
+        """
+            计算缓存key，返回([(代理, MAC, 缓存key)], 已缓存数)
+        """
+        work, cached = [], 0
+        for proxy in proxies:
+            mac_hash = proxy.pay_mac()
+            key = proxy.qrcode_cache_key(mac_hash)
+            value = None if self.force else cache.backend.get(key)
+            if value and value.get("png"):
+                cached += 1
+            else:
+                work.append((proxy, mac_hash, key))
+        return work, cached
+
+    def _fetch(self, item):
+        """
+            线程池中执行：请求建行网关，返回(代理, 缓存key, QRURL, 延迟, 异常)
+        """
+        proxy, mac_hash, key = item
+        start = time.time()
+        try:
+            return proxy, key, proxy.pay_qrcode_url(mac_hash), time.time() - start, None
+        except Exception as ex:
+            return proxy, key, None, time.time() - start, ex
+        finally:
+            close_old_connections()
+
+    def run(self, order_codes, progress=None):
+        """
+            预生成二维码，返回summary
+            :param progress: 可选，每完成一个订单调用progress(code, result, error)
+        """
+        import ccb_merchant_proxy as agents
+        from ccb_merchant_proxy import qrcode_generate
+        cache = qrcode_cache()
+        code_field = agents.order_code_field()
+        if cache is None:
+            raise agents.QRCodeError(u"未启用二维码缓存(CMMC_QRCODE_CACHE_BACKEND)")
+        codes = list(dict.fromkeys(code for code in order_codes if code))
+        started = time.time()
+        proxies, missing = self.load_proxies(codes)
+        work, cached = self.plan(proxies, cache)
+        counts = {"success": 0, "failed": len(missing), "skipped": cached}
+        latencies = []
+        if progress:
+            for code in missing:
+                progress(code, "failed", agents.OrderError(u"订单号错误"))
+
+        def done(code, result, error=None):
+            counts[result] += 1
+            if progress:
+                progress(code, result, error)
+
+        # 在启动网关请求线程之前fork进程池(订单已经加载，子进程只执行qrcode_generate)
+        processes = multiprocessing.Pool(self.processes) if self.processes > 0 and work else None
+        threads = ThreadPool(self.concurrency)
+        rendering = []
+        try:
+            for proxy, key, qrurl, latency, error in threads.imap_unordered(self._fetch, work):
+                latencies.append(latency)
+                if error is not None:
+                    done(getattr(proxy.order, code_field), "failed", error)
+                    continue
+                # 二维码内容先写入缓存，PNG生成完成前的客户请求只需在本地生成图片
+                cache.set(key, qrurl=qrurl)
+                if processes is None:
+                    rendering.append((proxy, key, qrurl, qrcode_generate(qrurl)))
+                else:
+                    rendering.append((proxy, key, qrurl, processes.apply_async(qrcode_generate, (qrurl,))))
+            for proxy, key, qrurl, png in rendering:
+                try:
+                    if processes is not None:
+                        png = png.get()
+                except Exception as ex:
+                    done(getattr(proxy.order, code_field), "failed", ex)
+                    continue
+                cache.set(key, qrurl=qrurl, png=png)
+                done(getattr(proxy.order, code_field), "success")
+        finally:
+            threads.close()
+            threads.join()
+            if processes is not None:
+                processes.close()
+                processes.join()
+        elapsed = time.time() - started
+        latencies.sort()
+        return {"total": len(codes), "success": counts["success"], "failed": counts["failed"],
+                "skipped": counts["skipped"], "elapsed": elapsed,
+                "throughput": (counts["success"] + counts["failed"]) / elapsed if elapsed > 0 else 0.0,
+                "latency_p50": percentile(latencies, 50), "latency_p95": percentile(latencies, 95),
+                "latency_p99": percentile(latencies, 99), "latency_max": latencies[-1] if latencies else 0.0}
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+QUERY_PAY / QUERY_REFUND 查询结果缓存
+    银行已返回终态(成功、已部分退款、已全额退款)的订单在较长时间内直接返回缓存的状态，不再请求银行；
+    其他状态(失败、待银行确认)只缓存很短时间，避免同一时刻的重复查询。
+    缓存值包含订单金额，金额变化时视为未命中；查询异常不缓存。
+    @@失效：
+        bank_refund成功、回调验签通过(verify_callback，同步和队列两种方式)时删除该订单的两种查询结果。
+        local后端(以及使用locmem等本进程cache的django后端)只在本进程内失效，其他worker可能在终态TTL内
+        返回退款前的状态，因此只有共享后端才按CMMC_QUERY_CACHE_TERMINAL_TTL缓存终态，
+        本进程后端的终态也只缓存CMMC_QUERY_CACHE_PENDING_TTL秒；多个worker部署时应使用django后端(共享cache)。
+    @@统计：
+        query_cache().stats()按交易返回hits/misses/hit_ratio，api/metrics导出cmmc_query_cache。
+    @@setting配置(均可选)：
+        CMMC_QUERY_CACHE_BACKEND = "local"          # "local", "django", 或后端类路径，None表示不缓存
+        CMMC_QUERY_CACHE_TERMINAL_TTL = 3600        # 终态的缓存时间(秒)，只对共享后端生效
+        CMMC_QUERY_CACHE_PENDING_TTL = 5            # 非终态的缓存时间(秒)，0表示不缓存
+        CMMC_QUERY_CACHE_MAX_ENTRIES = 10000        # local后端最大条目数
+        CMMC_QUERY_CACHE_ALIAS = "default"          # django后端使用的cache名称
+"""
+import functools
+import threading
+from django.conf import settings
+from django.utils.module_loading import import_string
+from cache_backends import LocalTTLBackend, DjangoCacheBackend, is_local_cache
+from utils import ORDER_STATUS_SUCCESS, ORDER_STATUS_REFUND_PART, ORDER_STATUS_REFUND
+
+QUERY_ACTIONS = ("QUERY_PAY", "QUERY_REFUND")
+
+TERMINAL_STATUSES = frozenset([str(ORDER_STATUS_SUCCESS[0]), str(ORDER_STATUS_REFUND_PART[0]),
+                               str(ORDER_STATUS_REFUND[0])])
+
+
+class DjangoQueryBackend(DjangoCacheBackend):
+    """
+        django cache后端
+    """
+    Prefix = "cmmc:query:"
+
+
+class QueryResultCache(object):
+    """
+        查询结果缓存，value为{"status": 银行状态, "amount": 订单金额}
+    """
+
+    def __init__(self, backend, terminal_ttl=3600, pending_ttl=5):
+        self.backend = backend
+        self.terminal_ttl = terminal_ttl
+        self.pending_ttl = pending_ttl
+        self._lock = threading.Lock()
+        self._stats = dict((action, {"hits": 0, "misses": 0}) for action in QUERY_ACTIONS)
+        self._invalidated = 0
+
+    @staticmethod
+    def make_key(action, order_code):
+        return u"{0}|{1}".format(action, order_code).encode("UTF-8")
+
+    def get(self, action, order_code, amount):
+        value = self.backend.get(self.make_key(action, order_code))
+        hit = value is not None and value.get("amount") == u"{0}".format(amount)
+        with self._lock:
+            self._stats[action]["hits" if hit else "misses"] += 1
+        return value["status"] if hit else None
+
+    def set(self, action, order_code, amount, status):
+        ttl = self.terminal_ttl if str(status) in TERMINAL_STATUSES else self.pending_ttl
+        if ttl > 0:
+            self.backend.set(self.make_key(action, order_code), {"status": status, "amount": u"{0}".format(amount)},
+                             ttl)
+
+    def invalidate(self, order_code):
+        for action in QUERY_ACTIONS:
+            self.backend.delete(self.make_key(action, order_code))
+        with self._lock:
+            self._invalidated += 1
+
+    def stats(self):
+        """
+            {"QUERY_PAY": {"hits", "misses", "hit_ratio"}, "QUERY_REFUND": {...}, "invalidated": 次数}
+        """
+        with self._lock:
+            stats = dict((action, dict(counts)) for action, counts in self._stats.items())
+            stats["invalidated"] = self._invalidated
+        for action in QUERY_ACTIONS:
+            total = stats[action]["hits"] + stats[action]["misses"]
+            stats[action]["hit_ratio"] = float(stats[action]["hits"]) / total if total else 0.0
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def query_cache():
+    """
+        按setting配置创建的全局查询结果缓存，未启用时返回None
+    """
+    global _cache
+    if _cache is None:
+        backend_conf = getattr(settings, "CMMC_QUERY_CACHE_BACKEND", "local")
+        if not backend_conf:
+            return None
+        with _cache_lock:
+            if _cache is None:
+                alias = getattr(settings, "CMMC_QUERY_CACHE_ALIAS", "default")
+                shared = True
+                if backend_conf == "local":
+                    # 缓存值很小，只按条目数淘汰
+                    backend = LocalTTLBackend(max_entries=getattr(settings, "CMMC_QUERY_CACHE_MAX_ENTRIES", 10000))
+                    shared = False
+                elif backend_conf == "django":
+                    backend = DjangoQueryBackend(alias)
+                    shared = not is_local_cache(alias)
+                else:
+                    backend = import_string(backend_conf)()
+                pending_ttl = getattr(settings, "CMMC_QUERY_CACHE_PENDING_TTL", 5)
+                terminal_ttl = getattr(settings, "CMMC_QUERY_CACHE_TERMINAL_TTL", 3600)
+                if not shared:
+                    # 失效不能通知其他worker，终态不长时间缓存
+                    terminal_ttl = min(terminal_ttl, pending_ttl)
+                _cache = QueryResultCache(backend, terminal_ttl=terminal_ttl, pending_ttl=pending_ttl)
+    return _cache
+
+
+def invalidate_query(order_code):
+    cache = query_cache()
+    if cache is not None:
+        cache.invalidate(order_code)
+
+
+def memoize_query(action):
+    """
+        装饰器：BankProxy.bank_query_pay/bank_query_refund先查缓存，未命中时请求银行并缓存返回的状态
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self):
+            cache = query_cache()
+            if cache is None:
+                return method(self)
+            order_code = getattr(self.order, settings.CMMC_ORDER_CODE_CONF)
+            amount = getattr(self.order, settings.CMMC_ORDER_PAY_AMOUNT)
+            status = cache.get(action, order_code, amount)
+            if status is not None:
+                return status
+            status = method(self)
+            cache.set(action, order_code, amount, status)
+            return status
+        return wrapper
+    return decorator
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行流水与订单表对账
+    Reconciler: 按时间段流式读取银行支付/退款流水(BankProxy.query_range，逐页iterparse)，
+        每chunk_size条记录按CMMC_ORDER_CODE_CONF批量加载订单(values_list，一次IN查询)，按订单号做hash join，
+        比较金额和状态，差异逐行写入输出文件，内存占用只与chunk_size有关；
+        银行出现过的订单号写入临时sqlite文件，支付对账结束后再分批检查本地已支付但银行没有流水的订单。
+    @@差异类型：
+        missing_order   银行有流水，订单表中没有该订单(或已删除)
+        missing_bank    订单已支付(支付时间在对账时间段内)，银行没有支付流水(仅支付对账，需配置CMMC_ORDER_PAY_TIME)
+        amount          金额不一致
+        status          状态不一致：银行支付成功而订单未支付/已取消，或银行失败而订单已支付；
+                        银行已退款(utils.REFUND_DONE_STATUSES)而订单未退款，或银行退款失败而订单已退款
+        待银行确认的流水不比较。
+    @@自动修复(fix=True)：
+        只修复安全的情况：银行支付成功、金额一致、订单未支付，使用mark_orders_paid批量更新(条件UPDATE，
+        不会覆盖已变化的订单)；其他差异只记录。
+    @@输出：
+        每行一个json，{"type": 差异类型, "order": 订单号, "bank_amount", "order_amount", "bank_status",
+        "order_status", "fixed": 是否已修复}
+    @@调用：
+        summary = Reconciler(start, end, kind="PAY", output="recon.jsonl", fix=False).run()
+        python manage.py cmmc_reconcile --start 2017-01-01 --end 2017-01-31 --output recon.jsonl [--fix]
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import tempfile
+from django.conf import settings
+from django.db import close_old_connections
+from utils import (FLAG_NO, ORDER_CHOICE_0, ORDER_CHOICE_1, ORDER_CHOICE_2, ORDER_CHOICE_5, ORDER_CHOICE_6,
+                   ORDER_STATUS_FAIL, ORDER_STATUS_SUCCESS, ORDER_STATUS_REFUND, ORDER_STATUS_REFUND_PART,
+                   REFUND_DONE_STATUSES, REFUND_FAILED_STATUSES)
+
+logger = logging.getLogger(__name__)
+
+# 对账使用的系统用户标识
+RECONCILE_USER = "cmmc_reconcile"
+
+# 银行支付流水状态，退款流水状态见utils.REFUND_DONE_STATUSES/REFUND_FAILED_STATUSES
+BANK_PAID = frozenset([str(ORDER_STATUS_SUCCESS[0]), str(ORDER_STATUS_REFUND_PART[0]), str(ORDER_STATUS_REFUND[0])])
+BANK_FAILED = frozenset([str(ORDER_STATUS_FAIL[0])])
+# 本地订单状态
+ORDER_UNPAID = frozenset([ORDER_CHOICE_0[0], ORDER_CHOICE_1[0]])
+ORDER_REFUNDED = frozenset([ORDER_CHOICE_5[0], ORDER_CHOICE_6[0]])
+
+
+def to_cents(amount):
+    """
+        金额转换为分，无法解析时返回None
+    """
+    try:
+        return int(round(float(amount) * 100))
+    except (TypeError, ValueError):
+        return None
+
+
+def to_status(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class SeenCodes(object):
+    """
+        银行出现过的订单号，保存在临时sqlite文件中，不占用进程内存
+    """
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix="cmmc_reconcile_", suffix=".sqlite3")
+        os.close(fd)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE seen (code TEXT PRIMARY KEY)")
+
+    def add(self, codes):
+        self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((code,) for code in codes))
+
+    def missing(self, codes):
+        """
+            codes中不在表中的订单号
+        """
+        found = set()
+        # sqlite的参数个数上限为999
+        for index in range(0, len(codes), 900):
+            part = codes[index:index + 900]
+            found.update(row[0] for row in self.db.execute(
+                "SELECT code FROM seen WHERE code IN ({0})".format(",".join("?" * len(part))), part))
+        return [code for code in codes if code not in found]
+
+    def close(self):
+        self.db.close()
+        os.remove(self.path)
+
+
+class Reconciler(object):
+    """
+        按时间段对账，差异写入output
+    """
+
+    def __init__(self, start, end, kind="PAY", output="reconcile.jsonl", chunk_size=1000, fix=False,
+                 user=RECONCILE_USER, merchant_id=None):
+        self.start = start
+        self.end = end
+        self.kind = kind
+        self.output = output
+        self.chunk_size = chunk_size
+        self.fix = fix
+        self.user = user
+        self.merchant_id = merchant_id
+        self._fp = None
+        self._stats = {"bank_records": 0, "matched": 0, "pending": 0, "missing_order": 0, "missing_bank": 0,
+                       "amount": 0, "status": 0, "fixed": 0}
+
+    def write(self, kind, code, bank_amount=None, order_amount=None, bank_status=None, order_status=None,
+              fixed=False):
+        self._stats[kind] += 1
+        entry = {"type": kind, "order": code, "bank_amount": bank_amount, "order_amount": order_amount,
+                 "bank_status": bank_status, "order_status": order_status, "fixed": fixed}
+        self._fp.write(json.dumps(entry, default=str) + "\n")
+
+    def load_orders(self, codes):
+        """
+            一次查询加载一批订单，返回{订单号: (金额, 支付状态)}
+        """
+        import ccb_merchant_proxy as agents
+        code_field = agents.order_code_field()
+        rows = agents.Order.objects.filter(**{settings.CMMC_ORDER_DEL_FLAG: FLAG_NO, code_field + "__in": codes}) \
+            .values_list(code_field, settings.CMMC_ORDER_PAY_AMOUNT, settings.CMMC_ORDER_PAY_STATUS)
+        return dict((code, (amount, status)) for code, amount, status in rows)
+
+    def compare(self, record, order):
+        """
+            比较一条银行流水和订单，返回差异类型，一致返回None，不需要比较返回"pending"
+        """
+        bank_amount = record.payment_money if self.kind == "PAY" else record.refund_amount
+        order_amount, order_status = order
+        if to_cents(bank_amount) != to_cents(order_amount):
+            return "amount"
+        bank_status = str(record.status)
+        order_status = to_status(order_status)
+        if self.kind == "PAY":
+            if bank_status in BANK_PAID:
+                return "status" if order_status in ORDER_UNPAID else None
+            if bank_status in BANK_FAILED:
+                return "status" if order_status == ORDER_CHOICE_2[0] else None
+            return "pending"
+        if bank_status in REFUND_DONE_STATUSES:
+            return None if order_status in ORDER_REFUNDED else "status"
+        if bank_status in REFUND_FAILED_STATUSES:
+            return "status" if order_status == ORDER_CHOICE_6[0] else None
+        return "pending"
+
+    def join(self, records):
+        """
+            一批银行流水与订单做hash join
+        """
+        import ccb_merchant_proxy as agents
+        orders = self.load_orders(list(set(record.order for record in records)))
+        fixable = []
+        for record in records:
+            bank_amount = record.payment_money if self.kind == "PAY" else record.refund_amount
+            order = orders.get(record.order)
+            if order is None:
+                self.write("missing_order", record.order, bank_amount=bank_amount, bank_status=record.status)
+                continue
+            result = self.compare(record, order)
+            if result is None:
+                self._stats["matched"] += 1
+            elif result == "pending":
+                self._stats["pending"] += 1
+            elif self.fix and result == "status" and self.kind == "PAY" and \
+                    to_status(order[1]) == ORDER_CHOICE_0[0]:
+                fixable.append((record, order))
+            else:
+                self.write(result, record.order, bank_amount, order[0], record.status, order[1])
+        if fixable:
+            self._stats["fixed"] += agents.mark_orders_paid([record.order for record, _ in fixable])
+            for record, order in fixable:
+                self.write("status", record.order, record.payment_money, order[0], record.status, order[1],
+                           fixed=True)
+        close_old_connections()
+
+    def check_local(self, seen):
+        """
+            本地已支付(支付时间在时间段内)但银行没有支付流水的订单
+        """
+        import ccb_merchant_proxy as agents
+        pay_time = getattr(settings, "CMMC_ORDER_PAY_TIME", None)
+        if not pay_time:
+            return
+        code_field = agents.order_code_field()
+        queryset = agents.Order.objects.filter(**{settings.CMMC_ORDER_DEL_FLAG: FLAG_NO,
+                                                  settings.CMMC_ORDER_PAY_STATUS: ORDER_CHOICE_2[0],
+                                                  pay_time + "__range": (self.start, self.end)}) \
+            .values_list(code_field, settings.CMMC_ORDER_PAY_AMOUNT, settings.CMMC_ORDER_PAY_STATUS)
+        chunk = []
+        for row in queryset.iterator():
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                self._check_chunk(seen, chunk)
+                chunk = []
+        if chunk:
+            self._check_chunk(seen, chunk)
+
+    def _check_chunk(self, seen, rows):
+        missing = set(seen.missing([row[0] for row in rows]))
+        for code, amount, status in rows:
+            if code in missing:
+                self.write("missing_bank", code, order_amount=amount, order_status=status)
+
+    def run(self):
+        """
+            执行对账，返回summary
+        """
+        import ccb_merchant_proxy as agents
+        started = time.time()
+        seen = SeenCodes() if self.kind == "PAY" else None
+        self._fp = open(self.output, "wb")
+        try:
+            records = []
+            for record in agents.BankProxy.query_range(self.start, self.end, kind=self.kind, user=self.user,
+                                                        merchant_id=self.merchant_id):
+                self._stats["bank_records"] += 1
+                records.append(record)
+                if len(records) >= self.chunk_size:
+                    self._flush(records, seen)
+                    records = []
+            if records:
+                self._flush(records, seen)
+            if seen is not None:
+                self.check_local(seen)
+        finally:
+            self._fp.close()
+            self._fp = None
+            if seen is not None:
+                seen.close()
+        summary = dict(self._stats)
+        summary["elapsed"] = time.time() - started
+        return summary
+
+    def _flush(self, records, seen):
+        if seen is not None:
+            seen.add(record.order for record in records)
+        self.join(records)
+        logger.debug(u"[reconcile]: {0}".format(self._stats))
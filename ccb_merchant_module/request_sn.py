@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行请求流水号(REQUEST_SN)分配
+    原来以订单id作为REQUEST_SN，同一订单的并发操作(如状态查询和退款)流水号相同。
+    RequestSnAllocator通过django cache的原子incr一次预留一段流水号，进程内在线程锁下逐个分配：
+        同一进程内单调递增，不同进程/线程之间不重复(需要配置memcached/redis等共享cache)。
+    计数器只在共享且incr为原子操作的cache中才能保证不重复，ready()时检查，
+    本进程cache(locmem/dummy)和incr先读后写的cache(filebased/db)直接报错。
+    计数器不存在(首次使用或cache被清空)时以当前毫秒时间戳为起点，保证重启后继续递增。
+    银行应答中的REQUEST_SN必须与请求一致，见BankProxy.bank_tx_exchange(check_request_sn)。
+    @@调用：
+        sn = request_sn_allocator().allocate()
+    @@setting配置(均可选)：
+        CMMC_REQUEST_SN_CACHE = "default"       # 计数器使用的cache名称，必须是memcached/redis等共享cache
+        CMMC_REQUEST_SN_BLOCK = 100             # 每次预留的流水号数量
+"""
+import time
+import threading
+from django.conf import settings
+from cache_backends import cache_backend_path, is_local_cache
+
+# incr先读后写、不是跨进程原子操作的django cache后端
+NON_ATOMIC_CACHE_BACKENDS = frozenset(["django.core.cache.backends.filebased.FileBasedCache",
+                                       "django.core.cache.backends.db.DatabaseCache"])
+
+
+class RequestSnError(Exception):
+    """
+        应答流水号与请求不一致
+    """
+    pass
+
+
+class RequestSnAllocator(object):
+    """
+        按段预留的流水号分配器
+    """
+    Key = "cmmc:request_sn"
+
+    def __init__(self, cache_alias="default", block_size=100):
+        self.cache_alias = cache_alias
+        self.block_size = block_size
+        self._next = 0
+        self._limit = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.cache_alias]
+
+    def _reserve(self):
+        """
+            原子地预留一段流水号，返回(起始, 结束)，左闭右开
+        """
+        cache = self.cache
+        try:
+            high = cache.incr(self.Key, self.block_size)
+        except ValueError:
+            # 计数器不存在，以毫秒时间戳为起点；并发初始化时只有一个add成功
+            cache.add(self.Key, max(int(time.time() * 1000), self._limit), None)
+            high = cache.incr(self.Key, self.block_size)
+        return high - self.block_size + 1, high + 1
+
+    def allocate(self):
+        with self._lock:
+            if self._next >= self._limit:
+                self._next, self._limit = self._reserve()
+            sn = self._next
+            self._next += 1
+            return sn
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def check_request_sn_cache():
+    """
+        检查计数器使用的cache，多个worker会分配到相同流水号时抛出异常
+    """
+    alias = getattr(settings, "CMMC_REQUEST_SN_CACHE", "default")
+    if is_local_cache(alias) or cache_backend_path(alias) in NON_ATOMIC_CACHE_BACKENDS:
+        raise Exception(u"CMMC_REQUEST_SN_CACHE({0})需要配置为memcached/redis等共享cache，"
+                        u"{1}不能保证多个进程分配的REQUEST_SN不重复".format(alias, cache_backend_path(alias)))
+
+
+def request_sn_allocator():
+    """
+        按setting配置创建的全局流水号分配器
+    """
+    global _allocator
+    if _allocator is None:
+        with _allocator_lock:
+            if _allocator is None:
+                _allocator = RequestSnAllocator(cache_alias=getattr(settings, "CMMC_REQUEST_SN_CACHE", "default"),
+                                                block_size=getattr(settings, "CMMC_REQUEST_SN_BLOCK", 100))
+    return _allocator
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行客户端和建行网关调用的超时、截止时间和熔断
+    截止时间(deadline)：
+        一次银行交易(登录 + 请求 + 应答)共用一个截止时间，保存在线程本地变量中，
+        TcpProxy的每次connect/send/recv、连接池等待和HTTP请求的超时都不超过剩余时间，
+        剩余时间用完时抛出DeadlineExceeded；嵌套的deadline不会延长外层的截止时间。
+    熔断(CircuitBreaker)：
+        每个端点(业务端口、验签端口、聚合二维码网关的每个host)一个熔断器：
+        closed 连续失败(连接错误、超时、HTTP 5xx)达到CMMC_BREAKER_FAILURES次后进入open；
+        open 直接抛出CircuitOpenError，不再连接端点，CMMC_BREAKER_RESET秒后进入half_open；
+        half_open 只放行一个探测请求，成功则closed，失败则重新open。
+        breaker_states()读取状态，api/metrics导出cmmc_circuit_state。
+    @@调用：
+        with deadline(10):
+            proxy.bank_query_pay()
+        with circuit_breaker("127.0.0.1:12345").guard():
+            ...
+    @@setting配置(均可选)：
+        CMMC_BANK_DEADLINE = 30             # 一次银行交易的截止时间(秒)
+        CMMC_TOOLS_TIMEOUT = 10             # 银行客户端socket单次操作超时(秒)
+        CMMC_BREAKER_ENABLED = True         # 是否启用熔断
+        CMMC_BREAKER_FAILURES = 5           # 连续失败多少次后熔断
+        CMMC_BREAKER_RESET = 30             # 熔断后多少秒进入半开状态
+"""
+import time
+import socket
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class DeadlineExceeded(Exception):
+    """
+        银行交易超过截止时间
+    """
+    pass
+
+
+class CircuitOpenError(Exception):
+    """
+        端点已熔断
+    """
+    pass
+
+
+class Deadline(object):
+    __slots__ = ("expires",)
+
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+
+    def remaining(self):
+        return self.expires - time.time()
+
+
+_local = threading.local()
+
+
+def current_deadline():
+    return getattr(_local, "deadline", None)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+        设置截止时间，seconds为None或0时沿用外层截止时间
+    """
+    outer = current_deadline()
+    if not seconds:
+        yield outer
+        return
+    current = Deadline(seconds)
+    if outer is not None and outer.expires < current.expires:
+        current = outer
+    _local.deadline = current
+    try:
+        yield current
+    finally:
+        _local.deadline = outer
+
+
+def bank_deadline():
+    return getattr(settings, "CMMC_BANK_DEADLINE", 30)
+
+
+def with_deadline(func):
+    """
+        装饰器：按CMMC_BANK_DEADLINE限制整个调用的时间
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with deadline(bank_deadline()):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def remaining_time(timeout=None):
+    """
+        下一次阻塞操作可用的超时时间：min(timeout, 剩余时间)，截止时间已过时抛出DeadlineExceeded
+    """
+    current = current_deadline()
+    if current is None:
+        return timeout
+    remaining = current.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded(u"银行交易超时")
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+class CircuitBreaker(object):
+    """
+        单个端点的熔断器
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, failure_types=(socket.error, IOError)):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_types = failure_types
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "rejected": 0, "failures": 0}
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning(u"[circuit breaker]: {0} {1} -> {2}".format(self.name, self.state, state))
+            self.state = state
+
+    def available(self):
+        """
+            当前是否会放行请求(不改变状态)，供多主机路由跳过已熔断的主机
+        """
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN:
+            return time.time() - self.opened_at >= self.reset_timeout
+        return not self._probing
+
+    def before(self):
+        """
+            请求前检查，熔断时抛出CircuitOpenError；返回True表示本次为半开探测
+        """
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return False
+            if self.state == STATE_OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self._set_state(STATE_HALF_OPEN)
+            if self.state == STATE_HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self._stats["rejected"] += 1
+        raise CircuitOpenError(u"{0} 暂时不可用".format(self.name))
+
+    def success(self, probe=False):
+        with self._lock:
+            if probe:
+                self._probing = False
+            self.failures = 0
+            self._set_state(STATE_CLOSED)
+
+    def failure(self, probe=False):
+        with self._lock:
+            if probe:
+                self._probing = False
+            self.failures += 1
+            self._stats["failures"] += 1
+            if self.state == STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != STATE_OPEN:
+                    self._stats["opened"] += 1
+                self.opened_at = time.time()
+                self._set_state(STATE_OPEN)
+
+    def release(self, probe=False):
+        """
+            请求因与端点无关的原因失败(如连接池等待超时)，不改变状态
+        """
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    @contextmanager
+    def guard(self):
+        probe = self.before()
+        try:
+            yield
+        except self.failure_types:
+            self.failure(probe)
+            raise
+        except Exception:
+            self.release(probe)
+            raise
+        self.success(probe)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({"state": self.state, "consecutive_failures": self.failures})
+        return stats
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(name, failure_types=(socket.error, IOError)):
+    """
+        获取端点的熔断器，CMMC_BREAKER_ENABLED为False时返回None
+    """
+    if not getattr(settings, "CMMC_BREAKER_ENABLED", True):
+        return None
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name, failure_threshold=getattr(settings, "CMMC_BREAKER_FAILURES", 5),
+                                         reset_timeout=getattr(settings, "CMMC_BREAKER_RESET", 30),
+                                         failure_types=failure_types)
+                _breakers[name] = breaker
+    return breaker
+
+
+def breaker_states():
+    """
+        所有熔断器的状态, {name: {...}}
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return dict((breaker.name, breaker.stats()) for breaker in breakers)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+建行客户端本地模拟器，用于没有建行客户端软件时测试和压测TcpProxy、BankProxy和open_bank_reply
+    BankSimulator:
+        业务端口(BANK_TOOLS_PORT): 5W1001登录、5W1002支付流水查询(单订单/按时间段分页)、5W1003退款流水查询、5W1004退款
+        验签端口(BANK_VERIFY_PORT): 返回Y/N
+        HTTP端口: 模拟聚合二维码的/CCBIS/ccbMain(返回PAYURL)和PAYURL(返回QRURL)
+    可配置延迟、抖动、错误返回比例(error_rate)和直接断开连接比例(drop_rate)。
+    @@调用：
+        simulator = BankSimulator(latency=0.005, jitter=0.002, order_lookup=lookup)
+        simulator.start()
+        with override_settings(**simulator.settings_overrides()):
+            ...
+        python manage.py cmmc_simulator --tools-port 12345 --verify-port 12346 --http-port 8088
+    @@订单：
+        add_order(code, amount, status)登记订单；未登记的订单通过order_lookup(code)取得金额，视为已支付。
+"""
+import json
+import time
+import random
+import socket
+import urllib
+import logging
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from lxml import etree
+from utils import ORDER_STATUS_SUCCESS, ORDER_STATUS_REFUND, RETURN_NO_RECORD
+
+logger = logging.getLogger(__name__)
+
+# 模拟的银行流水状态，含义见utils；5W1004后订单变为已全额退款，5W1003只返回已全额退款的订单
+STATUS_SUCCESS = str(ORDER_STATUS_SUCCESS[0])
+STATUS_REFUND = str(ORDER_STATUS_REFUND[0])
+
+RETURN_OK = ("000000", u"交易成功")
+RETURN_NOT_FOUND = RETURN_NO_RECORD
+RETURN_INJECTED = ("YBLA99999999", u"模拟错误")
+
+QRCODE_PATH = "/CCBIS/ccbMain"
+PAYURL_PATH = "/CCBIS/pay"
+
+
+def quiet_handle_error(server, request, client_address):
+    """
+        客户端断开等异常只记录debug日志
+    """
+    logger.debug(u"[bank simulator]: request from {0} failed".format(client_address), exc_info=True)
+
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    handle_error = quiet_handle_error
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    handle_error = quiet_handle_error
+
+
+class ToolsHandler(SocketServer.BaseRequestHandler):
+    """
+        业务端口：按</TX>分帧，支持同一连接上的多个请求
+    """
+
+    def handle(self):
+        simulator = self.server.simulator
+        simulator.track(self.request)
+        try:
+            self.serve(simulator)
+        finally:
+            simulator.untrack(self.request)
+
+    def serve(self, simulator):
+        buf = ""
+        while True:
+            try:
+                data = self.request.recv(8192)
+            except socket.error:
+                return
+            if not data:
+                return
+            buf += data
+            while "</TX>" in buf:
+                end = buf.index("</TX>") + len("</TX>")
+                message, buf = buf[:end], buf[end:].lstrip()
+                reply = simulator.handle_tx(message)
+                if reply is None:
+                    return
+                self.request.sendall(reply)
+                if not simulator.keep_alive:
+                    return
+
+
+class VerifyHandler(SocketServer.BaseRequestHandler):
+    """
+        验签端口：读到换行后返回Y/N并关闭连接
+    """
+
+    def handle(self):
+        simulator = self.server.simulator
+        buf = ""
+        while "\n" not in buf:
+            data = self.request.recv(4096)
+            if not data:
+                break
+            buf += data
+        self.request.sendall(simulator.handle_verify(buf))
+
+
+class GatewayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        聚合二维码网关
+    """
+    protocol_version = "HTTP/1.1"
+    # 响应头和body一次写出，避免keep-alive连接上的Nagle延迟
+    wbufsize = -1
+
+    def handle(self):
+        self.server.simulator.track(self.request)
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            pass
+        finally:
+            self.server.simulator.untrack(self.request)
+
+    def _reply(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length") or 0)
+        params = urlparse.parse_qs(self.rfile.read(length))
+        self._reply(self.server.simulator.handle_qrcode(self.server.server_address, params))
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self._reply(self.server.simulator.handle_payurl(urlparse.parse_qs(url.query)))
+
+    def log_message(self, *args):
+        pass
+
+
+class BankSimulator(object):
+    """
+        建行客户端模拟器
+    """
+
+    def __init__(self, host="127.0.0.1", tools_port=0, verify_port=0, http_port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, drop_rate=0.0, keep_alive=True, page_size=20, order_lookup=None):
+        self.host = host
+        self.ports = {"tools": tools_port, "verify": verify_port, "http": http_port}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.keep_alive = keep_alive
+        self.page_size = page_size
+        self.order_lookup = order_lookup
+        self._orders = {}
+        self._lock = threading.Lock()
+        self._servers = []
+        self._stats = {}
+        self._clients = set()
+
+    # ********************************** 订单 **********************************
+    def add_order(self, code, amount, status=STATUS_SUCCESS):
+        with self._lock:
+            self._orders[code] = {"amount": float(amount), "status": status, "time": time.localtime()}
+
+    def get_order(self, code):
+        with self._lock:
+            order = self._orders.get(code)
+        if order is None and self.order_lookup is not None:
+            amount = self.order_lookup(code)
+            if amount is not None:
+                self.add_order(code, amount)
+                order = self._orders.get(code)
+        return order
+
+    # ********************************** 行为 **********************************
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + 1
+
+    def delay(self):
+        seconds = self.latency + random.uniform(-self.jitter, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    @staticmethod
+    def render(fields, info=None, records=()):
+        """
+            生成GB2312编码的应答报文
+        """
+        root = etree.Element("TX")
+        for name, value in fields:
+            etree.SubElement(root, name).text = value
+        tx_info = etree.SubElement(root, "TX_INFO")
+        for name, value in info or ():
+            etree.SubElement(tx_info, name).text = value
+        for record in records:
+            item = etree.SubElement(tx_info, "LIST")
+            for name, value in record:
+                etree.SubElement(item, name).text = value
+        return etree.tostring(root, xml_declaration=True, encoding="GB2312", standalone=True) + "\n"
+
+    def pay_record(self, code, order):
+        return (("TRAN_DATE", time.strftime("%Y-%m-%d %H:%M:%S", order["time"])), ("ORDER", code),
+                ("PAYMENT_MONEY", "{0:.2f}".format(order["amount"])), ("ORDER_STATUS", order["status"]))
+
+    def refund_record(self, code, order):
+        return (("TRAN_DATE", time.strftime("%Y-%m-%d %H:%M:%S", order["time"])), ("ORDER", code),
+                ("PAYMENT_MONEY", "{0:.2f}".format(order["amount"])),
+                ("REFUNDEMENT_AMOUNT", "{0:.2f}".format(order["amount"])), ("ORDER_STATUS", order["status"]))
+
+    def handle_tx(self, message):
+        """
+            处理一个业务请求，返回应答报文，返回None表示模拟断开连接
+        """
+        root = etree.fromstring(message)
+        tx_code = root.findtext("TX_CODE") or ""
+        sn = root.findtext("REQUEST_SN") or ""
+        info = dict((child.tag, child.text or "") for child in root.find("TX_INFO"))
+        self._count(tx_code)
+        self.delay()
+        if random.random() < self.drop_rate:
+            self._count("dropped")
+            return None
+        result, reply_info, records = RETURN_OK, (), ()
+        if random.random() < self.error_rate:
+            self._count("errors")
+            result = RETURN_INJECTED
+        elif tx_code in ("5W1002", "5W1003"):
+            result, reply_info, records = self.handle_query(tx_code, info)
+        elif tx_code == "5W1004":
+            order = self.get_order(info.get("ORDER", ""))
+            if order is None:
+                result = RETURN_NOT_FOUND
+            else:
+                order["status"] = STATUS_REFUND
+                reply_info = (("ORDER_NUM", info.get("ORDER", "")), ("AMOUNT", info.get("MONEY", "")))
+        fields = (("REQUEST_SN", sn), ("CUST_ID", root.findtext("CUST_ID") or ""), ("TX_CODE", tx_code),
+                  ("RETURN_CODE", result[0]), ("RETURN_MSG", result[1]), ("LANGUAGE", "CN"))
+        return self.render(fields, reply_info, records)
+
+    def handle_query(self, tx_code, info):
+        code = info.get("ORDER", "")
+        refund = tx_code == "5W1003"
+        build = self.refund_record if refund else self.pay_record
+        if code:
+            order = self.get_order(code)
+            if order is None or (refund and order["status"] != STATUS_REFUND):
+                return RETURN_NOT_FOUND, (), ()
+            return RETURN_OK, (("CUR_PAGE", "1"), ("PAGE_COUNT", "1")), [build(code, order)]
+        with self._lock:
+            items = sorted(self._orders.items())
+        if refund:
+            items = [(key, order) for key, order in items if order["status"] == STATUS_REFUND]
+        page = int(info.get("PAGE") or 1)
+        page_count = max(1, (len(items) + self.page_size - 1) // self.page_size)
+        items = items[(page - 1) * self.page_size:page * self.page_size]
+        return (RETURN_OK, (("CUR_PAGE", str(page)), ("PAGE_COUNT", str(page_count))),
+                [build(key, order) for key, order in items])
+
+    def handle_verify(self, raw_str):
+        self._count("verify")
+        self.delay()
+        if random.random() < self.error_rate:
+            self._count("errors")
+            return "N"
+        return "Y"
+
+    def handle_qrcode(self, address, params):
+        self._count("530550")
+        self.delay()
+        if random.random() < self.error_rate:
+            self._count("errors")
+            return {"SUCCESS": "false"}
+        order_id = (params.get("ORDERID") or [""])[0]
+        return {"SUCCESS": "true", "PAYURL": "http://{0}:{1}{2}?ORDERID={3}".format(
+            address[0], address[1], PAYURL_PATH, urllib.quote(order_id))}
+
+    def handle_payurl(self, params):
+        self._count("payurl")
+        self.delay()
+        order_id = (params.get("ORDERID") or [""])[0]
+        return {"SUCCESS": "true", "QRURL": urllib.quote("https://ibsbjstar.ccb.com.cn/qr?ORDERID=" + order_id)}
+
+    # ********************************** 服务 **********************************
+    def start(self):
+        for name, server_class, handler in (("tools", ThreadingTCPServer, ToolsHandler),
+                                            ("verify", ThreadingTCPServer, VerifyHandler),
+                                            ("http", ThreadingHTTPServer, GatewayHandler)):
+            server = server_class((self.host, self.ports[name]), handler)
+            server.simulator = self
+            self.ports[name] = server.server_address[1]
+            thread = threading.Thread(target=server.serve_forever, name="cmmc-simulator-" + name)
+            thread.daemon = True
+            thread.start()
+            self._servers.append(server)
+        return self
+
+    def track(self, request):
+        """
+            记录业务端口和HTTP端口的长连接，stop时关闭
+        """
+        with self._lock:
+            self._clients.add(request)
+
+    def untrack(self, request):
+        with self._lock:
+            self._clients.discard(request)
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        with self._lock:
+            clients = list(self._clients)
+        for request in clients:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        # 等待处理线程退出，避免解释器退出时daemon线程仍在运行
+        deadline = time.time() + 1
+        while self._clients and time.time() < deadline:
+            time.sleep(0.01)
+
+    def settings_overrides(self):
+        """
+            指向模拟器的setting配置
+        """
+        return {"BANK_TOOLS_HOST": self.host, "BANK_TOOLS_PORT": self.ports["tools"],
+                "BANK_VERIFY_PORT": self.ports["verify"],
+                "CMMC_QRCODE_GATEWAY_URL": "http://{0}:{1}{2}".format(self.host, self.ports["http"], QRCODE_PATH)}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
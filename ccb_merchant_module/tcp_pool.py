@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行客户端(BANK_TOOLS_HOST)的TCP连接池
+    TcpProxy: 单个socket连接的封装
+    TcpConnectionPool: 按(host, port)维护的连接池，限制连接数量，带健康检查和有界等待队列
+    @@调用：
+        with tools_pool().connection() as conn:
+            conn.send_data(xml_string)
+            resp = conn.receive_data()
+        resp = tools_pool().request(xml_string, label="5W1002")    # label为统计使用的交易码
+    @@说明：
+        银行应答以terminator(如"</TX>")结束且对端未关闭连接时，连接放回池中复用；
+        对端在应答后关闭连接时，该连接被丢弃，下次取用时重新建立；
+        复用的连接在收到任何应答数据前被对端关闭(EOF/ECONNRESET/EPIPE，对端的FIN晚于健康检查到达)时，
+        丢弃该连接并在新连接上重试一次，收到应答数据后不再重试。ECONNRESET不能证明银行客户端没有处理请求，
+        只重试可以重复发送的交易(IDEMPOTENT_LABELS：登录和查询、验签)，退款(5W1004)等交易不重试，直接抛出异常。
+        应答通过FrameCodec接收(recv_into预分配缓冲，按结束标签或长度头分帧)，见framing。
+        connect/send/recv各阶段的耗时按label记录到metrics。
+        每次socket操作的超时为CMMC_TOOLS_TIMEOUT和当前deadline剩余时间中的较小值，超时抛出socket.timeout；
+        request()经过端点的熔断器，端点熔断时抛出CircuitOpenError，见resilience。
+    @@setting配置(均可选)：
+        CMMC_POOL_SIZE = 10             # 每个端口的最大连接数
+        CMMC_POOL_MAX_WAITERS = 50      # 等待队列长度，超出直接抛出PoolTimeoutError
+        CMMC_POOL_WAIT_TIMEOUT = 5      # 等待可用连接的超时时间(秒)
+        CMMC_POOL_MAX_IDLE = 60         # 空闲连接的最长保留时间(秒)
+        CMMC_TOOLS_TIMEOUT = 10         # socket单次操作超时(秒)
+        CMMC_TOOLS_LENGTH_HEADER = 0    # 业务端口应答的十进制长度头位数，0表示按</TX>分帧
+"""
+import time
+import errno
+import select
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from metrics import metrics, TX_VERIFY
+from resilience import remaining_time, circuit_breaker
+from framing import FrameCodec
+
+logger = logging.getLogger(__name__)
+
+# 银行客户端xml应答的结束标记
+TOOLS_TERMINATOR = "</TX>"
+
+# 复用的连接已被对端关闭时的socket错误
+STALE_ERRNOS = frozenset([errno.ECONNRESET, errno.EPIPE])
+
+# 可以重复发送的交易：5W1001登录、5W1002支付流水查询、5W1003退款流水查询、验签
+IDEMPOTENT_LABELS = frozenset(["5W1001", "5W1002", "5W1003", TX_VERIFY])
+
+
+class PoolTimeoutError(Exception):
+    """
+        连接池等待超时
+    """
+    pass
+
+
+class TcpProxy(object):
+    """
+        socket connection to bank tools
+    """
+    def __init__(self, sock=None, label="tcp", timeout=None, header_size=0):
+        if sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        else:
+            self.sock = sock
+        self.closed = False
+        self.last_used = time.time()
+        # 是否从连接池中复用，本次请求已收到的应答字节数
+        self.reused = False
+        self.received = 0
+        # 统计使用的交易码
+        self.label = label
+        self.timeout = timeout
+        self.codec = FrameCodec(header_size=header_size)
+
+    def connect(self, host, port):
+        start = time.time()
+        self.sock.settimeout(remaining_time(self.timeout))
+        self.sock.connect((host, port))
+        metrics().observe(self.label, "connect", time.time() - start)
+
+    def send_data(self, data):
+        start = time.time()
+        self.sock.settimeout(remaining_time(self.timeout))
+        self.received = 0
+        self.sock.sendall(data)
+        self.last_used = time.time()
+        metrics().observe(self.label, "send", self.last_used - start)
+
+    def receive_data(self, terminator=None):
+        """
+            接收应答数据
+            :param terminator: None, 读取到对端关闭连接为止并关闭socket(使用长度头时按长度分帧)；
+                               否则读取到terminator即返回，连接保持打开
+        """
+        start = time.time()
+        codec = self.codec
+        codec.terminator = terminator
+        while True:
+            frame = codec.next_frame()
+            if frame is not None:
+                self.last_used = time.time()
+                metrics().observe(self.label, "recv", self.last_used - start)
+                return frame
+            self.sock.settimeout(remaining_time(self.timeout))
+            size = self.sock.recv_into(codec.free_space())
+            if not size:
+                break
+            self.received += size
+            codec.commit(size)
+        self.close()
+        metrics().observe(self.label, "recv", time.time() - start)
+        return codec.eof_frame()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+
+    def is_alive(self):
+        """
+            健康检查：连接未关闭，且对端没有发送FIN或多余数据
+        """
+        if self.closed or self.codec.pending():
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                return True
+            # 应答之后的空白字符(如"</TX>\n"的换行)可能晚于应答到达，读掉后连接仍可复用
+            data = self.sock.recv(64, socket.MSG_PEEK)
+            if data and not data.strip():
+                self.sock.recv(len(data))
+                return self.is_alive()
+            # 对端已关闭或存在残留数据，均不可复用
+            return False
+        except (select.error, socket.error, ValueError) as ex:
+            if getattr(ex, "errno", None) == errno.EINTR:
+                return True
+            return False
+
+
+class TcpConnectionPool(object):
+    """
+        按(host, port)维护的TcpProxy连接池
+    """
+
+    def __init__(self, host, port, size=10, max_waiters=50, wait_timeout=5, max_idle=60, terminator=None,
+                 timeout=10, header_size=0):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_waiters = max_waiters
+        self.wait_timeout = wait_timeout
+        self.max_idle = max_idle
+        self.terminator = terminator
+        self.timeout = timeout
+        self.header_size = header_size
+        self.breaker = circuit_breaker("{0}:{1}".format(host, port))
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []
+        self._total = 0
+        self._in_use = 0
+        self._waiters = 0
+        self._stats = {"created": 0, "reused": 0, "discarded": 0, "waits": 0, "timeouts": 0, "errors": 0,
+                       "stale": 0}
+
+    def _healthy(self, conn):
+        if time.time() - conn.last_used > self.max_idle:
+            return False
+        return conn.is_alive()
+
+    def acquire(self, label="tcp", fresh=False):
+        """
+            取出一个可用连接，池满时在等待队列中等待，超时抛出PoolTimeoutError
+            :param label: 统计使用的交易码
+            :param fresh: 不复用空闲连接，总是建立新连接(池满时关闭最早的空闲连接)
+        """
+        deadline = time.time() + remaining_time(self.wait_timeout)
+        with self._cond:
+            while True:
+                if fresh and self._idle and self._total >= self.size:
+                    self._idle.pop(0).close()
+                    self._total -= 1
+                    self._stats["discarded"] += 1
+                while self._idle and not fresh:
+                    conn = self._idle.pop()
+                    if self._healthy(conn):
+                        self._in_use += 1
+                        self._stats["reused"] += 1
+                        conn.label = label
+                        conn.reused = True
+                        return conn
+                    conn.close()
+                    self._total -= 1
+                    self._stats["discarded"] += 1
+                if self._total < self.size:
+                    self._total += 1
+                    self._in_use += 1
+                    break
+                if self._waiters >= self.max_waiters:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeoutError(u"连接池等待队列已满: {0}:{1}".format(self.host, self.port))
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeoutError(u"等待连接超时: {0}:{1}".format(self.host, self.port))
+                self._waiters += 1
+                self._stats["waits"] += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiters -= 1
+        # 在锁外建立新连接，避免阻塞其他线程
+        conn = TcpProxy(label=label, timeout=self.timeout, header_size=self.header_size)
+        try:
+            conn.connect(self.host, self.port)
+        except Exception:
+            conn.close()
+            with self._cond:
+                self._total -= 1
+                self._in_use -= 1
+                self._stats["errors"] += 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def release(self, conn):
+        """
+            归还连接，已关闭的连接直接丢弃
+        """
+        with self._cond:
+            self._in_use -= 1
+            if conn.closed:
+                self._total -= 1
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, label="tcp", fresh=False):
+        conn = self.acquire(label, fresh)
+        try:
+            yield conn
+        except Exception:
+            # 异常时连接状态不确定，不再复用
+            conn.close()
+            with self._cond:
+                self._stats["errors"] += 1
+            raise
+        finally:
+            self.release(conn)
+
+    def request(self, data, label="tcp", idempotent=None):
+        """
+            发送数据并读取一个完整应答
+            :param idempotent: 请求可以重复发送，复用的连接已关闭时在新连接上重试；None时按label(交易码)判断
+        """
+        if idempotent is None:
+            idempotent = label in IDEMPOTENT_LABELS
+        if self.breaker is None:
+            return self._request(data, label, idempotent)
+        with self.breaker.guard():
+            return self._request(data, label, idempotent)
+
+    def _request(self, data, label, idempotent):
+        retry, fresh = idempotent, False
+        while True:
+            with self.connection(label, fresh=fresh) as conn:
+                try:
+                    conn.send_data(data)
+                    resp = conn.receive_data(self.terminator)
+                except socket.error as ex:
+                    if not (retry and self._stale(conn, ex)):
+                        raise
+                else:
+                    if not (retry and self._stale(conn)):
+                        return resp
+                # 复用的连接在应答前已被对端关闭，丢弃后在新连接上重试一次
+                conn.close()
+                with self._cond:
+                    self._stats["stale"] += 1
+            retry, fresh = False, True
+
+    @staticmethod
+    def _stale(conn, error=None):
+        """
+            复用的连接在收到任何应答数据前被对端关闭
+        """
+        if not conn.reused or conn.received:
+            return False
+        if error is None:
+            return conn.closed
+        return getattr(error, "errno", None) in STALE_ERRNOS
+
+    def outstanding(self):
+        """
+            在途请求数(使用中和等待中的连接)，多主机路由按此选择
+        """
+        return self._in_use + self._waiters
+
+    def close_all(self):
+        with self._cond:
+            for conn in self._idle:
+                conn.close()
+            self._total -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({"size": self.size, "total": self._total, "in_use": self._in_use,
+                          "idle": len(self._idle), "waiters": self._waiters})
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port, terminator=None):
+    """
+        获取(host, port)对应的连接池，不存在时按setting配置创建
+    """
+    key = (host, port)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = TcpConnectionPool(host, port,
+                                         size=getattr(settings, "CMMC_POOL_SIZE", 10),
+                                         max_waiters=getattr(settings, "CMMC_POOL_MAX_WAITERS", 50),
+                                         wait_timeout=getattr(settings, "CMMC_POOL_WAIT_TIMEOUT", 5),
+                                         max_idle=getattr(settings, "CMMC_POOL_MAX_IDLE", 60),
+                                         terminator=terminator,
+                                         timeout=getattr(settings, "CMMC_TOOLS_TIMEOUT", 10),
+                                         header_size=getattr(settings, "CMMC_TOOLS_LENGTH_HEADER", 0)
+                                         if terminator else 0)
+                _pools[key] = pool
+    return pool
+
+
+def tools_pool():
+    """
+        银行客户端业务端口(BANK_TOOLS_PORT)连接池
+    """
+    return get_pool(settings.BANK_TOOLS_HOST, settings.BANK_TOOLS_PORT, terminator=TOOLS_TERMINATOR)
+
+
+def verify_pool():
+    """
+        银行验签端口(BANK_VERIFY_PORT)连接池
+    """
+    return get_pool(settings.BANK_TOOLS_HOST, settings.BANK_VERIFY_PORT)
+
+
+def pool_stats():
+    """
+        所有连接池的统计信息, {"host:port": {...}}
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    return dict(("{0}:{1}".format(pool.host, pool.port), pool.stats()) for pool in pools)
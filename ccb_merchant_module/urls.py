@@ -6,4 +6,6 @@ from views import *
 
 urlpatterns = [
     url("^api/open/bank_reply$", api_open_bank_reply),
+    url("^api/pay_status$", api_pay_status),
+    url("^api/metrics$", api_metrics),
 ]
@@ -27,6 +27,14 @@ ORDER_STATUS_REFUND_PART = (3, u"已部分退款")
 ORDER_STATUS_REFUND = (4, u"已全额退款")
 ORDER_STATUS_WAIT_1 = (5, u"待银行确认")
 
+# 5W1003退款流水状态：成功、已部分退款、已全额退款为已退款，失败为未退款，待银行确认时结果未知
+REFUND_DONE_STATUSES = frozenset(str(status[0]) for status in (ORDER_STATUS_SUCCESS, ORDER_STATUS_REFUND_PART,
+                                                               ORDER_STATUS_REFUND))
+REFUND_FAILED_STATUSES = frozenset([str(ORDER_STATUS_FAIL[0])])
+
+# 银行返回码：查询的订单没有流水记录
+RETURN_NO_RECORD = ("YBLA00000002", u"流水记录不存在")
+
 
 import logging
 from err_code import *
@@ -71,11 +79,14 @@ def log_request(request):
         user_account = getattr(request.user, 'username', '-')
     else:
         user_account = 'nobody-user'
+    from audit import audit_event
+    audit_event("request", method=request.method, path=request.get_full_path(), remote_addr=remote_addr,
+                user=user_account)
     if 'POST' == str(request.method):
-        logger.info('[POST] %s %s %s :' % (remote_addr, user_account, request.get_full_path()))
+        logger.info('[POST] %s %s %s :', remote_addr, user_account, request.get_full_path())
         # info(request.POST)
     if 'GET' == str(request.method):
-        logger.info('[GET] %s %s %s :' % (remote_addr, user_account, request.get_full_path()))
+        logger.info('[GET] %s %s %s :', remote_addr, user_account, request.get_full_path())
         # info(request.GET)
 
 
@@ -83,3 +94,13 @@ def get_user_role(user):
     user_role_list = list()
     user_role_list.append(user.type)
     return user_role_list
+
+
+def percentile(sorted_values, pct):
+    """
+        已排序数据的百分位数(最近秩)，pct取0-100
+    """
+    if not sorted_values:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[min(len(sorted_values) - 1, max(0, index))]
@@ -2,11 +2,17 @@
 # coding=utf-8
 
 import json
+import math
 import traceback
 import logging
 
-from django.http import HttpResponse
-from utils import auth_check
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, Http404
+from utils import auth_check, ORDER_CHOICE_0
+from err_code import ERR_SUCCESS, ERR_WAIT_QUERY, ERR_REQUEST_PARAMETER_ERROR, ERR_USER_NOTLOGGED
+from metrics import metrics, render_prometheus, METRICS_LOCAL_IPS
+from payment_notifier import pay_wait_timeout
 import ccb_merchant_proxy as agents
 
 logger = logging.getLogger(__name__)
@@ -20,10 +26,71 @@ def api_open_bank_reply(request):
     if dict_resp != {}:
         return HttpResponse(json.dumps(dict_resp, ensure_ascii=False), content_type="application/json")
     try:
-        agents.open_bank_reply(request)
+        if getattr(settings, "CMMC_CALLBACK_ASYNC", False):
+            agents.enqueue_bank_reply(request)
+        else:
+            agents.open_bank_reply(request)
         return HttpResponse()
     except Exception as ex:
         error_info = traceback.format_exc()
         logger.error(error_info)
         dict_resp = dict(c=-1, m=ex.message)
         return HttpResponse(json.dumps(dict_resp, ensure_ascii=False), content_type="application/json")
+
+
+@transaction.non_atomic_requests
+def api_pay_status(request):
+    """
+        等待订单支付结果(长轮询)，GET order_code=订单号&timeout=等待秒数(不超过CMMC_PAY_WAIT_TIMEOUT)
+        订单已支付时立即返回；未支付时等待银行回调通知，超时后查询一次银行，仍未支付时返回ERR_WAIT_QUERY，
+        客户端重新发起请求即可。
+        只能查询当前登录用户自己的订单，需要配置CMMC_ORDER_USER(订单所属用户字段名)，未配置时接口不可用。
+        不能在事务中执行，否则等待后读取的订单状态是事务开始时的快照。
+    """
+    if not agents.order_config().user:
+        raise Http404
+    dict_resp = auth_check(request, "GET")
+    if dict_resp == {} and not request.user.is_authenticated():
+        # IS_CHECK_LOGIN关闭时也不允许匿名查询
+        dict_resp = {'c': ERR_USER_NOTLOGGED[0], 'm': ERR_USER_NOTLOGGED[1]}
+    if dict_resp != {}:
+        return HttpResponse(json.dumps(dict_resp, ensure_ascii=False), content_type="application/json")
+    order_code = request.GET.get("order_code", "")
+    max_timeout = pay_wait_timeout()
+    try:
+        timeout = float(request.GET.get("timeout", max_timeout))
+    except ValueError:
+        timeout = -1
+    # nan能通过min()和<0的检查，Event.wait(nan)在py2中不会返回
+    if math.isnan(timeout) or math.isinf(timeout):
+        timeout = -1
+    timeout = min(timeout, max_timeout)
+    if not order_code or timeout < 0:
+        dict_resp = {'c': ERR_REQUEST_PARAMETER_ERROR[0], 'm': ERR_REQUEST_PARAMETER_ERROR[1]}
+        return HttpResponse(json.dumps(dict_resp, ensure_ascii=False), content_type="application/json")
+    try:
+        status, source = agents.wait_pay_status(order_code, timeout, request.user, owner=request.user)
+    except Exception as ex:
+        error_info = traceback.format_exc()
+        logger.error(error_info)
+        dict_resp = dict(c=-1, m=ex.message)
+        return HttpResponse(json.dumps(dict_resp, ensure_ascii=False), content_type="application/json")
+    code = ERR_WAIT_QUERY if str(status) == str(ORDER_CHOICE_0[0]) else ERR_SUCCESS
+    dict_resp = {'c': code[0], 'm': code[1], 'd': {"order_code": order_code, "pay_status": status, "source": source}}
+    return HttpResponse(json.dumps(dict_resp, ensure_ascii=False), content_type="application/json")
+
+
+def api_metrics(request):
+    """
+        银行交易统计，Prometheus文本格式，只允许CMMC_METRICS_ALLOWED_IPS(默认本机)和staff用户访问
+    """
+    registry = metrics()
+    if not registry.enabled:
+        raise Http404
+    allowed_ips = getattr(settings, "CMMC_METRICS_ALLOWED_IPS", None)
+    if allowed_ips is None:
+        allowed_ips = METRICS_LOCAL_IPS
+    user = getattr(request, "user", None)
+    if request.META.get("REMOTE_ADDR") not in allowed_ips and not (user is not None and user.is_staff):
+        return HttpResponse(status=403)
+    return HttpResponse(render_prometheus(registry), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行客户端应答报文的单遍解析
+    parse_header: 只解析报文头(REQUEST_SN/TX_CODE/RETURN_CODE/RETURN_MSG/CUR_PAGE/PAGE_COUNT)，读到后即停止
+    parse_reply: 单遍解析整个应答，返回BankReply，reply.record为第一条订单记录(单订单查询/退款)
+    iter_records: 基于iterparse的生成器，逐条返回LIST记录并释放已处理的元素，大页面查询时内存占用不随记录数增长
+    @@调用：
+        reply = parse_reply(resp_xml)
+        if reply.return_code == "000000":
+            order_code, status = reply.record.order, reply.record.status
+
+        for record in iter_records(resp_xml):
+            record.order, record.payment_money, record.status
+    lxml在首次解析时导入
+"""
+from io import BytesIO
+
+HEADER_FIELDS = {"REQUEST_SN": "request_sn", "TX_CODE": "tx_code", "RETURN_CODE": "return_code",
+                 "RETURN_MSG": "return_msg", "CUR_PAGE": "cur_page", "PAGE_COUNT": "page_count"}
+
+RECORD_FIELDS = {"TRAN_DATE": "tran_date", "ACC_DATE": "acc_date", "ORDER": "order", "ORDER_NUM": "order",
+                 "ACCOUNT": "account", "PAYMENT_MONEY": "payment_money", "REFUNDEMENT_AMOUNT": "refund_amount",
+                 "AMOUNT": "amount", "POS_ID": "pos_id", "ORDER_STATUS": "status"}
+
+AMOUNT_FIELDS = frozenset(["payment_money", "refund_amount", "amount"])
+INT_FIELDS = frozenset(["cur_page", "page_count"])
+
+
+def to_number(text, func):
+    try:
+        return func(text)
+    except (TypeError, ValueError):
+        return None
+
+
+class BankRecord(object):
+    """
+        一条订单流水记录，金额字段为float，其余为银行返回的文本
+    """
+    __slots__ = ("tran_date", "acc_date", "order", "account", "payment_money", "refund_amount", "amount",
+                 "pos_id", "status")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def set_field(self, tag, text, overwrite=True):
+        name = RECORD_FIELDS.get(tag)
+        if name is None or (not overwrite and getattr(self, name) is not None):
+            return False
+        setattr(self, name, to_number(text, float) if name in AMOUNT_FIELDS else (text or ""))
+        return True
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return "<BankRecord {0} {1} {2}>".format(self.order, self.payment_money, self.status)
+
+
+class BankReply(object):
+    """
+        应答报文头和第一条订单记录
+    """
+    __slots__ = ("request_sn", "tx_code", "return_code", "return_msg", "cur_page", "page_count", "record")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def set_field(self, tag, text):
+        name = HEADER_FIELDS.get(tag)
+        if name is None:
+            return False
+        setattr(self, name, to_number(text, int) if name in INT_FIELDS else text)
+        return True
+
+    @property
+    def ok(self):
+        return self.return_code == "000000"
+
+
+def _iterparse(xml_string):
+    from lxml import etree
+    return etree.iterparse(BytesIO(xml_string), events=("end",))
+
+
+def _free(elem):
+    """
+        释放已处理的元素及其之前的兄弟节点
+    """
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+def parse_header(xml_string):
+    """
+        只解析报文头，读到RETURN_CODE和RETURN_MSG后停止
+    """
+    reply = BankReply()
+    for _, elem in _iterparse(xml_string):
+        reply.set_field(elem.tag, elem.text)
+        if elem.tag == "TX_INFO" or (reply.return_code is not None and elem.tag == "RETURN_MSG"):
+            break
+    return reply
+
+
+def parse_reply(xml_string):
+    """
+        单遍解析应答，返回BankReply，reply.record为第一次出现的订单字段
+    """
+    reply = BankReply()
+    record = BankRecord()
+    has_record = False
+    for _, elem in _iterparse(xml_string):
+        tag = elem.tag
+        if not reply.set_field(tag, elem.text):
+            has_record = record.set_field(tag, elem.text, overwrite=False) or has_record
+        if tag != "LIST" and len(elem) == 0:
+            elem.clear()
+        elif tag == "LIST":
+            _free(elem)
+    if has_record:
+        reply.record = record
+    return reply
+
+
+def iter_records(xml_string, reply=None):
+    """
+        逐条返回LIST记录(BankRecord)
+        :param reply: 可选的BankReply，解析过程中顺带填充报文头字段
+    """
+    for _, elem in _iterparse(xml_string):
+        tag = elem.tag
+        if tag == "LIST":
+            record = BankRecord()
+            for child in elem:
+                record.set_field(child.tag, child.text)
+            _free(elem)
+            yield record
+        elif reply is not None and reply.set_field(tag, elem.text):
+            elem.clear()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+银行客户端TX请求报文的预编译模板(5W1001-5W1004)
+    模板中的标签、TX_CODE等固定部分在编译时一次性编码为GB2312，
+    每次请求只对动态字段转义、编码后拼接，元素顺序固定为银行文档中的顺序。
+    @@调用：
+        template = QUERY_PAY_TEMPLATE.bind(CUST_ID=merchant_id, USER_ID=user_id, PASSWORD=password)
+        xml_string = template.render(REQUEST_SN=sn, ORDER=order_code, POS_CODE=pos_id, ...)
+    输出与lxml etree.tostring(tx_root, xml_declaration=True, encoding="GB2312", standalone=True)一致。
+"""
+import threading
+from xml.sax.saxutils import escape
+
+# TX报文头字段顺序
+TX_HEAD_FIELDS = ("REQUEST_SN", "CUST_ID", "USER_ID", "PASSWORD", "TX_CODE", "LANGUAGE")
+
+# 5W1002/5W1003 TX_INFO字段顺序
+QUERY_INFO_FIELDS = ("START", "STARTHOUR", "STARTMIN", "END", "ENDHOUR", "ENDMIN", "KIND", "ORDER",
+                     "ACCOUNT", "DEXCEL", "MONEY", "NORDERBY", "PAGE", "POS_CODE", "STATUS")
+
+
+def encode_value(value, encoding):
+    """
+        动态字段转义并编码，编码不支持的字符使用字符引用
+    """
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        value = value.decode("UTF-8")
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+    return escape(value).encode(encoding, "xmlcharrefreplace")
+
+
+class TxTemplate(object):
+    """
+        编译后的TX请求模板，parts为字节串(固定部分)和字段名(动态部分)交替组成的列表
+    """
+
+    def __init__(self, parts, encoding="GB2312", tx_code=None):
+        self.encoding = encoding
+        self.tx_code = tx_code
+        self.parts = self._merge(parts)
+        self.fields = frozenset(part[1] for part in self.parts if isinstance(part, tuple))
+        self._bound = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _merge(parts):
+        merged = []
+        for part in parts:
+            if not isinstance(part, tuple) and merged and not isinstance(merged[-1], tuple):
+                merged[-1] += part
+            else:
+                merged.append(part)
+        return merged
+
+    @classmethod
+    def compile(cls, tx_code, info_fields, encoding="GB2312", language="CN"):
+        static = {"TX_CODE": tx_code, "LANGUAGE": language}
+        parts = ["<?xml version='1.0' encoding='{0}' standalone='yes'?>\n<TX>".format(encoding)]
+        for field in TX_HEAD_FIELDS:
+            parts.append("<{0}>".format(field))
+            if field in static:
+                parts.append(encode_value(static[field], encoding))
+            else:
+                parts.append(("field", field))
+            parts.append("</{0}>".format(field))
+        parts.append("<TX_INFO>")
+        for field in info_fields:
+            parts.extend(["<{0}>".format(field), ("field", field), "</{0}>".format(field)])
+        parts.append("</TX_INFO></TX>")
+        return cls(parts, encoding, tx_code)
+
+    def bind(self, **constants):
+        """
+            将商户号、操作员、密码等不变的字段固化为静态部分，返回新的模板(按参数缓存)
+        """
+        key = tuple(sorted(constants.items()))
+        template = self._bound.get(key)
+        if template is None:
+            with self._lock:
+                template = self._bound.get(key)
+                if template is None:
+                    parts = []
+                    for part in self.parts:
+                        if isinstance(part, tuple) and part[1] in constants:
+                            parts.append(encode_value(constants[part[1]], self.encoding))
+                        else:
+                            parts.append(part)
+                    template = TxTemplate(parts, self.encoding, self.tx_code)
+                    self._bound[key] = template
+        return template
+
+    def render(self, **values):
+        """
+            填充动态字段，返回编码后的xml字节串，未提供的字段输出为空元素
+        """
+        unknown = set(values) - self.fields
+        if unknown:
+            raise Exception(u"模板字段错误: {0}".format(u", ".join(sorted(unknown))))
+        encoding = self.encoding
+        return "".join(part if not isinstance(part, tuple) else encode_value(values.get(part[1]), encoding)
+                       for part in self.parts)
+
+
+LOGIN_TEMPLATE = TxTemplate.compile("5W1001", ("REM1", "REM2"))
+QUERY_PAY_TEMPLATE = TxTemplate.compile("5W1002", QUERY_INFO_FIELDS)
+QUERY_REFUND_TEMPLATE = TxTemplate.compile("5W1003", QUERY_INFO_FIELDS)
+REFUND_TEMPLATE = TxTemplate.compile("5W1004", ("MONEY", "ORDER", "SIGN_INFO", "SIGNCERT"))